@@ -0,0 +1,300 @@
+"""This module provides a benchmark suite for the template engine (see the
+:py:mod:`templates` module).  Synthetic templates of a configurable shape are
+generated and then loaded, installed (in several ways) and uninstalled, with
+the wall time, peak memory use and rate of files processed recorded for each
+step.  Results are written as JSON so that changes to the engine can be
+compared across commits.
+
+To run the benchmarks, use the helper executable provided::
+
+   gbpBuild_helper benchmark --shape medium --output results.json
+
+or run the tests, setting ``GBPBUILD_BENCHMARK_SHAPE`` (and, optionally,
+``GBPBUILD_BENCHMARK_OUTPUT``) to choose the shape (and save the results)::
+
+   GBPBUILD_BENCHMARK_SHAPE=large pytest tests/test_benchmarks.py
+"""
+import os
+import sys
+import importlib
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Infer the name of this package from the path of __file__
+package_parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+package_root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+package_name = os.path.basename(package_root_dir)
+
+# Make sure that what's in this path takes precedence
+# over an installed version of the project
+sys.path.insert(0, package_parent_dir)
+
+# Import needed internal modules
+pkg = importlib.import_module(package_name)
+tmp = importlib.import_module(package_name + '.templates')
+
+#: Preset template shapes.  Each gives the number of files in the template, the depth of
+#: its directory tree, the number of sub-directories of each directory, the number of
+#: symlinked sub-templates (and of files in each), the number of files with parameterised
+#: names, the length of the list-valued parameter, the number of files using DIRLIST
+#: directives and the number of lines in each template file.
+shapes = {
+    'tiny': {'n_files': 24, 'depth': 2, 'n_subdirs': 2, 'n_links': 1, 'n_link_files': 4, 'n_var_files': 2,
+             'list_length': 3, 'n_dirlist': 1, 'n_lines': 20},
+    'small': {'n_files': 200, 'depth': 3, 'n_subdirs': 3, 'n_links': 2, 'n_link_files': 10, 'n_var_files': 10,
+              'list_length': 5, 'n_dirlist': 4, 'n_lines': 50},
+    'medium': {'n_files': 2000, 'depth': 4, 'n_subdirs': 4, 'n_links': 4, 'n_link_files': 50, 'n_var_files': 50,
+               'list_length': 10, 'n_dirlist': 16, 'n_lines': 100},
+    'large': {'n_files': 20000, 'depth': 5, 'n_subdirs': 5, 'n_links': 8, 'n_link_files': 250, 'n_var_files': 250,
+              'list_length': 20, 'n_dirlist': 64, 'n_lines': 100}}
+
+#: Steps timed by the benchmark, in the order they are run
+steps = ('add_cold', 'add_warm', 'install_silent', 'install', 'install_force', 'install_update', 'uninstall')
+
+
+def peak_rss():
+    """Return the peak resident set size of this process.
+
+    :return: Size in bytes (None if it can not be determined)
+    """
+    if(resource is None):
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes; macOS reports bytes
+    if(sys.platform != 'darwin'):
+        rss *= 1024
+    return rss
+
+
+class synthetic_template(object):
+    """This class generates a synthetic template with a given shape (see the
+    `shapes` dictionary for the meaning of the keyword arguments).
+
+    Template files reference scalar and list-valued parameters, some files
+    and one directory per level have parameterised (_var_) names, DIRLIST
+    directives list the files of their directories, and sub-templates are
+    symlinked (as directories) from a support directory outside the template,
+    as the stock templates do.
+
+    :param path: Directory to generate the template in
+    :param name: Name of the template
+    """
+
+    def __init__(self, path, name='synthetic', **shape):
+        self.path = os.path.abspath(path)
+        self.name = name
+        self.shape = dict(shapes['tiny'])
+        self.shape.update(shape)
+        self.dir_templates = os.path.join(self.path, 'templates')
+        self.dir_template = os.path.join(self.dir_templates, name)
+        self.dir_support = os.path.join(self.path, 'support')
+        self.params = {
+            'name': 'bench',
+            'author': 'Benchmark',
+            'items': ['item%d' % (i_item) for i_item in range(self.shape['list_length'])]}
+
+        # The template-relative path of the (non-parameterised) directory to use for updates
+        self.update_dir = None
+
+        self._generate()
+
+    def _write(self, path, txt):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp_out:
+            fp_out.write(txt)
+
+    def _text(self, i_file):
+        lines = []
+        for i_line in range(self.shape['n_lines']):
+            if(i_line % 10 == 0):
+                lines.append("# File %d of %%%%%%name%%%%%% by %%%%%%author%%%%%%\n" % (i_file))
+            elif(i_line % 10 == 5):
+                lines.append("item_%d = %%%%%%items%%%%%%;\n" % (i_line))
+            else:
+                lines.append("line %d of file %d: no references here.\n" % (i_line, i_file))
+        return ''.join(lines)
+
+    def _generate(self):
+        # Build the directory tree, breadth-first
+        directories = ['']
+        level = ['']
+        for i_depth in range(self.shape['depth']):
+            level_next = []
+            for dir_i in level:
+                for i_subdir in range(self.shape['n_subdirs']):
+                    if(i_subdir == 0 and dir_i == ''):
+                        name = 'dir_var_name_var_'
+                    else:
+                        name = 'dir%d_%d' % (i_depth, i_subdir)
+                    level_next.append(os.path.join(dir_i, name))
+            directories.extend(level_next)
+            level = level_next
+        self.update_dir = directories[2] if len(directories) > 2 else ''
+
+        # Distribute the files over the tree
+        n_var = self.shape['n_var_files']
+        n_dirlist = self.shape['n_dirlist']
+        for i_file in range(self.shape['n_files']):
+            dir_i = directories[i_file % len(directories)]
+            if(i_file < n_dirlist):
+                name = 'listing_%d.txt.template' % (i_file)
+                text = "files=%%%_DIRLIST_FILES *.txt%%%\ndirs=%%%_DIRLIST_DIRS%%%\n"
+            elif(i_file < n_dirlist + n_var):
+                name = '_var_name_var__%d.txt.template' % (i_file)
+                text = self._text(i_file)
+            elif(i_file % 2 == 0):
+                name = 'file_%d.txt.template' % (i_file)
+                text = self._text(i_file)
+            else:
+                name = 'file_%d.txt' % (i_file)
+                text = self._text(i_file)
+            self._write(os.path.join(self.dir_template, dir_i, name), text)
+
+        # Add the symlinked sub-templates
+        for i_link in range(self.shape['n_links']):
+            dir_support_i = os.path.join(self.dir_support, 'support_%d' % (i_link))
+            for i_file in range(self.shape['n_link_files']):
+                self._write(os.path.join(dir_support_i, 'support_%d.txt' % (i_file)), self._text(i_file))
+            os.symlink(os.path.relpath(dir_support_i, self.dir_template),
+                       os.path.join(self.dir_template, 'linked_%d' % (i_link)))
+
+    def n_files(self):
+        """Return the total number of files in the template (including those
+        of its symlinked sub-templates).
+
+        :return: Integer
+        """
+        return self.shape['n_files'] + self.shape['n_links'] * self.shape['n_link_files']
+
+
+class benchmark(object):
+    """This class runs the benchmark suite on a synthetic template.
+
+    :param shape: Name of a preset shape (see the `shapes` dictionary)
+    :param path: Working directory (default: a temporary directory, removed afterwards)
+    :param jobs: Number of workers to use for installs
+    :param shape_overrides: Values to override in the preset shape
+    """
+
+    #: Version of the results format
+    version = 1
+
+    def __init__(self, shape='small', path=None, jobs=1, **shape_overrides):
+        if(shape not in shapes):
+            raise ValueError("Invalid benchmark shape {%s}; valid shapes are: %s." % (shape, ', '.join(shapes)))
+        self.shape_name = shape
+        self.shape = dict(shapes[shape])
+        self.shape.update(shape_overrides)
+        self.path = path
+        self.jobs = jobs
+        self.results = []
+
+    def _measure(self, step, n_files, function):
+        time_start = time.perf_counter()
+        result = function()
+        wall_time = time.perf_counter() - time_start
+        self.results.append({
+            'step': step,
+            'wall_time': wall_time,
+            'peak_rss': peak_rss(),
+            'n_files': n_files,
+            'files_per_sec': n_files / wall_time if wall_time > 0 else None})
+        return result
+
+    def run(self):
+        """Run the benchmark suite.  Template scans are cached in, and
+        installs are made to, the working directory.  The package log is
+        silenced while the steps are run.
+
+        :return: List of results (one dictionary per step)
+        """
+        path = self.path
+        if(path is None):
+            path = tempfile.mkdtemp(prefix='gbpBuild_benchmark_')
+        environ_saved = {key: os.environ.get(key) for key in ('GBPTEMPLATE_CACHE_PATH', 'GBPTEMPLATE_CONFIG_PATH')}
+        log_saved = pkg.log
+        fp_null = open(os.devnull, 'w')
+        try:
+            os.environ['GBPTEMPLATE_CACHE_PATH'] = os.path.join(path, 'cache')
+            os.environ['GBPTEMPLATE_CONFIG_PATH'] = os.path.join(path, 'no_config.json')
+            pkg.log = log_saved.__class__(fp_out=fp_null)
+            self.results = []
+            self._run(path)
+        finally:
+            pkg.log = log_saved
+            fp_null.close()
+            for key, value in environ_saved.items():
+                if(value is None):
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            if(self.path is None):
+                shutil.rmtree(path, ignore_errors=True)
+        return self.results
+
+    def _run(self, path):
+        synthetic = synthetic_template(os.path.join(path, 'input'), **self.shape)
+        dir_out = os.path.join(path, 'output')
+        os.makedirs(dir_out)
+        n_files = synthetic.n_files()
+
+        def load():
+            template = tmp.template()
+            template.add(synthetic.name, path=[synthetic.dir_templates])
+            template.params.update(synthetic.params)
+            return template
+
+        self._measure('add_cold', n_files, load)
+        template = self._measure('add_warm', n_files, load)
+
+        self._measure('install_silent', n_files, lambda: template.install(dir_out, silent=True, jobs=self.jobs))
+        self._measure('install', n_files, lambda: template.install(dir_out, jobs=self.jobs))
+        self._measure('install_force', n_files, lambda: template.install(dir_out, force=True, jobs=self.jobs))
+
+        # Update a single sub-directory, after altering the parameters so that its files are rewritten
+        template.params['author'] = 'Another benchmark'
+        n_files_update = sum(1 for dir_i in template.directories for file_i in dir_i.files
+                             if template.update_element(file_i, synthetic.update_dir))
+        self._measure('install_update', n_files_update,
+                      lambda: template.install(dir_out, update=synthetic.update_dir, force=True, jobs=self.jobs))
+
+        self._measure('uninstall', n_files, lambda: template.uninstall(dir_out))
+
+    def to_record(self):
+        """Return the benchmark's description and results.
+
+        :return: Dictionary
+        """
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=package_root_dir,
+                                             stderr=subprocess.DEVNULL).decode('ascii').strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'version': self.version,
+            'shape_name': self.shape_name,
+            'shape': self.shape,
+            'jobs': self.jobs,
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': self.results}
+
+    def write(self, fp=sys.stdout):
+        """Write the benchmark results, as JSON.
+
+        :param fp: Optional file pointer (defaults to sys.stdout)
+        :return: None
+        """
+        json.dump(self.to_record(), fp, indent=2)
+        fp.write('\n')
@@ -18,6 +18,7 @@ sys.path.insert(0, package_parent_dir)
 pkg = importlib.import_module(package_name)
 prj = importlib.import_module(package_name + '._internal.project')
 docs = importlib.import_module(package_name + '._internal.docs')
+bench = importlib.import_module(package_name + '.benchmarks')
 
 # Import package submodules
 pkg.import_submodules()
@@ -115,6 +116,40 @@ def timing(ctx, n_avg, n_burn):
     timing.write()
 
 
+@gbpBuild_helper.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--shape', type=click.Choice(sorted(bench.shapes)), default='small', show_default=True,
+              help='Preset shape of the synthetic template')
+@click.option('--n-files', 'n_files', type=int, default=None, help='Number of files in the template')
+@click.option('--depth', type=int, default=None, help='Depth of the template\'s directory tree')
+@click.option('--n-links', 'n_links', type=int, default=None, help='Number of symlinked sub-templates')
+@click.option('--list-length', 'list_length', type=int, default=None, help='Length of the list-valued parameter')
+@click.option('-j', '--jobs', 'jobs', type=int, default=1, show_default=True, help='Number of workers for installs')
+@click.option('-o', '--output', 'output', type=click.Path(), default=None, help='File to write results to (JSON)')
+@click.option('--keep', 'path', type=click.Path(), default=None,
+              help='Working directory to use (and keep), in place of a temporary one')
+@click.pass_context
+def benchmark(ctx, shape, n_files, depth, n_links, list_length, jobs, output, path):
+    """Benchmark the template engine on a synthetic template."""
+
+    shape_overrides = {}
+    for key, value in (('n_files', n_files), ('depth', depth), ('n_links', n_links), ('list_length', list_length)):
+        if(value is not None):
+            shape_overrides[key] = value
+
+    pkg.log.open("Running template benchmarks (shape=%s)..." % (shape))
+    results = bench.benchmark(shape=shape, path=path, jobs=jobs, **shape_overrides)
+    for result in results.run():
+        pkg.log.comment("%-16s %8.3fs %10.1f files/s" % (result['step'], result['wall_time'], result['files_per_sec']))
+    pkg.log.close("Done.")
+
+    # Write results
+    if(output is None):
+        results.write()
+    else:
+        with open(output, 'w') as fp_out:
+            results.write(fp_out)
+
+
 # Permit script execution
 if __name__ == '__main__':
     status = gbpBuild_helper()
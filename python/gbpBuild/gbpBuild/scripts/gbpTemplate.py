@@ -2,6 +2,7 @@
 import os
 import importlib
 import sys
+import json
 
 import click
 
@@ -24,13 +25,69 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('-s', 'flag_silent', help='Silent/test run', default=False, is_flag=True)
 @click.option('-f', 'flag_force', help='Force write for existing files', default=False, is_flag=True)
 @click.option('-u', 'update_element', help='Update single element only', type=str, default=None)
-def gbpTemplate(template_name, output_dir, template_path, flag_uninstall, flag_silent, flag_force, update_element):
+@click.option('-j', '--jobs', 'jobs', type=int, default=None,
+              help='Number of parallel workers for installs (default: 1, or one per CPU with --targets-file)')
+@click.option('--copy-mode', 'copy_mode', help='How non-template files are copied', type=click.Choice(tmp.copy_modes),
+              default='copy', show_default=True)
+@click.option('--no-cache', 'flag_no_cache', help='Do not use cached template scans', default=False, is_flag=True)
+@click.option('--render-cache', 'flag_render_cache', default=False, is_flag=True,
+              help='Reuse rendered files from (and add them to) the cache of renders in the user\'s cache directory')
+@click.option('--cache-stats', 'flag_cache_stats', default=False, is_flag=True,
+              help='Report the statistics of the cache of rendered files and exit')
+@click.option('--walk-jobs', 'walk_jobs', type=int, default=1, show_default=True,
+              help='Number of threads listing template directories (more help on network filesystems)')
+@click.option('--save-plan', 'plan_file', help='Write the plan of the install to a file instead of performing it',
+              type=str, default=None)
+@click.option('--targets-file', 'targets_file', type=str, default=None,
+              help='JSON file listing [output_dir, params] pairs to install to (in place of OUTPUT_DIR)')
+@click.option('--watch', 'flag_watch', default=False, is_flag=True,
+              help='After installing, watch the template and re-render the files affected by each change')
+@click.option('--diff', 'flag_diff', default=False, is_flag=True,
+              help='Compare what an install would write to the files already installed, without writing anything')
+@click.option('--render', 'render_element', type=str, default=None,
+              help='Render a single file to stdout; given as TEMPLATE/PATH (or PATH, if TEMPLATE_NAME is given), '
+                   'with OUTPUT_DIR defaulting to the current directory')
+def gbpTemplate(template_name, output_dir, template_path, flag_uninstall, flag_silent, flag_force, update_element, jobs,
+                copy_mode, flag_no_cache, flag_render_cache, flag_cache_stats, walk_jobs, plan_file, targets_file,
+                flag_watch, flag_diff, render_element):
+
+    # Report on the render cache, if asked to
+    if(flag_cache_stats):
+        stats = tmp.template_render_cache().stats()
+        bld.log.open("Render cache {%s}:" % (tmp.cache_path('renders')))
+        bld.log.comment("renders =%d" % (stats['renders']))
+        bld.log.comment("size    =%.2f MB (of %.0f MB)" % (stats['size'] / 1e6, stats['size_max'] / 1e6))
+        n_lookups = stats['hits'] + stats['misses']
+        bld.log.comment("hits    =%d of %d (%.0f%%)" % (stats['hits'], n_lookups,
+                                                       100. * stats['hits'] / n_lookups if n_lookups else 0.))
+        bld.log.comment("stored  =%d" % (stats['stored']))
+        bld.log.close()
+        return
+
+    # Render a single file, if asked to
+    if(render_element is not None):
+        render(template_name, output_dir, render_element, template_path)
+        return
+
+    # Install to many targets, if asked to
+    if(targets_file is not None):
+        install_targets(template_name, targets_file, template_path, flag_silent, flag_force, update_element, jobs,
+                        copy_mode, flag_no_cache, flag_render_cache, walk_jobs)
+        return
 
     # Initialize a dictionary to hold all template paramters
     params = {}
 
     # ======== Start processing of CMDL ========
 
+    # Watching only makes sense for real installs of the whole template
+    if(flag_watch and (flag_uninstall or flag_silent or update_element is not None or plan_file is not None)):
+        bld.log.error("--watch can not be used with -r, -s, -u or --save-plan.")
+
+    # Comparisons do not write anything
+    if(flag_diff and (flag_uninstall or flag_watch or plan_file is not None)):
+        bld.log.error("--diff can not be used with -r, --watch or --save-plan.")
+
     # Validate output directory
     if(not os.path.isdir(output_dir)):
         bld.log.error("Given project directory (%s) is not a valid directory." % (output_dir))
@@ -52,13 +109,30 @@ def gbpTemplate(template_name, output_dir, template_path, flag_uninstall, flag_s
 
     # ========= End processing of CMDL =========
 
-    # Load the template(s)
+    # Whole templates are uninstalled from the record of their install, if there is one, without loading them
+    if(flag_uninstall and update_element is None and plan_file is None):
+        if(tmp.uninstall_recorded(output_dir_abs, templates=template_list, silent=flag_silent, jobs=jobs or 1)):
+            bld.log.close("Done")
+            return
+
+    # Load the template(s); only the parts leading to the element are needed for updates of a single element
     template = tmp.template()
     for template_name in template_list:
-        template.add(template_name, path=[template_path, bld.full_path_datafile('templates')])
+        template.add(template_name, path=[template_path, bld.full_path_datafile('templates')],
+                     use_cache=not flag_no_cache, walk_jobs=walk_jobs, element=update_element)
 
     # Process the template
-    if(flag_uninstall):
+    if(flag_diff):
+        template.validate_parameters(interactive=True)
+        template.diff(output_dir_abs, params_raw=params, update=update_element)
+    elif(plan_file is not None):
+        if(not flag_uninstall):
+            template.validate_parameters(interactive=True)
+        plan = template.plan(output_dir_abs, params_raw=params, uninstall=flag_uninstall, update=update_element,
+                             force=flag_force, copy_mode=copy_mode)
+        plan.write(plan_file)
+        bld.log.comment("Plan of %d operation(s) written to {%s}." % (plan.n_operations(), plan_file))
+    elif(flag_uninstall):
         template.uninstall(output_dir_abs, params_raw=params, silent=flag_silent, update=update_element)
     else:
 
@@ -66,11 +140,91 @@ def gbpTemplate(template_name, output_dir, template_path, flag_uninstall, flag_s
         template.validate_parameters(interactive=True)
 
         # Install template
-        template.install(output_dir_abs, params_raw=params, silent=flag_silent, update=update_element, force=flag_force)
+        template.install(
+            output_dir_abs,
+            params_raw=params,
+            silent=flag_silent,
+            update=update_element,
+            force=flag_force,
+            jobs=jobs or 1,
+            copy_mode=copy_mode,
+            use_render_cache=flag_render_cache)
+
+        # Keep the install up to date with changes to the template
+        if(flag_watch):
+            template.watch(output_dir_abs, jobs=jobs or 1, copy_mode=copy_mode)
 
     bld.log.close("Done")
 
 
+def render(template_name, output_dir, render_element, template_path):
+    """Render a single template file to stdout.  Only the parts of the
+    template(s) leading to the file are loaded.
+
+    :param template_name: Comma-separated list of templates (None to take it from render_element)
+    :param output_dir: Directory the file is rendered for (None for the current directory)
+    :param render_element: Template path (input or output) of the file, prefixed by the template name if
+        template_name is None
+    :return: None
+    """
+    if(template_name is None):
+        template_name, _, render_element = render_element.partition('/')
+    if(output_dir is None):
+        output_dir = '.'
+    if(not os.path.isdir(output_dir)):
+        bld.log.error("Given project directory (%s) is not a valid directory." % (output_dir))
+    output_dir_abs = os.path.abspath(output_dir)
+
+    bld.log.open("Rendering {%s}..." % (render_element))
+    template = tmp.template()
+    for template_name_i in template_name.split(','):
+        template.add(template_name_i, path=[template_path, bld.full_path_datafile('templates')],
+                     element=render_element)
+    template.validate_parameters(interactive=True)
+    content = template.render_element(output_dir_abs, render_element)
+    if(content is None):
+        bld.log.error("{%s} is not a file of template(s) {%s}." % (render_element, template_name))
+    sys.stdout.flush()
+    sys.stdout.buffer.write(content)
+    sys.stdout.flush()
+    bld.log.close("Done")
+
+
+def install_targets(template_name, targets_file, template_path, flag_silent, flag_force, update_element, jobs,
+                    copy_mode, flag_no_cache, flag_render_cache=False, walk_jobs=1):
+    """Install templates to every target listed in a file.
+
+    :param template_name: Comma-separated list of templates
+    :param targets_file: JSON file holding a list of [output_dir, params] pairs
+    :return: None
+    """
+    with open(targets_file) as fp_in:
+        targets_raw = json.load(fp_in)
+
+    # Validate the targets, inferring project names from the output directories where needed
+    targets = []
+    for target_i in targets_raw:
+        output_dir, params = target_i
+        if(not os.path.isdir(output_dir)):
+            bld.log.error("Given project directory (%s) is not a valid directory." % (output_dir))
+        output_dir_abs = os.path.abspath(output_dir)
+        params = dict(params)
+        params.setdefault('name', tmp.get_base_name(output_dir_abs).replace("-", "_"))
+        targets.append((output_dir_abs, params))
+
+    # Load the template(s) once
+    template = tmp.template()
+    for template_name_i in template_name.split(','):
+        template.add(template_name_i, path=[template_path, bld.full_path_datafile('templates')],
+                     use_cache=not flag_no_cache, walk_jobs=walk_jobs)
+
+    # Install to all targets
+    results = template.install_many(targets, silent=flag_silent, update=update_element, force=flag_force, jobs=jobs,
+                                    copy_mode=copy_mode, use_render_cache=flag_render_cache)
+    if([result for result in results if result['error'] is not None]):
+        sys.exit(1)
+
+
 # Permit script execution
 if __name__ == '__main__':
     status = gbpTemplate()
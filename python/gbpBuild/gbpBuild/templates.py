@@ -1,11 +1,28 @@
-import filecmp
 import os
 import importlib
 import sys
 import re
 import shutil
+import copy
 import fnmatch
 import json
+import hashlib
+import errno
+import mmap
+import locale
+import concurrent.futures
+import base64
+import io
+import time
+import multiprocessing
+import ctypes
+import ctypes.util
+import select
+import struct
+import stat
+import threading
+import zipfile
+import tarfile
 
 from datetime import datetime
 
@@ -26,6 +43,27 @@ import gbpBuild
 
 _regex_parameter_selector = "[^%/]*"
 
+# Compiled parameter-reference regular expressions, keyed by delimiter
+_regex_parameter_references = {}
+
+#: Supported modes for copying non-template files (see copy_file())
+copy_modes = ('copy', 'reflink', 'hardlink')
+
+# Size of the buffers used when copying and rendering files
+_io_buffer_size = 1 << 20
+
+# Linux ioctl request for cloning a file's extents (FICLONE)
+_ioctl_ficlone = 0x40049409
+
+#: Extensions of the archives that templates can be loaded from (see template_archive)
+archive_extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Names of files (editor swap and backup files) ignored when watching templates for changes
+_watch_ignore = ('*.swp', '*.swx', '*~', '.#*', '#*#', '4913')
+
+# Lock serialising updates to the active template_counters (see _count())
+_counters_lock = threading.Lock()
+
 # Helper functions
 # ----------------
 
@@ -73,6 +111,286 @@ def get_base_name(project_dir_abs):
     return (tail)
 
 
+def parameter_reference_regex(delimiter="%%%", multiline=False):
+    """Return the compiled regular expression matching parameter references
+    delimited by the given string.  Expressions are compiled only once per
+    delimiter.
+
+    :param delimiter: Delimiter marking the start and end of a reference
+    :param multiline: Bool indicating that the expression will be applied to text spanning several lines,
+        in which case references are not permitted to span line breaks
+    :return: Compiled regular expression
+    """
+    regex = _regex_parameter_references.get((delimiter, multiline))
+    if(regex is None):
+        selector = _regex_parameter_selector
+        if(multiline):
+            selector = selector.replace("]", "\\n]", 1)
+        regex = re.compile("%s%s%s" % (re.escape(delimiter), selector, re.escape(delimiter)))
+        _regex_parameter_references[(delimiter, multiline)] = regex
+    return regex
+
+
+def compile_template_text(text, delimiter="%%%"):
+    """Parse the full text of a template into a list of template_line
+    objects with a single scan for parameter references.  Lines holding
+    references each get their own template_line, while runs of lines without
+    any are merged into single literal blocks.
+
+    :param text: String holding the text to parse
+    :param delimiter: Delimiter marking the start and end of a reference
+    :return: List of template_line objects
+    """
+    lines = []
+    n_delimiter = len(delimiter)
+    i_text = 0
+    line = None
+    i_line_end = -1
+    i_last = 0
+    for match in parameter_reference_regex(delimiter, multiline=True).finditer(text):
+        directive = text[match.start() + n_delimiter:match.end() - n_delimiter]
+
+        # Further references on the line being assembled
+        if(line is not None and match.start() < i_line_end):
+            line.literals.append(text[i_last:match.start()])
+            line.directives.append(directive)
+            i_last = match.end()
+            continue
+
+        # Finish the last line holding references
+        if(line is not None):
+            line.literals.append(text[i_last:i_line_end])
+            lines.append(line)
+            i_text = i_line_end
+
+        # Everything between that line and this one is literal
+        i_line_start = text.rfind('\n', i_text, match.start()) + 1
+        if(i_line_start == 0):
+            i_line_start = i_text
+        if(i_line_start > i_text):
+            lines.append(template_line.literal(text[i_text:i_line_start], delimiter=delimiter))
+
+        # Start a new line
+        i_line_end = text.find('\n', match.end())
+        i_line_end = len(text) if i_line_end < 0 else i_line_end + 1
+        line = template_line.literal(text[i_line_start:match.start()], delimiter=delimiter)
+        line.directives.append(directive)
+        i_last = match.end()
+
+    if(line is not None):
+        line.literals.append(text[i_last:i_line_end])
+        lines.append(line)
+        i_text = i_line_end
+    if(i_text < len(text)):
+        lines.append(template_line.literal(text[i_text:], delimiter=delimiter))
+    return lines
+
+
+def _count(name, n=1):
+    """Add to one of the active counters of I/O and work (see
+    template_counters), if there are any.
+
+    :param name: Name of the counter
+    :param n: Amount to add
+    :return: None
+    """
+    counters = template_counters._active
+    if(counters is not None):
+        with _counters_lock:
+            counters[name] += n
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Compute the SHA-256 digest of a file's contents.
+
+    :param path: Path to the file
+    :param chunk_size: Number of bytes to read at a time
+    :return: Hexadecimal digest string
+    """
+    digest = hashlib.sha256()
+    n_read = 0
+    with open(path, 'rb') as fp_in:
+        for chunk in iter(lambda: fp_in.read(chunk_size), b''):
+            digest.update(chunk)
+            n_read += len(chunk)
+    _count('bytes_read', n_read)
+    return digest.hexdigest()
+
+
+def file_matches(path, content=None, path_in=None, chunk_size=_io_buffer_size):
+    """Check if a file holds the given content (or the same content as
+    another file).  Sizes are compared first; the contents are then compared
+    a chunk at a time, stopping at the first difference.
+
+    :param path: Path to the file
+    :param content: Content to compare to, as bytes
+    :param path_in: Path to the file to compare to (if content is not given)
+    :param chunk_size: Number of bytes to compare at a time
+    :return: Bool
+    """
+    size = len(content) if content is not None else os.stat(path_in).st_size
+    _count('stat_calls', 1 if content is not None else 2)
+    if(os.stat(path).st_size != size):
+        return False
+    with open(path, 'rb') as fp_out:
+        if(content is not None):
+            content = memoryview(content)
+            for i_chunk in range(0, size, chunk_size):
+                _count('bytes_read', min(chunk_size, size - i_chunk))
+                if(fp_out.read(chunk_size) != content[i_chunk:i_chunk + chunk_size]):
+                    return False
+            return True
+        with open(path_in, 'rb') as fp_in:
+            while(True):
+                chunk = fp_in.read(chunk_size)
+                _count('bytes_read', 2 * len(chunk))
+                if(chunk != fp_out.read(chunk_size)):
+                    return False
+                if(not chunk):
+                    return True
+
+
+def _copy_file_data(fp_in, fp_out):
+    """Copy the contents of one open file to another, keeping the data in the
+    kernel if possible.  os.copy_file_range() is tried first (this permits
+    server-side copies on some network filesystems), then os.sendfile(), and
+    finally a buffered copy.
+
+    :param fp_in: File object open for binary reading
+    :param fp_out: File object open for binary writing
+    :return: Number of bytes copied
+    """
+    fd_in = fp_in.fileno()
+    fd_out = fp_out.fileno()
+    n_total = 0
+    for name in ('copy_file_range', 'sendfile'):
+        copy_function = getattr(os, name, None)
+        if(copy_function is None):
+            continue
+        try:
+            while(True):
+                if(name == 'copy_file_range'):
+                    n_copied = copy_function(fd_in, fd_out, _io_buffer_size)
+                else:
+                    n_copied = copy_function(fd_out, fd_in, None, _io_buffer_size)
+                if(n_copied == 0):
+                    return n_total
+                n_total += n_copied
+        except OSError as error:
+            # Only fall back if nothing has been copied yet and
+            # the call is not supported for these files
+            if(error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF) or
+               os.lseek(fd_out, 0, os.SEEK_CUR) != 0):
+                raise
+    shutil.copyfileobj(fp_in, fp_out, _io_buffer_size)
+    return fp_out.tell()
+
+
+def copy_file(path_in, path_out, mode='copy'):
+    """Copy a file, along with its permissions and times (as for
+    shutil.copy2).
+
+    The mode can be one of:
+
+    * 'copy': copy the contents, in the kernel where possible
+    * 'reflink': share the contents copy-on-write (where the filesystem
+      supports it), falling back to a copy
+    * 'hardlink': hard link the output to the input, falling back to a copy
+      (only appropriate for files which will not be edited)
+
+    :param path_in: Path to the input file
+    :param path_out: Path to the output file
+    :param mode: Copy mode
+    :return: None
+    """
+    if(mode not in copy_modes):
+        raise ValueError("Invalid copy mode {%s}; must be one of %s." % (mode, copy_modes))
+    _count('files_copied')
+    if(mode == 'hardlink'):
+        try:
+            os.link(path_in, path_out)
+            return
+        except OSError:
+            pass
+    with open(path_in, 'rb') as fp_in:
+        with open(path_out, 'wb') as fp_out:
+            flag_cloned = False
+            if(mode == 'reflink'):
+                try:
+                    import fcntl
+                    fcntl.ioctl(fp_out.fileno(), _ioctl_ficlone, fp_in.fileno())
+                    flag_cloned = True
+                except (ImportError, OSError):
+                    pass
+            if(not flag_cloned):
+                n_copied = _copy_file_data(fp_in, fp_out)
+                _count('bytes_read', n_copied)
+                _count('bytes_written', n_copied)
+    shutil.copystat(path_in, path_out)
+    _count('stat_calls')
+
+
+def cache_path(*subdirs):
+    """Return the path to the directory where template caches are kept.
+    This is given by the GBPTEMPLATE_CACHE_PATH environment variable if set,
+    and is '$XDG_CACHE_HOME/gbpTemplate' (default: '~/.cache/gbpTemplate')
+    otherwise.
+
+    :param subdirs: Optional sub-directories of the cache directory
+    :return: Path
+    """
+    path = os.environ.get('GBPTEMPLATE_CACHE_PATH')
+    if(path is None):
+        path_xdg = os.environ.get('XDG_CACHE_HOME')
+        if(not path_xdg):
+            path_xdg = os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(path_xdg, 'gbpTemplate')
+    return os.path.join(path, *subdirs)
+
+
+def stat_signature(path):
+    """Return a signature of the state of a file or directory, which changes
+    when it is altered.
+
+    :param path: Path
+    :return: List of modification time, size and inode number
+    """
+    stat = os.stat(path)
+    _count('stat_calls')
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def get_archive_name(path):
+    """Return the name of a template held in an archive: the archive's file
+    name, without its extension.
+
+    :param path: Path to the archive
+    :return: String
+    """
+    name = os.path.basename(path)
+    for extension in archive_extensions:
+        if(name.endswith(extension)):
+            return name[:-len(extension)]
+    return name
+
+
+def find_archive(path):
+    """Find an archive holding a template, given its path either with or
+    without an archive extension.
+
+    :param path: Path to the archive
+    :return: Path to the archive (None if there is none)
+    """
+    if(path.endswith(archive_extensions)):
+        _count('stat_calls')
+        return path if os.path.isfile(path) else None
+    for extension in archive_extensions:
+        _count('stat_calls')
+        if(os.path.isfile(path + extension)):
+            return path + extension
+    return None
+
+
 def format_template_names(name_list):
     """Create a comma-separated list of template names.
 
@@ -91,6 +409,729 @@ def format_template_names(name_list):
 # -------------------
 
 
+class template_counters(dict):
+    """This class holds counts of the I/O and work done by a template add,
+    install or uninstall (see template.counters), keyed by the names in
+    template_counters.names.  Counting is done while a set of counters is
+    active; use it as a context manager to make it so.
+
+    Only the template's files, the installed files and the cache of rendered
+    files are counted; reads and writes of the install manifest, scan cache
+    and journal are not.
+    """
+
+    #: Names of the counters, in the order they are reported
+    names = ('stat_calls', 'listings', 'bytes_read', 'bytes_written', 'files_rendered', 'files_copied',
+             'symlinks_created', 'substitutions', 'directive_resolutions')
+
+    # Descriptions of the counters, used by __str__()
+    _descriptions = ('stat calls', 'directory listings', 'bytes read', 'bytes written', 'files rendered',
+                     'files copied', 'symlinks created', 'substitutions', 'directive resolutions')
+
+    # The counters being added to (see _count())
+    _active = None
+
+    def __init__(self):
+        super(template_counters, self).__init__((name, 0) for name in self.names)
+        self._saved = []
+
+    def __enter__(self):
+        self._saved.append(template_counters._active)
+        template_counters._active = self
+        return self
+
+    def __exit__(self, *args):
+        template_counters._active = self._saved.pop()
+
+    def add(self, counters):
+        """Add the counts of another set of counters to these.
+
+        :param counters: Dictionary of counts
+        :return: None
+        """
+        for name in self.names:
+            self[name] += counters.get(name, 0)
+
+    def __str__(self):
+        return ', '.join("%d %s" % (self[name], description) for name, description in
+                         zip(self.names, self._descriptions))
+
+
+class template_line(object):
+    """This class holds a string (generally a line of a template file or an
+    element name) which has been parsed into a sequence of literal text
+    segments and the parameter references/directives which separate them.
+    Parsing is done once, so that rendering is a single pass over the segments.
+
+    :param line: String to parse
+    :param delimiter: Delimiter marking the start and end of a reference
+    """
+
+    def __init__(self, line, delimiter="%%%"):
+        if(delimiter is None):
+            delimiter = "%%%"
+        self.delimiter = delimiter
+
+        # There is always one more literal than there are directives
+        self.literals = []
+        self.directives = []
+        n_delimiter = len(delimiter)
+        i_start = 0
+        for match in parameter_reference_regex(delimiter).finditer(line):
+            self.literals.append(line[i_start:match.start()])
+            self.directives.append(line[match.start() + n_delimiter:match.end() - n_delimiter])
+            i_start = match.end()
+        self.literals.append(line[i_start:])
+
+    @classmethod
+    def literal(cls, text, delimiter="%%%"):
+        """Create a line holding the given text verbatim, without parsing it
+        for parameter references.
+
+        :param text: String
+        :param delimiter: Delimiter (only used by __str__)
+        :return: template_line
+        """
+        line = cls('', delimiter=delimiter)
+        line.literals = [text]
+        return line
+
+    def to_record(self):
+        """Return a (JSON-serialisable) record of the parsed line.
+
+        :return: list
+        """
+        return [self.literals, self.directives]
+
+    @classmethod
+    def from_record(cls, record, delimiter="%%%"):
+        """Recreate a parsed line from a record generated by to_record().
+
+        :param record: list
+        :param delimiter: Delimiter marking the start and end of a reference
+        :return: template_line
+        """
+        line = cls('', delimiter=delimiter)
+        line.literals, line.directives = record
+        return line
+
+    def is_literal(self):
+        """Check if this line has no parameter references.
+
+        :return: Bool
+        """
+        return len(self.directives) == 0
+
+    def __str__(self):
+        """Reconstruct the original (unparsed) string.
+
+        :return: string
+        """
+        result = self.literals[0]
+        for directive, literal in zip(self.directives, self.literals[1:]):
+            result += self.delimiter + directive + self.delimiter + literal
+        return result
+
+
+class template_directive(object):
+    """This class holds a parameter reference or directive, parsed once.
+    Directives starting with '_' are protected commands (handled by the
+    objects registered with register_directive()), followed by
+    whitespace-separated arguments.  Anything else refers to a template
+    parameter.
+
+    Use parse_directive() to create these, so that each distinct directive
+    is only parsed once.
+
+    :param text: The text of the directive (without delimiters)
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.is_command = (text[0:1] == '_')
+        if(self.is_command):
+            words = text[1:].split()
+            self.command = words[0] if words else ''
+            self.args = words[1:]
+        else:
+            self.command = None
+            self.args = []
+
+    def __str__(self):
+        return self.text
+
+
+class template_directive_handler(object):
+    """This is the base class for the handlers of protected ('_'-prefixed)
+    template directives.  Derived classes must implement resolve() and
+    should be registered with register_directive().
+    """
+
+    #: Maximum number of arguments the directive accepts
+    n_args_max = 0
+
+    #: Bool indicating if results depend only on the directive, the host directory
+    #: of the element being rendered and the template state, and can be cached accordingly
+    cacheable = True
+
+    #: Bool indicating if results depend on the contents of the output directory
+    #: hosting the element (so that they change when files are added or removed)
+    lists_directory = False
+
+    def check(self, template_in, directive):
+        """Check the syntax of a directive.
+
+        :param template_in: The template being processed
+        :param directive: template_directive
+        :return: True
+        """
+        if(len(directive.args) > self.n_args_max):
+            if(self.n_args_max == 0):
+                gbpBuild.log.error("Syntax error in directive {%s}; no arguments allowed." % (directive))
+            else:
+                gbpBuild.log.error("Syntax error in directive {%s}; too many arguments." % (directive))
+        return True
+
+    def resolve(self, template_in, element, directive):
+        """Resolve a directive for a given template element.
+
+        :param template_in: The template being processed
+        :param element: The template element being rendered
+        :param directive: template_directive
+        :return: List of values to substitute
+        """
+        raise NotImplementedError
+
+
+class _directive_dirname_local(template_directive_handler):
+    """Handler for '_DIRNAME_LOCAL': the output name of the directory hosting the element."""
+
+    def resolve(self, template_in, element, directive):
+        if(element is None):
+            gbpBuild.log.error("No element passed to 'resolve_directive()'.")
+        if(element.dir_host is not None):
+            dir_path_out = template_in.template_path_out(element.dir_host)
+        else:
+            dir_path_out = template_in.dir_install
+        return [os.path.basename(dir_path_out)]
+
+
+class _directive_parameters(template_directive_handler):
+    """Handler for '_PARAMETERS.key' and '_PARAMETERS.value': lists of the
+    names or values of all the template parameters.
+
+    :param values: Bool indicating that values (rather than names) should be listed
+    """
+
+    def __init__(self, values=False):
+        self.values = values
+
+    def resolve(self, template_in, element, directive):
+        if(self.values):
+            return [value for value in template_in.params.values()]
+        else:
+            return [key for key in template_in.params.keys()]
+
+
+class _directive_dirlist(template_directive_handler):
+    """Handler for '_DIRLIST', '_DIRLIST_DIRS' and '_DIRLIST_FILES': sorted
+    lists of the entries of the output directory hosting the element,
+    optionally filtered by a comma-separated list of wildcards (those
+    starting with '!' exclude matches).
+
+    :param list_mode: One of 'all', 'dirs' or 'files'
+    """
+
+    n_args_max = 1
+    lists_directory = True
+
+    def __init__(self, list_mode='all'):
+        self.list_mode = list_mode
+        self._matchers_compiled = {}
+
+    def resolve(self, template_in, element, directive):
+        # Because we can't be sure that all the files are present
+        # either in the full input or output path, the listing is
+        # generated from the elements in the template.  We may also have
+        # some files/directories preexisting this template run, and those
+        # are added as well, so we have listings which actually represent
+        # the current state (see template.directory_listing())
+        files, dirs = template_in.directory_listing(element.dir_host)
+        if(self.list_mode == 'files'):
+            template_element_list = files
+        elif(self.list_mode == 'dirs'):
+            template_element_list = dirs
+        else:
+            template_element_list = sorted(files + dirs)
+
+        if(len(directive.args) == 0):
+            return list(template_element_list)
+
+        # The last matching wildcard determines if an entry is kept
+        matchers = self._matchers(directive.args[0])
+        listing = []
+        for file_i in template_element_list:
+            flag_keep = False
+            name = os.path.normcase(file_i)
+            for match, flag_wildcard in matchers:
+                if(match(name)):
+                    flag_keep = flag_wildcard
+            if(flag_keep):
+                listing.append(file_i)
+        return listing
+
+    def _matchers(self, wildcards):
+        """Compile a comma-separated list of wildcards.  Each distinct list is
+        only compiled once.
+
+        :param wildcards: String
+        :return: List of tuples of match functions and flags (False for negated wildcards)
+        """
+        matchers = self._matchers_compiled.get(wildcards)
+        if(matchers is None):
+            matchers = []
+            for wildcard in wildcards.split(','):
+                # If wildcard is prepended with '!', treat it as a negation search
+                if(wildcard[0:1] == '!'):
+                    wildcard = wildcard[1:]
+                    flag_wildcard = False
+                else:
+                    flag_wildcard = True
+                matchers.append((re.compile(fnmatch.translate(os.path.normcase(wildcard))).match, flag_wildcard))
+            self._matchers_compiled[wildcards] = matchers
+        return matchers
+
+
+#: Handlers of protected template directives, keyed by command name (see register_directive())
+directive_handlers = {}
+
+# Parsed directives, keyed by their text (see parse_directive())
+_directives_parsed = {}
+
+
+def register_directive(command, handler):
+    """Register a handler for a protected template directive.  Once
+    registered, '%%%_<command> [args]%%%' references in templates (and
+    '_var__<command>_var_' in names) are resolved by the handler.
+
+    :param command: Name of the command (without the leading '_')
+    :param handler: template_directive_handler instance
+    :return: None
+    """
+    if(not isinstance(handler, template_directive_handler)):
+        raise TypeError("Handlers for directive {%s} must be template_directive_handler instances." % (command))
+    directive_handlers[command] = handler
+
+
+def parse_directive(text):
+    """Return the parsed form of a directive.  Each distinct directive is
+    only parsed once.
+
+    :param text: The text of the directive (without delimiters)
+    :return: template_directive
+    """
+    directive = _directives_parsed.get(text)
+    if(directive is None):
+        directive = template_directive(text)
+        _directives_parsed[text] = directive
+    return directive
+
+
+register_directive('DIRNAME_LOCAL', _directive_dirname_local())
+register_directive('PARAMETERS.key', _directive_parameters(values=False))
+register_directive('PARAMETERS.value', _directive_parameters(values=True))
+register_directive('DIRLIST', _directive_dirlist('all'))
+register_directive('DIRLIST_DIRS', _directive_dirlist('dirs'))
+register_directive('DIRLIST_FILES', _directive_dirlist('files'))
+
+
+class _local_files(object):
+    """Access to template files on the local filesystem, with the same
+    interface as template_archive."""
+
+    scandir = staticmethod(os.scandir)
+    islink = staticmethod(os.path.islink)
+    isdir = staticmethod(os.path.isdir)
+    isfile = staticmethod(os.path.isfile)
+    readlink = staticmethod(os.readlink)
+    realpath = staticmethod(os.path.realpath)
+
+    @staticmethod
+    def identity(path, entry=None, parent=None):
+        """Return a value identifying a directory, however it is reached.
+        Sub-directories listed by scandir() are identified from their
+        directory entries (on their parent's device), without a stat().
+
+        :param path: Path of the directory
+        :param entry: Optional template_entry of the directory (which must not be a symlink)
+        :param parent: Identity of the directory's parent (needed with entry)
+        :return: Tuple of device and inode numbers
+        """
+        if(entry is not None):
+            return (parent[0], entry.inode)
+        _count('stat_calls')
+        stat_dir = os.stat(path)
+        return (stat_dir.st_dev, stat_dir.st_ino)
+
+
+class template_archive(object):
+    """This class provides read access to a template held in a zip or tar
+    archive.  Members are indexed from the archive's directory once, and are
+    addressed by 'virtual' paths: the path of the archive joined with the
+    member's path.  Symlinks between members are followed; members can not
+    link outside the archive.
+
+    If all the members are in one top-level directory, named after the
+    archive (without its extension), the template is rooted there.
+
+    :param path: Path to the archive
+    """
+
+    # Maximum number of symlinks followed when resolving a path
+    _n_links_max = 40
+
+    def __init__(self, path):
+        self.path = os.path.normpath(os.path.abspath(path))
+        self.is_zip = zipfile.is_zipfile(self.path)
+        if(not self.is_zip and not tarfile.is_tarfile(self.path)):
+            raise ValueError("File {%s} is not a zip or tar archive." % (self.path))
+        self._lock = threading.Lock()
+        self._handle = None
+        self._handle_pid = None
+
+        # Index the members: kinds ('file', 'dir' or 'symlink'), link targets and archive records
+        self._kinds = {'': 'dir'}
+        self._targets = {}
+        self._infos = {}
+        self._children = {'': []}
+        handle = self._open()
+        if(self.is_zip):
+            for info in handle.infolist():
+                mode = info.external_attr >> 16
+                if(info.is_dir()):
+                    self._add_member(info.filename, 'dir', info)
+                elif(stat.S_ISLNK(mode)):
+                    self._add_member(info.filename, 'symlink', info, handle.read(info).decode('utf-8'))
+                else:
+                    self._add_member(info.filename, 'file', info)
+        else:
+            for info in handle.getmembers():
+                if(info.isdir()):
+                    self._add_member(info.name, 'dir', info)
+                elif(info.issym()):
+                    self._add_member(info.name, 'symlink', info, info.linkname)
+                elif(info.isfile() or info.islnk()):
+                    self._add_member(info.name, 'file', info)
+
+        # Find the root of the template
+        name = get_archive_name(self.path)
+        self.root = self.path
+        if(self._children[''] == [name] and self._kinds[name] == 'dir'):
+            self.root = os.path.join(self.path, name)
+
+    def _add_member(self, name, kind, info, target=None):
+        member = os.path.normpath(name.replace('\\', '/')).lstrip('/')
+        if(member in ('', '.')):
+            return
+        # Add any parent directories not explicitly listed in the archive
+        parent = os.path.dirname(member)
+        if(parent not in self._kinds):
+            self._add_member(parent, 'dir', None)
+        if(member not in self._kinds):
+            self._children[parent].append(os.path.basename(member))
+        self._kinds[member] = kind
+        if(kind == 'dir'):
+            self._children.setdefault(member, [])
+        if(info is not None):
+            self._infos[member] = info
+        if(target is not None):
+            self._targets[member] = target
+
+    def _open(self):
+        # Handles are not shared with forked processes, which would share their file offsets
+        if(self._handle is None or self._handle_pid != os.getpid()):
+            if(self.is_zip):
+                self._handle = zipfile.ZipFile(self.path)
+            else:
+                self._handle = tarfile.open(self.path)
+            self._handle_pid = os.getpid()
+        return self._handle
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_handle'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def contains(self, path):
+        """Check if a path is within the archive.
+
+        :param path: Path
+        :return: Bool
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        return path == self.path or path.startswith(self.path + os.sep)
+
+    def _member(self, path):
+        member = os.path.relpath(os.path.normpath(os.path.abspath(path)), self.path)
+        if(member == '.'):
+            return ''
+        if(member.startswith('..')):
+            raise FileNotFoundError("Path {%s} is outside archive {%s}." % (path, self.path))
+        return member.replace(os.sep, '/')
+
+    def _resolve(self, member, follow_last=True):
+        """Resolve the symlinks in the path of a member.
+
+        :param member: Member path
+        :param follow_last: Bool indicating if the last component should be resolved if it is a symlink
+        :return: Member path (None if it does not exist)
+        """
+        resolved = ''
+        components = [component for component in member.split('/') if component]
+        n_links = 0
+        while(components):
+            component = components.pop(0)
+            candidate = component if resolved == '' else resolved + '/' + component
+            kind = self._kinds.get(candidate)
+            if(kind is None):
+                return None
+            if(kind == 'symlink' and (components or follow_last)):
+                n_links += 1
+                if(n_links > self._n_links_max):
+                    raise OSError(errno.ELOOP, "Too many levels of symbolic links in archive", member)
+                target = os.path.normpath(os.path.join(resolved, self._targets[candidate])).replace(os.sep, '/')
+                if(target.startswith('..') or os.path.isabs(target)):
+                    raise FileNotFoundError("Archive member {%s} links outside archive {%s}." % (candidate, self.path))
+                components = [c for c in target.split('/') if c and c != '.'] + components
+                resolved = ''
+            else:
+                resolved = candidate
+        return resolved
+
+    def _kind(self, path, follow=True):
+        try:
+            member = self._resolve(self._member(path), follow_last=follow)
+        except FileNotFoundError:
+            return None
+        if(member is None):
+            return None
+        return self._kinds[member]
+
+    def isdir(self, path):
+        return self._kind(path) == 'dir'
+
+    def isfile(self, path):
+        return self._kind(path) == 'file'
+
+    def islink(self, path):
+        return self._kind(path, follow=False) == 'symlink'
+
+    def readlink(self, path):
+        member = self._resolve(self._member(path), follow_last=False)
+        if(member is None or self._kinds[member] != 'symlink'):
+            raise OSError(errno.EINVAL, "Not a symbolic link", path)
+        return self._targets[member]
+
+    def realpath(self, path):
+        member = self._resolve(self._member(path))
+        if(member is None):
+            raise FileNotFoundError(path)
+        return os.path.join(self.path, member) if member else self.path
+
+    def listdir(self, path):
+        member = self._resolve(self._member(path))
+        if(member is None or self._kinds[member] != 'dir'):
+            raise NotADirectoryError(path)
+        return list(self._children[member])
+
+    def scandir(self, path):
+        """List a directory of the archive, as os.scandir() does.
+
+        :param path: Path of the directory
+        :return: List of template_archive.entry objects
+        """
+        return [template_archive.entry(self, os.path.join(path, name)) for name in self.listdir(path)]
+
+    def identity(self, path, entry=None, parent=None):
+        """Return a value identifying a directory of the archive, however it
+        is reached (see _local_files.identity()).
+
+        :param path: Path of the directory
+        :return: Path of the directory, with symlinks resolved
+        """
+        return self.realpath(path)
+
+    class entry(object):
+        """This class describes a member of an archive listed by
+        template_archive.scandir(), with the interface of os.DirEntry.
+
+        :param archive: template_archive
+        :param path: Path of the member
+        """
+
+        def __init__(self, archive, path):
+            self.archive = archive
+            self.path = path
+            self.name = os.path.basename(path)
+
+        def is_dir(self):
+            return self.archive.isdir(self.path)
+
+        def is_file(self):
+            return self.archive.isfile(self.path)
+
+        def is_symlink(self):
+            return self.archive.islink(self.path)
+
+    def walk(self, top):
+        """Walk a directory of the archive, as os.walk() does (symlinks to
+        directories are listed with the directories, but not descended into).
+
+        :param top: Path of the directory
+        :return: Generator of (path, directory names, file names) tuples
+        """
+        dirs = []
+        files = []
+        for name in self.listdir(top):
+            path = os.path.join(top, name)
+            if(self.isdir(path)):
+                dirs.append(name)
+            else:
+                files.append(name)
+        yield top, dirs, files
+        for name in dirs:
+            path = os.path.join(top, name)
+            if(not self.islink(path)):
+                for result in self.walk(path):
+                    yield result
+
+    def size(self, path):
+        member = self._resolve(self._member(path))
+        info = self._infos[member]
+        return info.file_size if self.is_zip else info.size
+
+    def read(self, path):
+        """Read the contents of a file in the archive.
+
+        :param path: Path of the file
+        :return: Bytes
+        """
+        member = self._resolve(self._member(path))
+        if(member is None or self._kinds[member] != 'file'):
+            raise FileNotFoundError(path)
+        with self._lock:
+            handle = self._open()
+            if(self.is_zip):
+                return handle.read(self._infos[member])
+            with handle.extractfile(self._infos[member]) as fp_in:
+                return fp_in.read()
+
+    def materialize(self, path):
+        """Return a path on the local filesystem holding a copy of a file or
+        directory of the archive, extracting it to the cache the first time
+        this is called.  This is used for elements installed as links.
+
+        :param path: Path of the file or directory
+        :return: Full path of the copy
+        """
+        key = hashlib.sha256(repr((self.path, stat_signature(self.path))).encode('utf-8')).hexdigest()
+        member = self._resolve(self._member(path))
+        path_out = cache_path('archives', key, *member.split('/'))
+        if(not os.path.lexists(path_out)):
+            path_tmp = "%s.%d.tmp" % (path_out, os.getpid())
+            os.makedirs(os.path.dirname(path_out), exist_ok=True)
+            if(self._kinds[member] == 'dir'):
+                for root, dirs, files in self.walk(os.path.join(self.path, member)):
+                    root_out = os.path.join(path_tmp, os.path.relpath(root, os.path.join(self.path, member)))
+                    os.makedirs(root_out, exist_ok=True)
+                    for name in files:
+                        with open(os.path.join(root_out, name), 'wb') as fp_out:
+                            fp_out.write(self.read(os.path.join(root, name)))
+                    for name in dirs:
+                        if(self.islink(os.path.join(root, name))):
+                            shutil.copytree(self.materialize(os.path.join(root, name)), os.path.join(root_out, name))
+            else:
+                with open(path_tmp, 'wb') as fp_out:
+                    fp_out.write(self.read(path))
+            try:
+                os.rename(path_tmp, path_out)
+            except OSError:
+                # Another process got there first
+                shutil.rmtree(path_tmp, ignore_errors=True)
+        return path_out
+
+
+class template_entry(object):
+    """This class holds what a directory listing tells of an element of a
+    template (see template_entry.scan()), so that elements can be built
+    without accessing the filesystem again.
+
+    :param name: Name of the element
+    :param path: Full path of the element
+    :param is_dir: Bool indicating if the element is a directory (or a symlink to one)
+    :param is_file: Bool indicating if the element is a file (or a symlink to one)
+    :param is_symlink: Bool indicating if the element is a symlink
+    :param inode: Inode number of the element (None for archive members)
+    :param target: Target of the symlink (for symlinks)
+    :param realpath: Full path of the element with symlinks resolved (for symlinks)
+    :param identity: Identity of the directory linked to (for symlinks to directories; see
+        _local_files.identity())
+    """
+
+    __slots__ = ('name', 'path', 'is_dir', 'is_file', 'is_symlink', 'inode', 'target', 'realpath', 'identity')
+
+    def __init__(self, name, path, is_dir, is_file, is_symlink, inode=None, target=None, realpath=None,
+                 identity=None):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.is_file = is_file
+        self.is_symlink = is_symlink
+        self.inode = inode
+        self.target = target
+        self.realpath = realpath
+        self.identity = identity
+
+    @classmethod
+    def scan(cls, source, path):
+        """List a directory.  Symlinks are resolved here, so that the
+        listing holds everything needed to build the directory's elements.
+
+        :param source: _local_files or template_archive
+        :param path: Full path of the directory
+        :return: List of template_entry objects
+        """
+        entries = []
+        if(source is _local_files):
+            _count('listings')
+        for entry in source.scandir(path):
+            is_symlink = entry.is_symlink()
+            is_dir = entry.is_dir()
+            is_file = not is_dir and entry.is_file()
+            target = None
+            realpath = None
+            identity = None
+            if(is_symlink):
+                if(source is _local_files):
+                    _count('stat_calls', 2)
+                target = source.readlink(entry.path)
+                try:
+                    realpath = source.realpath(entry.path)
+                    if(is_dir):
+                        identity = source.identity(realpath)
+                except OSError:
+                    pass
+            entries.append(cls(entry.name, entry.path, is_dir, is_file, is_symlink,
+                               inode=entry.inode() if source is _local_files else None,
+                               target=target, realpath=realpath, identity=identity))
+        return entries
+
+
 class template_element(object):
     """This is the base class for template objects (generally, directories or files).
 
@@ -100,6 +1141,8 @@ class template_element(object):
     :param dir_host:
     :param is_directory: Bool indicating if this element is a directory
     :param is_file: Bool indicating if this element is a file
+    :param archive: The template_archive holding the element (None if it is on the filesystem)
+    :param entry: Optional template_entry of the element, used in place of accessing the filesystem
     """
 
     def __init__(
@@ -109,11 +1152,15 @@ class template_element(object):
             template_path,
             dir_host,
             is_directory=False,
-            is_file=False):
+            is_file=False,
+            archive=None,
+            entry=None):
         # Set basic properties
         self.dirname_template = full_path_in_template_root
         self._full_path_in = full_path_in
         self._template_path_in = template_path
+        self.archive = archive
+        files = _local_files if archive is None else archive
 
         # Parse the input template name of the element -> output name
         self.parse_name(self._template_path_in)
@@ -122,7 +1169,12 @@ class template_element(object):
         self.dir_host = dir_host
 
         # Check if this directory is a symlink
-        self.is_symlink = os.path.islink(full_path_in)
+        if(entry is not None):
+            self.is_symlink = entry.is_symlink
+        else:
+            if(archive is None):
+                _count('stat_calls')
+            self.is_symlink = files.islink(full_path_in)
 
         # Set some flags determining what type of element this is
         self.is_directory = is_directory
@@ -131,7 +1183,15 @@ class template_element(object):
         # Make sure full_path_in points to actual file
         # if element is a symlink and not marked as a template link
         if(self.is_symlink and not self.is_link):
-            self._full_path_in = os.path.realpath(self._full_path_in)
+            if(entry is not None and entry.realpath is not None):
+                self._full_path_in = entry.realpath
+            else:
+                if(archive is None):
+                    _count('stat_calls')
+                self._full_path_in = files.realpath(self._full_path_in)
+
+        # Compiled versions of the input and output names (see name_compiled())
+        self._names_compiled = {}
 
     def parse_name(self, template_path_in):
         """
@@ -147,6 +1207,65 @@ class template_element(object):
         # Check if the file is a link (and remove any trailing '.link's)
         self.name_out, self.is_link = check_and_remove_trailing_occurrence(self.name_out, '.link')
 
+    def name_compiled(self, name_out=True):
+        """Return the element's input or output name, parsed for '_var_'
+        parameter references.
+
+        :param name_out: Bool indicating if the output (rather than input) name is wanted
+        :return: template_line
+        """
+        # Names are keyed by value since name_out can be altered by derived classes
+        name = self.name_out if name_out else self.name_in
+        compiled = self._names_compiled.get(name)
+        if(compiled is None):
+            compiled = template_line(name, delimiter="_var_")
+            self._names_compiled[name] = compiled
+        return compiled
+
+    def to_record(self):
+        """Return a (JSON-serialisable) record of the element, from which it
+        can be recreated by from_record() without accessing the filesystem.
+
+        :return: dict
+        """
+        return {
+            'full_path_template': self.dirname_template,
+            'full_path_in': self._full_path_in,
+            'template_path': self._template_path_in,
+            'dir_host': None if self.dir_host is None else self.dir_host.template_path_in(),
+            'is_symlink': self.is_symlink,
+            'is_directory': self.is_directory}
+
+    @classmethod
+    def from_record(cls, record, dir_host):
+        """Recreate an element from a record generated by to_record().
+
+        :param record: dict
+        :param dir_host: The host directory of the element
+        :return: Element of type cls
+        """
+        element = cls.__new__(cls)
+        element._restore(record, dir_host)
+        return element
+
+    def _restore(self, record, dir_host):
+        """Set the element's properties from a record (see from_record()).
+
+        :param record: dict
+        :param dir_host: The host directory of the element
+        :return: None
+        """
+        self.dirname_template = record['full_path_template']
+        self._full_path_in = record['full_path_in']
+        self._template_path_in = record['template_path']
+        self.parse_name(self._template_path_in)
+        self.dir_host = dir_host
+        self.is_symlink = record['is_symlink']
+        self.archive = None
+        self.is_directory = False
+        self.is_file = False
+        self._names_compiled = {}
+
     def full_path_in(self):
         """
 
@@ -161,6 +1280,17 @@ class template_element(object):
         """
         return self._template_path_in
 
+    def link_source(self):
+        """Return the path that an install of this element as a link should
+        point to.  Elements of archives are extracted to the cache for this (see
+        template_archive.materialize()).
+
+        :return: Full path
+        """
+        if(self.archive is not None):
+            return self.archive.materialize(self.full_path_in())
+        return self.full_path_in()
+
 
 class template_directory(template_element):
     """
@@ -169,11 +1299,17 @@ class template_directory(template_element):
     :param full_path_dir:
     :param template_path:
     :param dir_host:
+    :param archive: The template_archive holding the directory (None if it is on the filesystem)
+    :param entry: Optional template_entry of the directory
     """
 
-    def __init__(self, full_path_in_template_root, full_path_dir, template_path, dir_host):
+    def __init__(self, full_path_in_template_root, full_path_dir, template_path, dir_host, archive=None, entry=None):
         # Verify that full_path_in points to a directory
-        if (not os.path.isdir(full_path_dir)):
+        if(entry is not None):
+            flag_valid = entry.is_dir
+        else:
+            flag_valid = (_local_files if archive is None else archive).isdir(full_path_dir)
+        if (not flag_valid):
             raise IsADirectoryError(
                 "Directory name {%s} passed to template_directory constructor does not point to a valid directory." % (
                     full_path_dir))
@@ -185,13 +1321,28 @@ class template_directory(template_element):
             full_path_dir,
             template_path,
             dir_host,
-            is_directory=True)
+            is_directory=True,
+            archive=archive,
+            entry=entry)
 
         # This will host a list of all files in this directory
         self.files = []
 
+        # Bool indicating if this is the template's root (see is_root())
+        self._is_root = None
+
+    def _restore(self, record, dir_host):
+        template_element._restore(self, record, dir_host)
+        self.is_directory = True
+        self.files = []
+        self._is_root = None
+
     def is_root(self):
-        return os.path.realpath(self.full_path_in()) == os.path.realpath(self.dirname_template)
+        # Paths are only resolved the first time this is called
+        if(self._is_root is None):
+            _count('stat_calls', 2)
+            self._is_root = os.path.realpath(self.full_path_in()) == os.path.realpath(self.dirname_template)
+        return self._is_root
 
 
 class template_file(template_element):
@@ -201,11 +1352,17 @@ class template_file(template_element):
     :param full_path_file:
     :param template_path:
     :param dir_host:
+    :param archive: The template_archive holding the file (None if it is on the filesystem)
+    :param entry: Optional template_entry of the file
     """
 
-    def __init__(self, full_path_in_template_root, full_path_file, template_path, dir_host):
+    def __init__(self, full_path_in_template_root, full_path_file, template_path, dir_host, archive=None, entry=None):
         # Verify that full_path_in points to a file
-        if (not os.path.isfile(full_path_file)):
+        if(entry is not None):
+            flag_valid = entry.is_file
+        else:
+            flag_valid = (_local_files if archive is None else archive).isfile(full_path_file)
+        if (not flag_valid):
             raise FileNotFoundError(
                 "File name {%s} passed to template_file constructor does not point to a valid file." % (full_path_file))
 
@@ -216,11 +1373,1501 @@ class template_file(template_element):
             full_path_file,
             template_path,
             dir_host,
-            is_file=True)
+            is_file=True,
+            archive=archive,
+            entry=entry)
 
         # Check if the file is a template (and remove any trailing '.template's)
         self.name_out, self.is_template = check_and_remove_trailing_occurrence(self.name_out, '.template')
 
+        # This will host the compiled lines of the file, if it is a template
+        self.lines = None
+
+        # These will host the status of the file and the digest of its contents (see stat() and digest())
+        self._stat = None
+        self._digest = None
+
+    def to_record(self):
+        record = template_element.to_record(self)
+        record['lines'] = None if self.lines is None else [line.to_record() for line in self.lines]
+        record['digest'] = self._digest
+        return record
+
+    def _restore(self, record, dir_host):
+        template_element._restore(self, record, dir_host)
+        self.is_file = True
+        self.name_out, self.is_template = check_and_remove_trailing_occurrence(self.name_out, '.template')
+        if(record['lines'] is None):
+            self.lines = None
+        else:
+            self.lines = [template_line.from_record(line) for line in record['lines']]
+        # The scan cache is only used if the file's signature is unchanged, so a cached digest is current
+        self._stat = None
+        self._digest = record.get('digest')
+
+    def stat(self):
+        """Return the status of the file (following any links).  The file is
+        only stat'ed the first time this is called.
+
+        :return: os.stat_result
+        """
+        if(self._stat is None):
+            _count('stat_calls')
+            self._stat = os.stat(self.full_path_in())
+        return self._stat
+
+    def digest(self):
+        """Return the digest of the file's contents.  The file is only read
+        the first time this is called, and the digest is stored in the scan
+        cache along with the file's signature.
+
+        :return: Hexadecimal digest string
+        """
+        if(self._digest is None):
+            if(self.archive is None):
+                self._digest = file_digest(self.full_path_in())
+            else:
+                self._digest = hashlib.sha256(self.read()).hexdigest()
+        return self._digest
+
+    def read(self):
+        """Read the contents of the file.
+
+        :return: Bytes
+        """
+        if(self.archive is not None):
+            content = self.archive.read(self.full_path_in())
+        else:
+            with open(self.full_path_in(), 'rb') as fp_in:
+                content = fp_in.read()
+        _count('bytes_read', len(content))
+        return content
+
+    def size(self):
+        """Return the size of the file, without reading it.
+
+        :return: Size in bytes
+        """
+        if(self.archive is not None):
+            return self.archive.size(self.full_path_in())
+        return self.stat().st_size
+
+    def same_contents(self, file_other):
+        """Check if another file has the same contents as this one.  Files
+        which are the same file on disk (those linked from a shared directory,
+        for example) are recognised by inode, and files of different sizes by
+        their status, without reading either file.  Otherwise, their digests
+        are compared.
+
+        :param file_other: template_file
+        :return: Bool
+        """
+        if(self.archive is None and file_other.archive is None):
+            stat_self = self.stat()
+            stat_other = file_other.stat()
+            if(stat_self.st_ino == stat_other.st_ino and stat_self.st_dev == stat_other.st_dev):
+                return True
+        if(self.size() != file_other.size()):
+            return False
+        return self.digest() == file_other.digest()
+
+    def compile(self):
+        """Parse the contents of a template file into a list of compiled
+        lines (see compile_template_text()).  The file is only read the first
+        time this is called.
+
+        The file is memory-mapped and decoded as a whole, so that it is read
+        sequentially and scanned for references in one pass.  Files with
+        carriage returns are read line-by-line in text mode instead, so that
+        their line endings are translated as before.  Files in archives are
+        read into memory and decoded in the same way.
+
+        :return: List of template_line objects (None if the file is not a template)
+        """
+        if(self.is_template and self.lines is None and self.archive is not None):
+            text = io.TextIOWrapper(io.BytesIO(self.read()), encoding=locale.getpreferredencoding(False)).read()
+            self.lines = compile_template_text(text)
+        elif(self.is_template and self.lines is None):
+            with open(self.full_path_in(), 'rb') as fp_in:
+                size = os.fstat(fp_in.fileno()).st_size
+                _count('stat_calls')
+                if(size == 0):
+                    self.lines = []
+                    return self.lines
+                _count('bytes_read', size)
+                with mmap.mmap(fp_in.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    if(hasattr(buffer, 'madvise')):
+                        buffer.madvise(mmap.MADV_SEQUENTIAL)
+                    if(buffer.find(b'\r') < 0):
+                        text = str(buffer, locale.getpreferredencoding(False))
+                    else:
+                        text = None
+            if(text is None):
+                with open(self.full_path_in(), 'r') as fp_in:
+                    text = fp_in.read()
+            self.lines = compile_template_text(text)
+        return self.lines
+
+
+class template_operation(object):
+    """This class describes a single filesystem operation of a template plan
+    (see template_plan).  Everything needed to perform the operation (the
+    output path, link target, rendered content or source file) is computed
+    when the plan is built, so that performing it requires only I/O.
+
+    :param action: One of 'mkdir', 'rmdir', 'symlink', 'unlink', 'write', 'copy', 'remove' or 'rmtree'
+        (the removal of a directory and everything in it)
+    :param path: Full output path of the operation
+    :param target: Target of the link (for 'symlink')
+    :param content: Rendered content of the file, as bytes (for 'write')
+    :param source: Full path of the file to copy (for 'copy')
+    :param copy_mode: How the file is to be copied (for 'copy'; see copy_file())
+    :param replace: Bool indicating that the operation replaces an existing file or link
+    :param record: Dictionary describing the change to the install manifest made by the operation
+    """
+
+    #: Valid operation actions
+    actions = ('mkdir', 'rmdir', 'symlink', 'unlink', 'write', 'copy', 'remove', 'rmtree')
+
+    def __init__(self, action, path, target=None, content=None, source=None, copy_mode='copy', replace=False,
+                 record=None, is_directory=False):
+        if(action not in self.actions):
+            raise ValueError("Invalid template operation {%s}." % (action))
+        self.action = action
+        self.path = path
+        self.target = target
+        self.content = content
+        self.source = source
+        self.copy_mode = copy_mode
+        self.replace = replace
+        self.record = record
+        self.is_directory = is_directory or action in ('mkdir', 'rmdir')
+
+        # Digest of the content of the written file
+        self.digest = None
+        if(content is not None):
+            self.digest = hashlib.sha256(content).hexdigest()
+        elif(record is not None):
+            self.digest = record.get('output')
+
+        # Path that a replaced or removed file is moved to, so that it can be restored
+        self.backup = None
+
+    @property
+    def phase(self):
+        """Operations are performed in two phases: directories are created
+        before, and removed after, the files within them.
+
+        :return: 0 or 1
+        """
+        flag_removal = self.action in ('rmdir', 'unlink', 'remove', 'rmtree')
+        return int(self.is_directory == flag_removal)
+
+    def to_record(self):
+        record = {
+            'action': self.action,
+            'path': self.path,
+            'replace': self.replace,
+            'is_directory': self.is_directory}
+        if(self.target is not None):
+            record['target'] = self.target
+        if(self.content is not None):
+            record['content'] = base64.b64encode(self.content).decode('ascii')
+        if(self.source is not None):
+            record['source'] = self.source
+            record['copy_mode'] = self.copy_mode
+        if(self.record is not None):
+            record['record'] = self.record
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        content = record.get('content')
+        if(content is not None):
+            content = base64.b64decode(content)
+        return cls(record['action'], record['path'],
+                   target=record.get('target'),
+                   content=content,
+                   source=record.get('source'),
+                   copy_mode=record.get('copy_mode', 'copy'),
+                   replace=record['replace'],
+                   record=record.get('record'),
+                   is_directory=record['is_directory'])
+
+    def undo(self):
+        """Describe how to reverse this operation.  This must be called
+        before the operation is performed.
+
+        :return: Dictionary (see template_journal.undo())
+        """
+        if(self.action == 'mkdir'):
+            return {'undo': 'rmdir', 'path': self.path}
+        elif(self.action == 'rmdir'):
+            return {'undo': 'mkdir', 'path': self.path}
+        elif(self.action == 'unlink' or (self.action == 'symlink' and self.replace)):
+            return {'undo': 'relink', 'path': self.path, 'target': os.readlink(self.path)}
+        elif(self.action == 'symlink'):
+            return {'undo': 'unlink', 'path': self.path}
+        elif(self.backup is not None):
+            return {'undo': 'restore', 'path': self.path, 'backup': self.backup}
+        else:
+            return {'undo': 'remove', 'path': self.path}
+
+    def perform(self):
+        """Perform the operation.  Replaced or removed files (and removed
+        directory trees) are moved to self.backup (if set) rather than deleted.
+
+        :return: None
+        """
+        if(self.action == 'mkdir'):
+            os.mkdir(self.path)
+        elif(self.action == 'rmtree'):
+            if(self.backup is not None):
+                os.rename(self.path, self.backup)
+            else:
+                shutil.rmtree(self.path)
+        elif(self.action == 'rmdir'):
+            os.rmdir(self.path)
+        elif(self.action in ('symlink', 'unlink')):
+            if(self.action == 'unlink' or self.replace):
+                os.unlink(self.path)
+            if(self.action == 'symlink'):
+                os.symlink(self.target, self.path)
+                _count('symlinks_created')
+        else:
+            if(self.action == 'remove' or self.replace):
+                if(self.backup is not None):
+                    os.replace(self.path, self.backup)
+                else:
+                    os.remove(self.path)
+            if(self.action == 'write'):
+                with open(self.path, 'wb') as fp_out:
+                    fp_out.write(self.content)
+                _count('bytes_written', len(self.content))
+            elif(self.action == 'copy'):
+                copy_file(self.source, self.path, mode=self.copy_mode)
+
+    def __str__(self):
+        if(self.action == 'symlink'):
+            return "symlink %s -> %s" % (self.path, self.target)
+        elif(self.action in ('write', 'copy') and self.digest is not None):
+            return "%s %s (sha256 %s)" % (self.action, self.path, self.digest)
+        else:
+            return "%s %s" % (self.action, self.path)
+
+
+class template_journal(object):
+    """This class manages the journal kept in an install directory while a
+    template plan is performed.  Before each batch of operations is performed,
+    a description of how to reverse each of them is appended to the journal,
+    and files which are replaced or removed are moved to a backup directory
+    rather than deleted.  If the plan fails (or the process is interrupted)
+    the journal can be used to restore the install directory to its prior
+    state.
+
+    :param dir_install: Directory the template is installed to
+    """
+
+    #: Name of the journal directory written to the install directory
+    dirname = '.gbpTemplate.journal'
+
+    def __init__(self, dir_install):
+        self.path = os.path.join(dir_install, self.dirname)
+        self.path_journal = os.path.join(self.path, 'journal')
+        self.path_backup = os.path.join(self.path, 'backup')
+        self.undo_records = []
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def start(self):
+        """Create a new (empty) journal.
+
+        :return: None
+        """
+        os.makedirs(self.path_backup)
+        open(self.path_journal, 'w').close()
+
+    def backup_path(self, index):
+        return os.path.join(self.path_backup, str(index))
+
+    def record(self, operations):
+        """Record how to reverse a batch of operations, before they are performed.
+
+        :param operations: List of template_operations
+        :return: None
+        """
+        undo_records = [operation.undo() for operation in operations]
+        with open(self.path_journal, 'a') as fp_out:
+            fp_out.write(json.dumps(undo_records) + '\n')
+            fp_out.flush()
+            os.fsync(fp_out.fileno())
+        self.undo_records.extend(undo_records)
+
+    def commit(self):
+        """Discard the journal (and any backups) once a plan has succeeded.
+
+        :return: None
+        """
+        shutil.rmtree(self.path)
+
+    def rollback(self):
+        """Reverse every recorded operation, in reverse order, and discard
+        the journal.  Operations may have been recorded without having been
+        performed, so each reversal first checks that it is needed.  If no
+        operations have been recorded by this instance, those in the journal
+        on disk (left by an interrupted install) are reversed.
+
+        :return: None
+        """
+        undo_records = self.undo_records
+        if(not undo_records):
+            undo_records = self.read()
+        for undo_record in reversed(undo_records):
+            try:
+                self.undo(undo_record)
+            except OSError:
+                pass
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.undo_records = []
+
+    def read(self):
+        """Read the operations recorded in the journal on disk (left by an
+        interrupted install), without reversing them.
+
+        :return: List of undo records (see template_operation.undo()), in the order recorded
+        """
+        undo_records = []
+        if(os.path.isfile(self.path_journal)):
+            with open(self.path_journal, 'r') as fp_in:
+                for line in fp_in:
+                    try:
+                        undo_records.extend(json.loads(line))
+                    except ValueError:
+                        # A batch which was being recorded when the process was interrupted
+                        break
+        return undo_records
+
+    @staticmethod
+    def undo(undo_record):
+        """Reverse a single operation.
+
+        :param undo_record: Dictionary returned by template_operation.undo()
+        :return: None
+        """
+        action = undo_record['undo']
+        path = undo_record['path']
+        if(action == 'rmdir'):
+            if(os.path.isdir(path) and not os.path.islink(path)):
+                os.rmdir(path)
+        elif(action == 'mkdir'):
+            if(not os.path.lexists(path)):
+                os.mkdir(path)
+        elif(action == 'unlink'):
+            if(os.path.islink(path)):
+                os.unlink(path)
+        elif(action == 'relink'):
+            if(os.path.islink(path)):
+                os.unlink(path)
+            if(not os.path.lexists(path)):
+                os.symlink(undo_record['target'], path)
+        elif(action == 'remove'):
+            if(os.path.lexists(path) and not os.path.isdir(path)):
+                os.remove(path)
+        elif(action == 'restore'):
+            if(os.path.lexists(undo_record['backup'])):
+                if(os.path.lexists(path)):
+                    os.remove(path)
+                os.replace(undo_record['backup'], path)
+
+
+class template_output_tree(object):
+    """This class holds a snapshot of the output directories of an install,
+    so that the questions asked about them while plans are built (does a
+    path exist; is it a file, a directory or a link?) are answered without
+    a system call per element.  Each directory is listed once, with a single
+    os.scandir(), the first time anything in it is asked about.  Directories
+    which the listings of their parents show to be missing are never listed.
+
+    The snapshot is updated in place as the operations of a plan are
+    performed (see template_plan.execute()).
+    """
+
+    def __init__(self):
+        # Listings of directories, keyed by full path.  Each maps the names of the directory's entries to
+        # tuples of flags (is_dir, is_file, is_symlink), with symlinks followed for the first two.  Directories
+        # which do not exist have listings of None.
+        self._listings = {}
+
+    @staticmethod
+    def _kind(entry):
+        is_symlink = entry.is_symlink()
+        if(is_symlink):
+            _count('stat_calls')
+        try:
+            return (entry.is_dir(), entry.is_file(), is_symlink)
+        except OSError:
+            return (False, False, is_symlink)
+
+    def listing(self, path_dir):
+        """Return the entries of a directory, listing it if this is the
+        first time it has been asked about.
+
+        :param path_dir: Full path of the directory
+        :return: Dictionary of (is_dir, is_file, is_symlink) tuples, keyed by name (None if there is
+            no such directory)
+        """
+        if(path_dir in self._listings):
+            return self._listings[path_dir]
+        listing = None
+        path_parent, name = os.path.split(path_dir)
+        if(path_parent in self._listings):
+            listing_parent = self._listings[path_parent]
+            flag_exists = listing_parent is not None and listing_parent.get(name, (False,))[0]
+        else:
+            flag_exists = True
+        if(flag_exists):
+            _count('listings')
+            try:
+                with os.scandir(path_dir) as entries:
+                    listing = {entry.name: self._kind(entry) for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        self._listings[path_dir] = listing
+        return listing
+
+    def entry(self, path):
+        """Return the kind of the entry at a path, listing its directory if
+        need be.
+
+        :param path: Full path
+        :return: Tuple of flags (is_dir, is_file, is_symlink); None if there is no such entry
+        """
+        path_parent, name = os.path.split(path)
+        if(not name):
+            return None
+        listing = self.listing(path_parent)
+        return None if listing is None else listing.get(name)
+
+    def lexists(self, path):
+        return self.entry(path) is not None
+
+    def isfile(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry[1]
+
+    def islink(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry[2]
+
+    def isdir(self, path):
+        # Directories are checked by listing them (rather than their parents), so that
+        # checking the install directory does not list the directory holding it
+        path_parent = os.path.dirname(path)
+        if(self._listings.get(path_parent) is None):
+            return self.listing(path) is not None
+        entry = self.entry(path)
+        return entry is not None and entry[0]
+
+    def add(self, path, is_dir=False, is_symlink=False):
+        """Record the creation of a file, directory or link.
+
+        :param path: Full path
+        :param is_dir: Bool indicating if a directory (or a link to one) was created
+        :param is_symlink: Bool indicating if a link was created
+        :return: None
+        """
+        listing = self._listings.get(os.path.dirname(path))
+        if(listing is not None):
+            listing[os.path.basename(path)] = (is_dir, not is_dir, is_symlink)
+        self._listings.pop(path, None)
+        if(is_dir and not is_symlink):
+            self._listings[path] = {}
+
+    def remove(self, path, tree=False):
+        """Record the removal of a file, directory or link.
+
+        :param path: Full path
+        :param tree: Bool indicating that a directory was removed with everything under it
+        :return: None
+        """
+        listing = self._listings.get(os.path.dirname(path))
+        if(listing is not None):
+            listing.pop(os.path.basename(path), None)
+        if(path in self._listings):
+            self._listings[path] = None
+        if(tree):
+            for path_dir in [path_dir for path_dir in self._listings if path_dir.startswith(path + os.sep)]:
+                self._listings[path_dir] = None
+
+    def revert(self, undo_records):
+        """Record the effect of reversing the operations of an interrupted
+        install (see template_journal.rollback()), without reversing them.
+
+        :param undo_records: List of undo records (see template_operation.undo()), in the order recorded
+        :return: None
+        """
+        for undo_record in reversed(undo_records):
+            path = undo_record['path']
+            self.listing(os.path.dirname(path))
+            action = undo_record['undo']
+            if(action in ('rmdir', 'unlink', 'remove')):
+                self.remove(path)
+            elif(action == 'mkdir'):
+                self.add(path, is_dir=True)
+            elif(action == 'relink'):
+                self.add(path, is_dir=os.path.isdir(os.path.join(os.path.dirname(path), undo_record['target'])),
+                         is_symlink=True)
+            elif(os.path.isdir(undo_record['backup'])):
+                # Restored directory trees are listed from their backups
+                self.add(path, is_dir=True)
+                for root, dirs, files in os.walk(undo_record['backup']):
+                    root_restored = os.path.normpath(os.path.join(path, os.path.relpath(root, undo_record['backup'])))
+                    with os.scandir(root) as entries:
+                        self._listings[root_restored] = {entry.name: self._kind(entry) for entry in entries}
+            elif(os.path.lexists(undo_record['backup'])):
+                self.add(path)
+
+    def apply(self, operation):
+        """Record the effect of a performed operation (see template_operation).
+
+        :param operation: template_operation
+        :return: None
+        """
+        if(operation.action in ('rmdir', 'rmtree', 'unlink', 'remove')):
+            self.remove(operation.path, tree=(operation.action == 'rmtree'))
+        elif(operation.action == 'mkdir'):
+            self.add(operation.path, is_dir=True)
+        elif(operation.action == 'symlink'):
+            self.add(operation.path, is_dir=operation.is_directory, is_symlink=True)
+        else:
+            self.add(operation.path)
+
+
+class template_plan(object):
+    """This class holds the plan of an install (or uninstall) of a template:
+    an ordered list of filesystem operations and the log messages which
+    report them.  Building a plan makes every decision about what to do (and
+    renders the content of every file to be written) without altering the
+    filesystem; the operations are then performed by execute(), or the plan
+    is just reported for a silent install.  Plans can be written to a file
+    and read back to be executed later.
+
+    :param dir_install: Directory the template is installed to
+    """
+
+    #: Version of the plan file format
+    version = 1
+
+    #: Number of operations recorded in the journal at a time
+    batch_size = 256
+
+    class execution_error(Exception):
+        """Raised when an operation of a plan fails."""
+
+        def __init__(self, operation, error):
+            super(template_plan.execution_error, self).__init__("Failed to %s: %s" % (operation, error))
+            self.operation = operation
+            self.error = error
+
+    def __init__(self, dir_install):
+        self.dir_install = os.path.abspath(dir_install)
+        self.operations = []
+        self.messages = []
+
+        # Operations creating each output path, keyed by path (see planned())
+        self._operations_out = {}
+
+    def add(self, method, msg=None, msg_silent=None, operation=None, in_silent=True):
+        """Add a log message to the plan, along with the operation it reports (if any).
+
+        :param method: Log method of the message ('open', 'close' or 'comment')
+        :param msg: Message
+        :param msg_silent: Message to write instead for silent installs (default: msg)
+        :param operation: template_operation reported by the message
+        :param in_silent: Bool indicating that the message is written for silent installs
+        :return: None
+        """
+        if(msg_silent is None):
+            msg_silent = msg
+        self.messages.append((method, msg, msg_silent if in_silent else False))
+        if(operation is not None):
+            self.operations.append(operation)
+            if(operation.action not in ('rmdir', 'unlink', 'remove', 'rmtree')):
+                self._operations_out[operation.path] = operation
+
+    def planned(self, path):
+        """Return the operation of the plan which creates an output path, so
+        that elements of a template which resolve to the same path are only
+        installed once.
+
+        :param path: Full output path
+        :return: template_operation (None if the plan does not create the path)
+        """
+        return self._operations_out.get(path)
+
+    def discard(self, operation):
+        """Remove an operation from the plan (when a later one supersedes it).
+        The message reporting it is kept.
+
+        :param operation: template_operation
+        :return: None
+        """
+        self.operations.remove(operation)
+        if(self._operations_out.get(operation.path) is operation):
+            del self._operations_out[operation.path]
+
+    def n_operations(self):
+        return len(self.operations)
+
+    def report(self, silent=False):
+        """Write the plan's messages to the log.
+
+        :param silent: Bool indicating that the silent-install messages should be written
+        :return: None
+        """
+        for method, msg, msg_silent in self.messages:
+            if(silent):
+                msg = msg_silent
+            if(msg is not False):
+                getattr(gbpBuild.log, method)(msg)
+
+    def execute(self, jobs=1, manifest=None, output_tree=None, use_journal=True):
+        """Perform the plan's operations.  Directories are created before (and
+        removed after) files, and the operations on files are performed by a
+        pool of workers if jobs>1.  If any operation fails, everything done
+        so far is reversed and template_plan.execution_error is raised.
+
+        Plans of a single element need not pay for a journal: with
+        use_journal=False, operations are performed directly and a failure
+        leaves whatever was done in place.
+
+        :param jobs: Number of workers to use for file operations
+        :param manifest: template_manifest to update with the files written and removed
+        :param output_tree: template_output_tree to update with the changes made
+        :param use_journal: Bool indicating that the operations should be journaled (see template_journal)
+        :return: None
+        """
+        if(not self.operations):
+            return
+
+        # Reverse anything left by an interrupted install (see template.plan())
+        journal = None
+        if(use_journal):
+            journal = template_journal(self.dir_install)
+            if(journal.exists()):
+                journal.rollback()
+            journal.start()
+
+        executor = None
+        if(jobs > 1):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            for phase in (0, 1):
+                operations = [(i_op, op) for i_op, op in enumerate(self.operations) if op.phase == phase]
+                for i_batch in range(0, len(operations), self.batch_size):
+                    batch = operations[i_batch:i_batch + self.batch_size]
+                    if(journal is not None):
+                        for i_op, op in batch:
+                            if(op.action in ('remove', 'rmtree') or (op.replace and op.action in ('write', 'copy'))):
+                                op.backup = journal.backup_path(i_op)
+                        journal.record([op for i_op, op in batch])
+
+                    # Runs of file operations are performed in parallel; directory operations are performed
+                    # one at a time, in order, after everything before them has finished
+                    runs = []
+                    for i_op, op in batch:
+                        if(runs and runs[-1][0].is_directory == op.is_directory):
+                            runs[-1].append(op)
+                        else:
+                            runs.append([op])
+                    for run in runs:
+                        if(executor is not None and not run[0].is_directory and len(run) > 1):
+                            futures = [(op, executor.submit(op.perform)) for op in run]
+                            for op, future in futures:
+                                self._perform(op, future.result)
+                        else:
+                            for op in run:
+                                self._perform(op, op.perform)
+        except BaseException:
+            if(executor is not None):
+                executor.shutdown(wait=True)
+            if(journal is not None):
+                journal.rollback()
+            raise
+        finally:
+            for op in self.operations:
+                op.backup = None
+        if(executor is not None):
+            executor.shutdown(wait=True)
+        if(journal is not None):
+            journal.commit()
+
+        # Keep the snapshot of the output directories current
+        if(output_tree is not None):
+            for op in self.operations:
+                output_tree.apply(op)
+
+        # Record the changes made in the manifest
+        if(manifest is not None):
+            for op in self.operations:
+                if(op.record is not None):
+                    if(op.action in ('remove', 'unlink', 'rmdir', 'rmtree')):
+                        manifest.remove(op.record['path_relative'], tree=(op.action == 'rmtree'))
+                    elif(op.action == 'mkdir'):
+                        manifest.add_directory(op.record['path_relative'])
+                    elif(op.action == 'symlink'):
+                        manifest.add_link(op.record['path_relative'], op.target)
+                    else:
+                        manifest.add(op.record['path_relative'], op.path, op.record['source'], op.record['params'],
+                                     output=op.digest)
+
+    @staticmethod
+    def _perform(operation, perform):
+        try:
+            perform()
+        except OSError as error:
+            raise template_plan.execution_error(operation, error)
+
+    def to_record(self):
+        return {
+            'version': self.version,
+            'dir_install': self.dir_install,
+            'operations': [operation.to_record() for operation in self.operations],
+            'messages': self.messages}
+
+    @classmethod
+    def from_record(cls, record):
+        if(record.get('version') != cls.version):
+            raise ValueError("Incompatible template plan version {%s}." % (record.get('version')))
+        plan = cls(record['dir_install'])
+        plan.operations = [template_operation.from_record(operation) for operation in record['operations']]
+        plan.messages = [tuple(message) for message in record['messages']]
+        return plan
+
+    def write(self, path):
+        """Write the plan to a file.
+
+        :param path: Path of the file
+        :return: None
+        """
+        with open(path, 'w') as fp_out:
+            json.dump(self.to_record(), fp_out, indent=1)
+
+    @classmethod
+    def read(cls, path):
+        """Read a plan written by template_plan.write().
+
+        :param path: Path of the file
+        :return: template_plan
+        """
+        with open(path, 'r') as fp_in:
+            return cls.from_record(json.load(fp_in))
+
+    def __str__(self):
+        result = "Plan for {%s}: %d operation(s)\n" % (self.dir_install, len(self.operations))
+        for operation in self.operations:
+            result += "   --> %s\n" % (operation)
+        return result
+
+
+class template_watcher(object):
+    """This class watches a set of directories for changes to the entries
+    within them (not recursively).  On Linux, inotify is used; elsewhere (or
+    if inotify is unavailable) the directories are polled.
+
+    :param directories: List of directories to watch
+    :param poll_interval: Time (in seconds) between polls, when polling
+    :param use_inotify: Bool indicating if inotify should be used (if available)
+    """
+
+    # inotify event masks (see inotify(7))
+    _in_attrib = 0x00000004
+    _in_close_write = 0x00000008
+    _in_moved_from = 0x00000040
+    _in_moved_to = 0x00000080
+    _in_create = 0x00000100
+    _in_delete = 0x00000200
+    _in_delete_self = 0x00000400
+    _in_move_self = 0x00000800
+    _in_q_overflow = 0x00004000
+    _in_mask = (_in_attrib | _in_close_write | _in_moved_from | _in_moved_to | _in_create | _in_delete |
+                _in_delete_self | _in_move_self)
+    _in_event = struct.Struct('iIII')
+
+    #: Time (in seconds) with no further events after which a burst of changes is reported
+    quiet_time = 0.05
+
+    def __init__(self, directories, poll_interval=0.5, use_inotify=True):
+        self.poll_interval = poll_interval
+        self.directories = []
+        self._libc = None
+        self._fd = None
+        self._wds = {}
+        self._snapshot = {}
+        if(use_inotify and sys.platform.startswith('linux')):
+            try:
+                self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+            except (OSError, AttributeError):
+                self._fd = None
+            if(self._fd is not None and self._fd < 0):
+                self._fd = None
+        self.watch(directories)
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def watch(self, directories):
+        """Set the directories being watched.
+
+        :param directories: List of directories
+        :return: None
+        """
+        self.directories = sorted(set(os.path.abspath(directory) for directory in directories))
+        if(self.uses_inotify):
+            for wd in list(self._wds):
+                self._libc.inotify_rm_watch(self._fd, wd)
+            self._wds = {}
+            for directory in self.directories:
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self._in_mask)
+                if(wd >= 0):
+                    self._wds[wd] = directory
+        else:
+            self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                        except OSError:
+                            pass
+            except OSError:
+                snapshot[directory] = None
+        return snapshot
+
+    def _poll(self):
+        snapshot = self._scan()
+        changed = set(path for path in set(snapshot) | set(self._snapshot)
+                      if snapshot.get(path) != self._snapshot.get(path))
+        self._snapshot = snapshot
+        return changed
+
+    def _read_events(self):
+        changed = set()
+        buffer = os.read(self._fd, 1 << 16)
+        offset = 0
+        while(offset < len(buffer)):
+            wd, mask, cookie, length = self._in_event.unpack_from(buffer, offset)
+            offset += self._in_event.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if(mask & self._in_q_overflow):
+                # Events were lost; report every watched directory as changed
+                changed.update(self.directories)
+            elif(wd in self._wds):
+                if(name):
+                    changed.add(os.path.join(self._wds[wd], os.fsdecode(name)))
+                else:
+                    changed.add(self._wds[wd])
+        return changed
+
+    def wait(self, timeout=None):
+        """Wait for changes to the watched directories.  Once a change is
+        seen, any others made within a short time are collected with it.
+
+        :param timeout: Maximum time (in seconds) to wait (default: wait forever)
+        :return: Sorted list of the paths changed (empty if the wait timed out)
+        """
+        time_stop = None if timeout is None else time.time() + timeout
+        changed = set()
+        while(True):
+            if(self.uses_inotify):
+                if(changed):
+                    wait = self.quiet_time
+                elif(time_stop is None):
+                    wait = None
+                else:
+                    wait = max(0., time_stop - time.time())
+                ready, _, _ = select.select([self._fd], [], [], wait)
+                if(ready):
+                    changed.update(self._read_events())
+                    continue
+            else:
+                changes = self._poll()
+                if(changes):
+                    changed.update(changes)
+                    time.sleep(self.quiet_time)
+                    continue
+                if(not changed):
+                    if(time_stop is not None and time.time() >= time_stop):
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+            if(changed or (time_stop is not None and time.time() >= time_stop)):
+                break
+        return sorted(changed)
+
+    def close(self):
+        if(self.uses_inotify):
+            os.close(self._fd)
+            self._fd = None
+
+
+class template_scan_cache(object):
+    """This class manages the on-disk cache of the results of scanning a
+    template directory: the elements found (in the order they were found),
+    their link/template flags and the compiled contents of template files.
+    Along with these, a signature (see stat_signature()) of every scanned
+    directory and file is stored, and the cache is only used if none of these
+    have changed.  Validating the cache therefore requires only a stat of
+    each element.
+
+    :param template_dir: Path to the template directory
+    """
+
+    #: Version of the cache file format
+    version = 1
+
+    def __init__(self, template_dir):
+        self.template_dir = os.path.abspath(template_dir)
+        key = hashlib.sha256(self.template_dir.encode('utf-8')).hexdigest()
+        self.path = cache_path('scan', key + '.json')
+
+    def load(self):
+        """Load the cached scan of the template, if it exists and is current.
+
+        :return: List of element records (None if there is no valid cache)
+        """
+        try:
+            with open(self.path, 'r') as fp_in:
+                cache = json.load(fp_in)
+            if(cache['version'] != self.version or cache['template_dir'] != self.template_dir):
+                return None
+            for path, signature in cache['signatures'].items():
+                if(stat_signature(path) != signature):
+                    return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return cache['elements']
+
+    def save(self, elements):
+        """Write the scan of the template to the cache.  Failures to write
+        the cache are ignored.
+
+        :param elements: List of elements, in the order they were added to the template
+        :return: None
+        """
+        try:
+            signatures = {}
+            for element in elements:
+                signatures[element._full_path_in] = stat_signature(element._full_path_in)
+            cache = {
+                'version': self.version,
+                'template_dir': self.template_dir,
+                'signatures': signatures,
+                'elements': [element.to_record() for element in elements]}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            path_tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(path_tmp, 'w') as fp_out:
+                json.dump(cache, fp_out)
+            os.replace(path_tmp, self.path)
+        except OSError:
+            pass
+
+
+class template_render_cache(object):
+    """This class manages the on-disk cache of rendered template files.
+    Rendered contents are stored under a key computed from the digest of the
+    template file and the digest of the values of the parameters and
+    directives it references (see template.parameter_digest()), so that a
+    file rendered with the same inputs by any install can be copied from the
+    cache rather than rendered again.
+
+    The cache is kept below a maximum size (given by the
+    GBPTEMPLATE_RENDER_CACHE_SIZE environment variable, in bytes; default
+    256MB) by removing the least recently used renders (see trim()).  The
+    numbers of hits and misses are accumulated in the cache, for reporting
+    (see stats()).
+
+    Renders are stored by a background thread, so that writing the cache
+    does not hold up the install that rendered them (see flush()).
+
+    :param size_max: Maximum size of the cache, in bytes (default: set from the environment)
+    """
+
+    #: Default maximum size of the cache, in bytes
+    size_max_default = 256 << 20
+
+    def __init__(self, size_max=None):
+        self.path = cache_path('renders')
+        self.path_stats = os.path.join(self.path, 'stats.json')
+        if(size_max is None):
+            size_max = int(os.environ.get('GBPTEMPLATE_RENDER_CACHE_SIZE', self.size_max_default))
+        self.size_max = size_max
+
+        # Sub-directories known to exist, and the thread (and pending futures) storing renders
+        self._directories = set()
+        self._executor = None
+        self._futures = []
+
+        # Counts of lookups and stores since the counts were last saved (see save_stats())
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_stored = 0
+
+    def path_render(self, source, params):
+        """Return the path a render is stored at.
+
+        :param source: Digest of the template file
+        :param params: Digest of the parameters referenced by the file
+        :return: Full path
+        """
+        key = hashlib.sha256((source + params).encode('ascii')).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, source, params):
+        """Look up a render, marking it as recently used if it is found.
+        Small renders are read from the cache here; larger ones are left to
+        be copied from it.
+
+        :param source: Digest of the template file
+        :param params: Digest of the parameters referenced by the file
+        :return: Tuple of the full path of the cached render and its content (None if it is not read);
+            None if there is no render
+        """
+        path = self.path_render(source, params)
+        try:
+            with open(path, 'rb') as fp_in:
+                os.utime(fp_in.fileno())
+                content = fp_in.read(_io_buffer_size + 1)
+        except OSError:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        _count('bytes_read', len(content))
+        if(len(content) > _io_buffer_size):
+            content = None
+        return path, content
+
+    def put(self, source, params, content):
+        """Queue a render to be stored.  Failures to write the cache are
+        ignored.
+
+        :param source: Digest of the template file
+        :param params: Digest of the parameters referenced by the file
+        :param content: Rendered content, as bytes
+        :return: None
+        """
+        if(self._executor is None):
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        _count('bytes_written', len(content))
+        self._futures.append(self._executor.submit(self._store, self.path_render(source, params), content))
+
+    def flush(self):
+        """Wait for all queued renders to be stored.
+
+        :return: None
+        """
+        if(self._executor is None):
+            return
+        concurrent.futures.wait(self._futures)
+        self._futures = []
+        self._executor.shutdown()
+        self._executor = None
+
+    def _store(self, path, content):
+        try:
+            if(os.path.dirname(path) not in self._directories):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._directories.add(os.path.dirname(path))
+            path_tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(path_tmp, 'wb') as fp_out:
+                fp_out.write(content)
+            os.replace(path_tmp, path)
+            self.n_stored += 1
+        except OSError:
+            pass
+
+    def _renders(self):
+        renders = []
+        try:
+            with os.scandir(self.path) as entries_dir:
+                for entry_dir in [entry for entry in entries_dir if entry.is_dir()]:
+                    with os.scandir(entry_dir.path) as entries:
+                        for entry in entries:
+                            stat_render = entry.stat()
+                            renders.append((stat_render.st_mtime_ns, stat_render.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return renders
+
+    def trim(self):
+        """Remove the least recently used renders until the cache is no
+        larger than its maximum size.
+
+        :return: Number of renders removed
+        """
+        renders = self._renders()
+        size = sum(render[1] for render in renders)
+        n_removed = 0
+        for mtime, size_render, path in sorted(renders):
+            if(size <= self.size_max):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= size_render
+            n_removed += 1
+        return n_removed
+
+    def stats(self):
+        """Return statistics of the cache.
+
+        :return: Dictionary of the numbers of renders, their total size, the maximum size and the
+            numbers of hits, misses and renders stored
+        """
+        counts = {'hits': 0, 'misses': 0, 'stored': 0}
+        try:
+            with open(self.path_stats, 'r') as fp_in:
+                counts.update(json.load(fp_in))
+        except (OSError, ValueError):
+            pass
+        counts['hits'] += self.n_hits
+        counts['misses'] += self.n_misses
+        counts['stored'] += self.n_stored
+        renders = self._renders()
+        return dict(counts, renders=len(renders), size=sum(render[1] for render in renders), size_max=self.size_max)
+
+    def save_stats(self):
+        """Wait for queued renders to be stored (see flush()), add the
+        counts of hits, misses and renders stored to those saved in the
+        cache, then trim the cache (see trim()).  Failures to write
+        the cache are ignored.
+
+        :return: None
+        """
+        self.flush()
+        if(not (self.n_hits or self.n_misses or self.n_stored)):
+            return
+        stats = self.stats()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            path_tmp = "%s.%d.tmp" % (self.path_stats, os.getpid())
+            with open(path_tmp, 'w') as fp_out:
+                json.dump({key: stats[key] for key in ('hits', 'misses', 'stored')}, fp_out)
+            os.replace(path_tmp, self.path_stats)
+        except OSError:
+            pass
+        self.n_hits = 0
+        self.n_misses = 0
+        if(self.n_stored):
+            self.n_stored = 0
+            self.trim()
+
+
+class template_manifest(object):
+    """This class holds the record of the files written by template installs
+    to a given directory.  For each file (keyed by its path relative to the
+    install directory) it stores digests of the template source, of the
+    parameters the file used and of the rendered output, so that later
+    installs can tell whether the file needs to be written again.
+
+    The directories and links created by installs, and the names of the
+    templates installed, are recorded too, so that an install can be removed
+    without the templates (see plan_uninstall()).  Manifests written before
+    these were recorded do not list the installed templates.
+
+    :param dir_install: Directory the template is installed to
+    """
+
+    #: Name of the manifest file written to the install directory
+    filename = '.gbpTemplate.manifest'
+
+    #: Version of the manifest file format
+    version = 1
+
+    def __init__(self, dir_install):
+        self.dir_install = dir_install
+        self.path = os.path.join(dir_install, self.filename)
+        self.files = {}
+        self.directories = {}
+        self.links = {}
+        self.templates = []
+
+        # Load any existing manifest; ignore those with an incompatible format
+        if(os.path.isfile(self.path)):
+            with open(self.path, 'r') as fp_in:
+                manifest = json.load(fp_in)
+            if(manifest.get('version') == self.version):
+                self.files = manifest['files']
+                self.directories = manifest.get('directories', {})
+                self.links = manifest.get('links', {})
+                self.templates = manifest.get('templates')
+
+    def add(self, path_relative, path_out, source, params, output=None):
+        """Record a file which has just been written.
+
+        :param path_relative: Path of the file, relative to the install directory
+        :param path_out: Full path of the file
+        :param source: Digest of the file's template source
+        :param params: Digest of the parameters used to render the file
+        :param output: Digest of the file's contents (computed from the file if not given)
+        :return: None
+        """
+        stat = os.stat(path_out)
+        if(output is None):
+            output = file_digest(path_out)
+        self.files[path_relative] = {
+            'source': source,
+            'params': params,
+            'output': output,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+    def add_directory(self, path_relative):
+        """Record a directory which has just been created.
+
+        :param path_relative: Path of the directory, relative to the install directory
+        :return: None
+        """
+        self.directories[path_relative] = {}
+
+    def add_link(self, path_relative, target):
+        """Record a link (to a file or directory) which has just been created.
+
+        :param path_relative: Path of the link, relative to the install directory
+        :param target: Target of the link
+        :return: None
+        """
+        self.links[path_relative] = target
+
+    def add_templates(self, names):
+        """Record the names of templates installed.  Nothing is recorded if
+        the manifest was written before template names were.
+
+        :param names: List of template names
+        :return: None
+        """
+        if(self.templates is not None):
+            self.templates = sorted(set(self.templates).union(names))
+
+    def remove(self, path_relative, tree=False):
+        """Remove a file, link or directory from the record.
+
+        :param path_relative: Path of the element, relative to the install directory
+        :param tree: Bool indicating that everything recorded under the element should be removed too
+        :return: None
+        """
+        self.files.pop(path_relative, None)
+        self.directories.pop(path_relative, None)
+        self.links.pop(path_relative, None)
+        if(tree):
+            prefix = path_relative + os.sep
+            for records in (self.files, self.directories, self.links):
+                for path_i in [path_i for path_i in records if path_i.startswith(prefix)]:
+                    del records[path_i]
+
+    def is_current(self, path_relative, path_out, source, params):
+        """Check if a file was written from the given inputs and has not
+        been altered since.  The file is only read if its size or
+        modification time differ from those recorded.
+
+        :param path_relative: Path of the file, relative to the install directory
+        :param path_out: Full path of the file
+        :param source: Digest of the file's template source
+        :param params: Digest of the parameters used to render the file
+        :return: Bool
+        """
+        record = self.files.get(path_relative)
+        if(record is None or record['source'] != source or record['params'] != params):
+            return False
+        stat = os.stat(path_out)
+        _count('stat_calls')
+        if(stat.st_size != record['size']):
+            return False
+        if(stat.st_mtime_ns == record['mtime_ns']):
+            return True
+        return file_digest(path_out) == record['output']
+
+    def write(self):
+        """Write the manifest to the install directory.  If nothing is
+        recorded, any existing manifest is removed instead.
+
+        :return: None
+        """
+        if(self.files or self.directories or self.links):
+            manifest = {
+                'version': self.version,
+                'files': self.files,
+                'directories': self.directories,
+                'links': self.links}
+            if(self.templates is not None):
+                manifest['templates'] = self.templates
+            with open(self.path, 'w') as fp_out:
+                json.dump(manifest, fp_out, indent=2, sort_keys=True)
+        elif(os.path.isfile(self.path)):
+            os.remove(self.path)
+
+    def plan_uninstall(self):
+        """Build the plan of the removal of everything recorded in the
+        manifest, without the templates that were installed.  Each directory
+        holding recorded elements is listed once, and recorded directories
+        holding nothing but recorded elements are removed whole (in one
+        operation each).  Directories holding anything else are kept, along
+        with their unrecorded contents.
+
+        :return: template_plan
+        """
+        plan = template_plan(self.dir_install)
+        recorded = set(self.files) | set(self.links) | set(self.directories)
+
+        # List the contents of every directory holding (or recorded as) an element of the install
+        listings = {}
+        for path_relative in set(os.path.dirname(path_i) for path_i in recorded) | set(self.directories):
+            _count('listings')
+            try:
+                with os.scandir(os.path.join(self.dir_install, path_relative)) as entries:
+                    listings[path_relative] = [entry.name for entry in entries]
+            except (FileNotFoundError, NotADirectoryError):
+                listings[path_relative] = None
+
+        # Find the directories holding only recorded elements, deepest first
+        removable = set()
+        for path_relative in sorted(self.directories, key=lambda path_i: path_i.count(os.sep), reverse=True):
+            listing = listings[path_relative]
+            if(listing is not None and all(
+                    os.path.join(path_relative, name) in removable or
+                    os.path.join(path_relative, name) in self.files or
+                    os.path.join(path_relative, name) in self.links for name in listing)):
+                removable.add(path_relative)
+
+        # Remove directory trees whole, and everything else element by element
+        removed = set()
+        for path_relative in sorted(recorded):
+            path_parent = os.path.dirname(path_relative)
+            if(any(path_i in removed for path_i in self._parents(path_relative))):
+                continue
+            full_path_out = os.path.join(self.dir_install, path_relative)
+            record = {'path_relative': path_relative}
+            if(path_relative in self.directories):
+                if(path_relative in removable):
+                    removed.add(path_relative)
+                    plan.add('comment',
+                             "Directory %s removed." % (full_path_out),
+                             "Directory %s removed silently." % (full_path_out),
+                             operation=template_operation('rmtree', full_path_out, record=record))
+                elif(listings[path_relative] is None):
+                    plan.add('comment', "Directory %s not found." % (full_path_out))
+                else:
+                    plan.add('comment', "Directory %s kept (it holds unrecorded files)." % (full_path_out))
+            elif(listings[path_parent] is None or os.path.basename(path_relative) not in listings[path_parent]):
+                plan.add('comment', "--> %s not found." % (full_path_out))
+            elif(path_relative in self.links):
+                plan.add('comment',
+                         "--> %s unlinked." % (full_path_out),
+                         "--> %s unlinked silently." % (full_path_out),
+                         operation=template_operation('unlink', full_path_out, record=record))
+            else:
+                plan.add('comment',
+                         "--> %s removed." % (full_path_out),
+                         "--> %s removed silently." % (full_path_out),
+                         operation=template_operation('remove', full_path_out, record=record))
+        return plan
+
+    @staticmethod
+    def _parents(path_relative):
+        path_parent = os.path.dirname(path_relative)
+        while(path_parent):
+            yield path_parent
+            path_parent = os.path.dirname(path_parent)
+
+
+class template_parameters(dict):
+    """This class is a dictionary of template parameters which counts the
+    number of times it has been altered, so that anything derived from the
+    parameters (output paths, for example) can tell when it is stale.
+
+    Changes made through the dictionary are counted as they are made.
+    Mutable values (lists, sets and dictionaries) can also be altered in
+    place; these changes are found by changes(check_values=True), which
+    compares the values with copies taken when they were last checked.
+    """
+
+    # Types of the values which can be altered in place
+    _mutable_types = (list, set, dict)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.n_changes = 0
+        self._values_mutable = None
+
+    def _changed(self):
+        self.n_changes += 1
+        self._values_mutable = None
+
+    def changes(self, check_values=False):
+        """Return the number of changes made to the parameters.
+
+        :param check_values: Bool indicating that changes made in place to mutable values since they were
+            last checked should be found (and counted) as well.  This compares every such value with a
+            copy, so is done once per install rather than for every lookup.
+        :return: Integer
+        """
+        if(check_values):
+            if(self._values_mutable is not None):
+                for key, value in self._values_mutable.items():
+                    if(dict.get(self, key) != value):
+                        self._changed()
+                        break
+            if(self._values_mutable is None):
+                self._values_mutable = {key: copy.deepcopy(value) for key, value in self.items()
+                                        if isinstance(value, self._mutable_types)}
+        return self.n_changes
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def __ior__(self, other):
+        dict.update(self, other)
+        self._changed()
+        return self
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
 
 class template:
     """
@@ -229,19 +2876,103 @@ class template:
     :param path:
     """
 
+    # Descriptions of the outcomes of a comparison (see diff())
+    _diff_messages = {
+        'created': 'would be created',
+        'changed': 'would change',
+        'unchanged': 'unchanged',
+        'orphaned': 'orphaned'}
+
     def __init__(self, template_name=None, path=None):
         self.path = []
         self.dir = []
         self.name = []
         self.directories = []
+
+        # Caches of resolved output paths, keyed by element.  Template
+        # paths depend only on the parameters, while full paths also
+        # depend on the install directory.
+        self._template_paths_out = {}
+        self._full_paths_out = {}
+        self._paths_out_n_changes = None
+
+        # Cache of resolved directives, keyed by directive and host directory (see resolve_directive())
+        self._directive_results = {}
+
+        # Index of output directory listings, keyed by template directory (see directory_listing()),
+        # and of the output names of template directories, keyed by their parent's output path
+        self._listings = {}
+        self._subdirectories_out = None
+
+        # Snapshot of the output directories (see output_tree())
+        self._output_tree = None
+
+        # Full output paths which the plan being built removes (and which are left out of listings)
+        self._paths_removed = set()
+
         self.params = self.init_parameters()
+
+        # Indices of the directories and files in the template, keyed by
+        # template_path_in().  These must be kept in sync with the lists above.
+        self._directory_index = {}
+        self._file_index = {}
         self.params_list = []
         self.current_element = None
+
+        # Elements of lazily loaded templates needed for parameters (see add()); None once a template is fully loaded
+        self._elements_needed = []
         self.dir_install = "."
 
+        # Record of the files written to the install directory (set during installs/uninstalls)
+        self.manifest = None
+
+        # How non-template files are copied (see copy_file())
+        self.copy_mode = 'copy'
+
+        # Cache of rendered template files (set during installs; see template_render_cache)
+        self.render_cache = None
+
+        # Counts of the I/O and work done by the last add, install or uninstall (see template_counters)
+        self.counters = template_counters()
+
         if(template_name is not None):
             self.add(template_name, path=path)
 
+    @property
+    def params(self):
+        """The dictionary of template parameters."""
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = template_parameters(params)
+        self._template_paths_out.clear()
+        self._full_paths_out.clear()
+        self._clear_install_caches()
+
+    @property
+    def dir_install(self):
+        """The directory the template is being installed to."""
+        return self._dir_install
+
+    @dir_install.setter
+    def dir_install(self, dir_install):
+        self._dir_install = dir_install
+        self._full_paths_out.clear()
+        self._clear_install_caches()
+
+    def _clear_install_caches(self):
+        """Clear the caches of directive results and directory listings (and
+        the snapshot of the output directories), which are only valid for the
+        duration of an install.
+
+        :return: None
+        """
+        self._directive_results.clear()
+        self._listings.clear()
+        self._subdirectories_out = None
+        self._output_tree = None
+
     # This method locates all annotated parameter references in a string
     def collect_parameter_references(self, string, delimiter="%%%"):
         """
@@ -250,13 +2981,16 @@ class template:
         :param delimiter:
         :return:
         """
-        if(delimiter is None):
-            delimiter = "%%%"
-        regex = re.compile("%s%s%s" % (delimiter, _regex_parameter_selector, delimiter))
-        for match in regex.finditer(string):
-            # Check if there are any directives in the match
-            directive = match.group()
-            directive = directive[len(delimiter):len(directive) - len(delimiter)]
+        self.collect_compiled_references(template_line(string, delimiter=delimiter))
+
+    def collect_compiled_references(self, line):
+        """Add the parameters referenced by a compiled line to the list of
+        needed parameters.
+
+        :param line: template_line
+        :return: None
+        """
+        for directive in line.directives:
             if(not self.resolve_directive(None, directive, check=True)):
                 self.params_list.add(directive)
 
@@ -313,218 +3047,121 @@ class template:
                         (param_i))
 
     def resolve_directive(self, element, directive, check=False):
+        """Resolve a parameter reference or directive.  Protected ('_'-prefixed)
+        directives are passed to their registered handler (see
+        register_directive()); anything else is looked-up in the template
+        parameters.  Results are cached by directive and host directory until
+        the parameters or install directory change, or a new install starts.
+
+        :param element: The template element being rendered
+        :param directive: The text of the directive
+        :param check: Bool indicating that only the validity of the directive should be checked
+        :return: If check, True if valid.  Otherwise, a dictionary with the directive name
+            and a list of values to substitute.  None if the directive is not defined.
         """
+        directive = parse_directive(directive)
 
-        :param element:
-        :param directive:
-        :param check:
-        :return:
-        """
-        input_return = None
         # Directives starting with '_' are protected commands.
         # Check to see if the directive is defined ...
-        if(directive[0:1] == '_'):
-            directive_words = directive[1:].split()
-            command = directive_words[0]
-            directive_args = directive_words[1:]
-            n_args = len(directive_args)
-            if(command == 'DIRNAME_LOCAL'):
-                if(n_args != 0):
-                    gbpBuild.log.error("Syntax error in directive {%s}; no arguments allowed." % (directive))
-                if(check):
-                    input_return = True
-                else:
-                    if(element is None):
-                        gbpBuild.log.error("No element passed to 'resolve_directive()'.")
-                    if(element.dir_host is not None):
-                        dir_path_out = self.template_path_out(element.dir_host)
-                    else:
-                        dir_path_out = self.dir_install
-                    dirname = os.path.basename(dir_path_out)
-                    input_return = {'name': '_DIRNAME_LOCAL', 'input': [dirname]}
-            elif(command == "PARAMETERS.key"):
-                if(n_args != 0):
-                    gbpBuild.log.error("Syntax error in directive {%s}; no arguments allowed." % (directive))
-                if(check):
-                    input_return = True
-                else:
-                    input_return = {'name': '_PARAMETERS.key', 'input': [key for key in self.params.keys()]}
-            elif(command == "PARAMETERS.value"):
-                if(n_args != 0):
-                    gbpBuild.log.error("Syntax error in directive {%s}; no arguments allowed." % (directive))
-                if(check):
-                    input_return = True
-                else:
-                    input_return = {'name': '_PARAMETERS.key', 'input': [key for key in self.params.values()]}
-            elif(command.startswith('DIRLIST')):
-                # The command can contain subdirectives, separated by underscores
-                # Parse this information to determine what sort of list we're making
-                command_words = command.split("_")
-                n_command_words = len(command_words)
-                if(n_command_words == 1):
-                    list_mode = 'all'
-                elif(n_command_words == 2):
-                    if(command_words[1] == 'DIRS'):
-                        list_mode = 'dirs'
-                    elif(command_words[1] == 'FILES'):
-                        list_mode = 'files'
-                    else:
-                        gbpBuild.log_error(
-                            "Invalid directive syntax {%s}; word {%s} invalid." %
-                            (line, command_words[1]))
-                else:
-                    gbpBuild.log_error("Invalid directive syntax {%s}; too many command words." % (line))
-                if(check):
-                    input_return = True
-                else:
-                    # Because we can't be sure that all the files are present
-                    # either in the full input or output path, we need to
-                    # generate the list from the elements in the template.  We
-                    # may also have some files/directories preexisting this
-                    # template run, and we want to add those as well, so we have
-                    # listings which actually represent the current state
-                    template_element_list = []
-                    dir_host = self.full_path_out(element.dir_host)
-                    listing_host = os.listdir(dir_host)
-                    if(list_mode == 'all' or list_mode == 'files'):
-                        for file_i in element.dir_host.files:
-                            template_element_list.append(os.path.basename(self.full_path_out(file_i)))
-                        for element_i in listing_host:
-                            if(os.path.isfile(element_i)):
-                                if(element_i not in template_element_list):
-                                    template_element_list.append(element_i)
-                    if(list_mode == 'all' or list_mode == 'dirs'):
-                        for dir_i in self.directories:
-                            dir_host_i = os.path.dirname(self.full_path_out(dir_i))
-                            if(dir_host == dir_host_i):
-                                template_element_list.append(os.path.basename(self.full_path_out(dir_i)))
-                            for element_i in listing_host:
-                                if (os.path.isdir(element_i)):
-                                    if (element_i not in template_element_list):
-                                        template_element_list.append(element_i)
-
-                    # Sort the element list
-                    template_element_list = sorted(template_element_list)
-
-                    if(n_args == 0):
-                        listing = template_element_list
-                    elif(n_args == 1):
-                        flag_keep_list = [False] * len(template_element_list)
-                        for wildcard in directive_args[0].split(','):
-                            # If wildcard is prepended with '!', treat it as a negation search
-                            if(wildcard[0:1] == '!'):
-                                wildcard = wildcard[1:]
-                                flag_wildcard = False
-                            else:
-                                flag_wildcard = True
-                            for i_file, file_i in enumerate(template_element_list):
-                                if(fnmatch.fnmatch(file_i, wildcard)):
-                                    flag_keep_list[i_file] = flag_wildcard
-                        listing = [file_i for (file_i, flag) in zip(template_element_list, flag_keep_list) if flag]
-                    else:
-                        gbpBuild.log.error("Syntax error in directive {%s}; too many arguments." % (directive))
-                    input_return = {'name': command, 'input': listing}
+        if(directive.is_command):
+            handler = directive_handlers.get(directive.command)
+            if(handler is None):
+                return None
+            if(check):
+                return handler.check(self, directive)
+            if(handler.cacheable):
+                self._check_caches()
+                key = (directive.text, None if element is None else element.dir_host)
+                input_return = self._directive_results.get(key)
+                if(input_return is None):
+                    handler.check(self, directive)
+                    input_return = {'name': directive.command, 'input': handler.resolve(self, element, directive)}
+                    self._directive_results[key] = input_return
+                return input_return
+            handler.check(self, directive)
+            return {'name': directive.command, 'input': handler.resolve(self, element, directive)}
 
         # ... else, look to see if it has been listed in the user parameters
+        if(directive.text not in self.params):
+            return None
+        if(check):
+            return True
+        param_value = self.params[directive.text]
+        if(hasattr(param_value, '__iter__') and not isinstance(param_value, str)):
+            return {'name': directive.text, 'input': param_value}
         else:
-            if(self.params):
-                for param_i_key, param_i_value in self.params.items():
-                    if(directive == param_i_key):
-                        if(check):
-                            input_return = True
-                        else:
-                            if(hasattr(param_i_value, '__iter__') and not isinstance(param_i_value, str)):
-                                input_return = {'name': param_i_key, 'input': param_i_value}
-                            else:
-                                input_return = {'name': param_i_key, 'input': [param_i_value]}
-                        break
-        return input_return
-
-    def _perform_parameter_substitution_ith(self, element, line, idx=None, delimiter="%%%"):
-        """
-
-        :param element:
-        :param line:
-        :param idx:
-        :param delimiter:
-        :return:
+            return {'name': directive.text, 'input': [param_value]}
+
+    def render_line(self, element, line):
+        """Perform parameter substitution on a compiled line.  Every reference
+        is resolved (and its values converted to strings) once, and the list
+        sizes are checked once.  If any references resolve to lists, then one
+        output string is generated per list item, in a single pass.  Values
+        which hold references of their own have them substituted in turn,
+        until none remain (lists among them must match the line's list size,
+        and the i'th output takes the i'th item).
+
+        :param element: The template element being rendered
+        :param line: template_line
+        :return: List of output strings
         """
-        if(delimiter is None):
-            delimiter = "%%%"
-        line_new = line
+        # Lines without parameter references are passed straight through
+        if(line.is_literal()):
+            return [line.literals[0]]
+
+        # Resolve all references, making sure that
+        # they all result in the same number of lines
+        inputs = []
         n_lines = -1
-        if(self.params is not None):
-            regex = re.compile("%s%s%s" % (delimiter, _regex_parameter_selector, delimiter))
-            match = regex.search(line_new)
-            while(match):
-                # Strip the delimiters from the match
-                #directive = match.group().strip(delimiter)
-                directive = match.group()
-                directive = directive[len(delimiter):len(directive) - len(delimiter)]
-                # First pass: check that input.size() is 1 or current size >1
-                param_insert = self.resolve_directive(element, directive)
-                if(param_insert is not None):
-                    replace_with = param_insert['input']
-                else:
-                    replace_with = [directive]
-                param_insert_size = len(replace_with)
-                # This is just to prevent an infinite loop.  Since
-                # param_insert_size==0, this line should be thrown
-                # away anyways ... but we want to make sure there
-                # are no errors, so we'll substitute this for just
-                # to keep things going.
-                if(param_insert_size == 0):
-                    replace_with = ["---"]
-                # Record n_lines this way to make sure that
-                # all parameter substitutions result in the
-                # same number of lines
-                if(n_lines < 0):
-                    n_lines = param_insert_size
-                elif(n_lines != param_insert_size):
+        for directive in line.directives:
+            param_insert = self.resolve_directive(element, directive)
+            if(param_insert is not None):
+                replace_with = param_insert['input']
+            else:
+                replace_with = [directive]
+            if(n_lines < 0):
+                n_lines = len(replace_with)
+            elif(n_lines != len(replace_with)):
+                gbpBuild.log.error(
+                    "There is an input list size incompatibility (%d!=%d) in {%s}." %
+                    (n_lines, len(replace_with), line))
+            inputs.append([str(value) for value in replace_with])
+        _count('directive_resolutions', len(inputs))
+        _count('substitutions', len(inputs) * n_lines)
+
+        # Assemble the output, one column of values at a time.  Empty lists result in no output.
+        literals = line.literals
+        if(len(inputs) == 1):
+            head, tail = literals
+            lines_out = [head + value + tail for value in inputs[0]]
+        else:
+            line_format = '%s'.join(literal.replace('%', '%%') for literal in literals)
+            lines_out = [line_format % values for values in zip(*inputs)]
+
+        # Substitute any references introduced by the values
+        if(any(line.delimiter in value for values in inputs for value in values)):
+            for i_line, line_out in enumerate(lines_out):
+                line_nested = template_line(line_out, delimiter=line.delimiter)
+                if(line_nested.is_literal()):
+                    continue
+                lines_nested = self.render_line(element, line_nested)
+                if(len(lines_nested) != n_lines):
                     gbpBuild.log.error(
                         "There is an input list size incompatibility (%d!=%d) in {%s}." %
-                        (n_lines, param_insert_size, line))
-                # Perform substitution
-                if(idx is None):
-                    line_new = line_new[0:match.start()] + str(replace_with[0]) + line_new[match.end():]
-                else:
-                    if(idx > len(replace_with)):
-                        gbpBuild.log_error(
-                            "Indexing error (%d>%d)for input line {%s}." %
-                            (idx, len(replace_with), line))
-                    line_new = line_new[0:match.start()] + str(replace_with[idx]) + line_new[match.end():]
-                match = regex.search(line_new)
-        # If n_lines<0, then no parameter substitution has occurred
-        # and we will just be returning the input line
-        if(n_lines < 0):
-            n_lines = 1
-        if(idx is None):
-            return n_lines, line_new
-        else:
-            return line_new
+                        (n_lines, len(lines_nested), line))
+                lines_out[i_line] = lines_nested[i_line]
+        return lines_out
 
     def perform_parameter_substitution(self, element, line):
         """
 
         :param element:
-        :param line:
+        :param line: String or template_line
         :return:
         """
-        # As a first attempt, assume all substitutions are of scalars.
-        # If in the course of trying to do this, >=1 substitution(s)
-        # is/are a list, then subsequently deal with that.  If the
-        # assumption is correct, we will have a string at the end
-        # that we can sue.
-        n_lines, line_new = self._perform_parameter_substitution_ith(element, line)
-
-        # If one of the parameters is iterable, we generate a set of lines instead.
-        lines_new = []
-        if(n_lines > 1):
-            for idx in range(n_lines):
-                lines_new.append(self._perform_parameter_substitution_ith(element, line, idx=idx))
-        elif(n_lines == 1):
-            lines_new.append(line_new)
-        return lines_new
+        if(not isinstance(line, template_line)):
+            line = template_line(line)
+        return self.render_line(element, line)
 
     def perform_parameter_substitution_filename(self, element, name_out=False):
         """
@@ -534,105 +3171,321 @@ class template:
         :return:
         """
         # Finally, perform substitution
-        if(name_out):
-            n_lines, filename_out = self._perform_parameter_substitution_ith(
-                element, element.name_out, delimiter="_var_")
-        else:
-            n_lines, filename_out = self._perform_parameter_substitution_ith(
-                element, element.name_in, delimiter="_var_")
+        filename_out = self.render_line(element, element.name_compiled(name_out=name_out))
 
         # Check that we haven't used an iterable for the substitution
-        if(n_lines != 1):
+        if(len(filename_out) != 1):
             gbpBuild.log.error(
                 "An invalid filename parameter substitution has occurred for {%s} (n_lines=%d)." %
-                (element.full_path_in(), n_lines))
+                (element.full_path_in(), len(filename_out)))
 
-        return filename_out
+        return filename_out[0]
 
     def _process_directory_recursive(
             self,
             full_path_template,
             full_path_recurse_start,
             template_path_start,
-            n_template_files):
-        """
+            n_template_files,
+            scanned=None,
+            archive=None,
+            walk_jobs=1):
+        """Add the elements of a template directory to the template, along
+        with those of the directories symlinked from it (unless they are
+        marked as links).  Each directory is listed once (see
+        template_entry.scan()) and elements are built from the listings.
+        Symlinked directories which lead back to a directory being walked are
+        reported as cycles.
+
+        Directories are listed before any elements are built, by a pool of
+        threads if walk_jobs>1 (which helps where each listing has a high
+        latency, as on network filesystems).  Elements are then built in the
+        same order however the directories were listed.
 
         :param full_path_template:
         :param full_path_recurse_start:
         :param template_path_start:
         :param n_template_files:
+        :param scanned: Optional list to which all elements found are appended, in the order they are added
+        :param archive: The template_archive holding the template (None if it is on the filesystem)
+        :param walk_jobs: Number of threads used to list directories (None: chosen by concurrent.futures)
         :return:
         """
-        # Parse the given template directory
-        for root, dirs, files in os.walk(full_path_recurse_start):
+        if(scanned is None):
+            scanned = []
+        source = _local_files if archive is None else archive
+        full_path_recurse_start = os.path.abspath(full_path_recurse_start)
+        identity_start = source.identity(full_path_recurse_start)
+        listings = self._list_directories(source, full_path_recurse_start, identity_start, walk_jobs)
+
+        # Directories being walked, keyed by identity (see _local_files.identity())
+        ancestors = {}
+
+        def walk(root, template_path_dir, identity, entry=None):
+            n_template_files = 0
+
+            # Ignore '__pycache__' directories that can get annoyingly created
+            # automatically when templates are installed by setuptools.
+            if(os.path.basename(root) == "__pycache__"):
+                return n_template_files
+
             # Create directory from directory name
-            full_path_element = os.path.abspath(root)
-            template_path_dir = os.path.normpath(
-                os.path.join(
-                    template_path_start,
-                    os.path.relpath(
-                        root,
-                        full_path_recurse_start)))
+            template_path_dir = os.path.normpath(template_path_dir)
             template_path_parent = os.path.dirname(template_path_dir)
             if(template_path_parent == ''):
                 template_path_parent = '.'
             dir_new = template_directory(
                 full_path_template,
-                full_path_element,
+                root,
                 template_path_dir,
-                self.get_directory(template_path_parent))
+                self.get_directory(template_path_parent),
+                archive=archive,
+                entry=entry)
+            scanned.append(dir_new)
+            self.add_directory(dir_new)
+
+            # Symlinks to directories are dealt with as they are found; other
+            # directories are walked after the files of this one are added
+            ancestors[identity] = root
+            entries_dir = []
+            entries_file = []
+            listing = listings.get(root)
+            if(listing is None):
+                listing = template_entry.scan(source, root)
+            for entry_i in listing:
+                if(not entry_i.is_dir):
+                    entries_file.append(entry_i)
+                elif(not entry_i.is_symlink):
+                    entries_dir.append(entry_i)
+                elif(entry_i.name != "__pycache__"):
+                    # Sort-out some paths for the link
+                    full_path_element = os.path.abspath(os.path.join(root, entry_i.target))
+                    template_path_element = os.path.join(template_path_dir, entry_i.name)
+                    template_path_parent = os.path.dirname(template_path_element)
+                    # Process paths underneath sym-linked template directories
+                    # if they are not marked as being links
+                    dir_link = template_directory(
+                        full_path_template,
+                        full_path_element,
+                        template_path_element,
+                        self.get_directory(template_path_parent),
+                        archive=archive)
+                    if(not dir_link.is_link):
+                        if(entry_i.identity in ancestors):
+                            raise OSError(errno.ELOOP, "Symlinked template directory {%s} leads back to {%s}." % (
+                                entry_i.path, ancestors[entry_i.identity]), entry_i.path)
+                        n_template_files += walk(full_path_element, template_path_element, entry_i.identity)
+                    # ...else, just add the path
+                    else:
+                        scanned.append(dir_link)
+                        self.add_directory(dir_link)
+
+            # Add files
+            for entry_i in entries_file:
+                template_path = os.path.normpath(os.path.join(template_path_dir, entry_i.name))
+                file_new = template_file(full_path_template, entry_i.path, template_path, dir_new,
+                                         archive=archive, entry=entry_i)
+                if(file_new.is_template):
+                    n_template_files += 1
+                scanned.append(file_new)
+                self.add_file(file_new)
+
+            # Walk sub-directories
+            for entry_i in entries_dir:
+                n_template_files += walk(entry_i.path, os.path.join(template_path_dir, entry_i.name),
+                                         source.identity(entry_i.path, entry=entry_i, parent=identity), entry=entry_i)
+            del ancestors[identity]
+            return n_template_files
+
+        n_template_files += walk(full_path_recurse_start, template_path_start, identity_start)
+        return(n_template_files)
 
-            # Ignore '__pycache__' directories that can get annoyingly created
-            # automatically when templates are installed by setuptools.
-            if(os.path.basename(full_path_element) != "__pycache__"):
-                # Add directory to the list
+    @staticmethod
+    def _list_directories(source, full_path_start, identity_start, walk_jobs=1):
+        """List every directory of a template tree, including those of the
+        directories symlinked from it which are not marked as links.  Listings
+        are made by a pool of threads if walk_jobs>1, each directory being
+        submitted as soon as the listing of its parent is complete.
+
+        :param source: _local_files or template_archive
+        :param full_path_start: Full path of the directory to start from
+        :param identity_start: Identity of the directory to start from (see _local_files.identity())
+        :param walk_jobs: Number of threads to use (None: chosen by concurrent.futures)
+        :return: Dictionary of lists of template_entry objects, keyed by directory path
+        """
+        listings = {}
+
+        # Directories to list, with the identities of the directories leading to them (so that cycles are not followed)
+        pending = [(full_path_start, (identity_start,))]
+        requested = {full_path_start}
+
+        def children(path, chain, listing):
+            for entry in listing:
+                if(not entry.is_dir or entry.name == "__pycache__"):
+                    continue
+                if(not entry.is_symlink):
+                    path_child = entry.path
+                    identity = source.identity(path_child, entry=entry, parent=chain[-1])
+                else:
+                    _, is_link = check_and_remove_trailing_occurrence(entry.name.replace("_dot_", ".", 1), '.link')
+                    if(is_link or entry.identity is None or entry.identity in chain):
+                        continue
+                    path_child = os.path.abspath(os.path.join(path, entry.target))
+                    identity = entry.identity
+                if(path_child not in requested):
+                    requested.add(path_child)
+                    yield path_child, chain + (identity,)
+
+        if(walk_jobs == 1 or source is not _local_files):
+            while(pending):
+                path, chain = pending.pop()
+                listings[path] = template_entry.scan(source, path)
+                pending.extend(children(path, chain, listings[path]))
+            return listings
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=walk_jobs) as executor:
+            futures = {executor.submit(template_entry.scan, source, path): (path, chain) for path, chain in pending}
+            while(futures):
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path, chain = futures.pop(future)
+                    listings[path] = future.result()
+                    for path_child, chain_child in children(path, chain, listings[path]):
+                        futures[executor.submit(template_entry.scan, source, path_child)] = (path_child, chain_child)
+        return listings
+
+    def _process_path(self, full_path_template, template_path_element, scanned=None, archive=None, walk_jobs=1):
+        """Add the elements of a template leading to a single element, given
+        by its template path (input or output; see find_element()).  Only the
+        directories on the way to the element are listed, so that the cost is
+        set by the depth of the element rather than the size of the template.
+        If the element is a directory, everything under it is added (see
+        _process_directory_recursive()).  If it is a file whose rendering
+        lists its directory (see _lists_directory()), the rest of that
+        directory's elements are added as well, without walking any of its
+        sub-directories.
+
+        Names are matched by input name first.  Output names can only be
+        matched once the parameters they reference are known; if they are not
+        (or if the template has no such element), nothing is added.
+
+        :param full_path_template: Full path of the root of the template
+        :param template_path_element: Template path of the element
+        :param scanned: Optional list to which all elements found are appended, in the order they are added
+        :param archive: The template_archive holding the template (None if it is on the filesystem)
+        :param walk_jobs: Number of threads used to list directories, if the element is a directory
+        :return: Tuple of the number of template files and the list of the elements needed: those
+            leading to the element, and the element (with everything under it).  None if the
+            element could not be found.
+        """
+        if(scanned is None):
+            scanned = []
+        source = _local_files if archive is None else archive
+
+        def register(element_new):
+            scanned.append(element_new)
+            if(element_new.is_directory):
+                self.add_directory(element_new)
+                return self.get_directory(element_new.template_path_in())
+            self.add_file(element_new)
+            return self.get_file(element_new.template_path_in())
+
+        def from_entry(full_path_dir, template_path_dir, entry, dir_host):
+            template_path = os.path.normpath(os.path.join(template_path_dir, entry.name))
+            if(not entry.is_dir):
+                return template_file(full_path_template, entry.path, template_path, dir_host, archive=archive,
+                                     entry=entry)
+            elif(entry.is_symlink):
+                return template_directory(full_path_template,
+                                          os.path.abspath(os.path.join(full_path_dir, entry.target)),
+                                          template_path, dir_host, archive=archive)
+            return template_directory(full_path_template, entry.path, template_path, dir_host, archive=archive,
+                                      entry=entry)
+
+        def is_resolved(element):
+            return all(self.resolve_directive(None, directive, check=True)
+                       for directive in element.name_compiled().directives)
+
+        # Find the elements leading to the element, before adding any of them
+        root = template_directory(full_path_template, full_path_template, '.', None, archive=archive)
+        path_found = []
+        dir_host = root
+        components = [name for name in os.path.normpath(template_path_element).split(os.sep) if name not in ('', '.')]
+        for i_component, component in enumerate(components):
+            listing = [entry for entry in template_entry.scan(source, dir_host.full_path_in())
+                       if entry.name != "__pycache__"]
+            elements = [from_entry(dir_host.full_path_in(), dir_host.template_path_in(), entry_i, dir_host)
+                        for entry_i in listing]
+            element_new = next((element_i for element_i in elements if element_i.name_in == component), None)
+            if(element_new is None):
+                if(not all(is_resolved(element_i) for element_i in elements)):
+                    return None
+                element_new = next((element_i for element_i in elements
+                                    if component in self.render_line(element_i, element_i.name_compiled())), None)
+            flag_last = (i_component == len(components) - 1)
+            if(element_new is None or (not flag_last and (element_new.is_file or element_new.is_link))):
+                return None
+            path_found.append((element_new, elements))
+            dir_host = element_new
+
+        # Directories leading to the element
+        needed = [register(root)]
+        for element_i, _ in path_found[:-1]:
+            element_i.dir_host = needed[-1]
+            needed.append(register(element_i))
+        if(len(path_found) == 0):
+            return 0, needed
+        element_new, elements = path_found[-1]
+        element_new.dir_host = needed[-1]
+
+        # A directory, with everything under it
+        if(element_new.is_directory and not element_new.is_link):
+            scanned_dir = []
+            n_template_files = self._process_directory_recursive(
+                full_path_template, element_new.full_path_in(), element_new.template_path_in(), 0,
+                scanned=scanned_dir, archive=archive, walk_jobs=walk_jobs)
+            scanned.extend(scanned_dir)
+            needed.extend(self.get_directory(element_i.template_path_in()) if element_i.is_directory else
+                          self.get_file(element_i.template_path_in()) for element_i in scanned_dir)
+            return n_template_files, needed
+
+        # A file (or a link); its directory's listing is only needed if its rendering lists it
+        element_new = register(element_new)
+        needed.append(element_new)
+        if(element_new.is_file and self._lists_directory(element_new)):
+            for element_i in elements:
+                if(self.get_file(element_i.template_path_in()) is None):
+                    element_i.dir_host = needed[-2]
+                    register(element_i)
+        return int(element_new.is_file and element_new.is_template), needed
+
+    def _restore_scan(self, records):
+        """Add the elements of a cached template scan (see template_scan_cache)
+        to the template, in the same way as _process_directory_recursive().
+
+        :param records: List of element records
+        :return: Tuple of the number of template files and the list of elements added
+        """
+        n_template_files = 0
+        scanned = []
+        directories = {}
+        for record in records:
+            if(record['is_directory']):
+                if(record['dir_host'] is None):
+                    dir_host = None
+                else:
+                    dir_host = self.get_directory(record['dir_host'])
+                dir_new = template_directory.from_record(record, dir_host)
+                directories[dir_new.template_path_in()] = dir_new
+                scanned.append(dir_new)
                 self.add_directory(dir_new)
-
-                # Check for symlinks to directories.  This is necessary
-                # because os.walk() does not list symlinks to directories (by default)
-                # and it is less work (I think) to look for them manually then to
-                # walk the tree with them and weed-out everything under
-                # them which we may not (often don't) want to consider at all.
-                for test_dir_i in os.listdir(root):
-                    # Ignore '__pycache__' directories that can get annoyingly created
-                    # automatically when templates are installed by setuptools.
-                    if(os.path.basename(test_dir_i) != "__pycache__"):
-                        full_path_element = os.path.join(dir_new.full_path_in(), test_dir_i)
-                        if(os.path.islink(full_path_element) and os.path.isdir(full_path_element)):
-                            # Sort-out some paths for the link
-                            full_path_element = os.path.abspath(os.path.join(root, os.readlink(full_path_element)))
-                            template_path_element = os.path.join(template_path_dir, test_dir_i)
-                            template_path_parent = os.path.dirname(template_path_element)
-                            # Process paths underneath sym-linked template directories
-                            # if they are not marked as being links
-                            dir_link = template_directory(
-                                full_path_template,
-                                full_path_element,
-                                template_path_element,
-                                self.get_directory(template_path_parent))
-                            if(not dir_link.is_link):
-                                n_template_files = self._process_directory_recursive(
-                                    full_path_template, full_path_element, template_path_element, n_template_files)
-                            # ...else, just add the path
-                            else:
-                                self.add_directory(dir_link)
-
-                # Add files
-                for file_i in files:
-                    template_path = os.path.normpath(
-                        os.path.join(
-                            template_path_start,
-                            os.path.relpath(
-                                root,
-                                full_path_recurse_start),
-                            file_i))
-                    full_path_element = os.path.join(root, file_i)
-                    file_new = template_file(full_path_template, full_path_element, template_path, dir_new)
-                    if(file_new.is_template):
-                        n_template_files += 1
-                    self.add_file(file_new)
-
-        return(n_template_files)
+            else:
+                file_new = template_file.from_record(record, directories[record['dir_host']])
+                if(file_new.is_template):
+                    n_template_files += 1
+                scanned.append(file_new)
+                self.add_file(file_new)
+        return n_template_files, scanned
 
     def _build_path_list(self, path=None):
         """
@@ -653,58 +3506,135 @@ class template:
 
         return(path_list)
 
-    def add(self, template_name, path=None):
-        """
+    def add(self, template_name, path=None, use_cache=True, scan_jobs=None, walk_jobs=1, element=None):
+        """Add a template, found in the given path.  Templates can be either
+        directories or archives (see template_archive), which are found with
+        or without their extensions.  Archives are read in place; their scans
+        are not cached.
+
+        If an element is given, the template is loaded lazily: only the
+        directories leading to the element are listed and only the element
+        (with everything under it, if it is a directory) is scanned for
+        parameters (see _process_path()).  Lazy scans are not cached.  The
+        whole template is loaded if the element can not be found this way
+        (if its output path references parameters which are not known yet,
+        for example).
 
         :param template_name:
         :param path:
+        :param use_cache: Bool indicating if the on-disk scan cache (see template_scan_cache) should be used
+        :param scan_jobs: Number of threads used to read template files (default: chosen by concurrent.futures)
+        :param walk_jobs: Number of threads used to list the template's directories (None: chosen by
+            concurrent.futures; worthwhile for templates on network filesystems)
+        :param element: Template path (input or output; see find_element()) of the only element needed
         :return:
         """
-        # Build a list of priority-ordered paths to search
-        path_list = self._build_path_list(path)
-
-        # Search the path
-        template_dir_abs = None
-        for path_i in path_list:
-            dir_test = os.path.join(path_i, template_name)
-            if(os.path.isdir(dir_test)):
-                template_dir_abs = dir_test
-                break
-
-        # Raise an exception if the template was not in the path
-        if(not template_dir_abs):
-            raise IsADirectoryError("Could not find template '%s' in template path {%s}" % (template_name, path))
-
-        # template_name may have path information. Clean that up.
-        template_path_dir, template_name = os.path.split(template_dir_abs)
-
-        # Proceed with template construction
-        self.path.append(template_path_dir)
-        self.dir.append(template_dir_abs)
-        self.name.append(template_name)
-
-        # Walk the template directory structure, recursively processing sym-linked directories
-        gbpBuild.log.open("Loading template {'%s' from %s}..." % (self.name[-1], self.path[-1]))
-        n_template_files = self._process_directory_recursive(self.dir[-1], self.dir[-1], '.', 0)
-
-        # Search all files to generate a list of needed parameters
-        self.params_list = set()
-        if(n_template_files > 0):
-            gbpBuild.log.open("Scanning template files for parameters...")
-            for dir_i in self.directories:
-                self.collect_parameter_references(dir_i.full_path_in(), delimiter="_var_")
-                for file_i in [f for f in dir_i.files if(f.is_template)]:
-                    self.collect_parameter_references(file_i.full_path_in(), delimiter="_var_")
-                    if(file_i.is_template):
-                        with open(file_i.full_path_in(), 'r') as file_in:
-                            for line in file_in:
-                                self.collect_parameter_references(line, delimiter="%%%")
-            gbpBuild.log.close("Done")
-
-        # Print the contents of the template
-        gbpBuild.log.comment(self)
-
-        gbpBuild.log.close("Done")
+        self.counters = template_counters()
+        with self.counters:
+            # Build a list of priority-ordered paths to search
+            path_list = self._build_path_list(path)
+
+            # Search the path
+            template_dir_abs = None
+            archive = None
+            for path_i in path_list:
+                dir_test = os.path.join(path_i, template_name)
+                _count('stat_calls')
+                if(os.path.isdir(dir_test)):
+                    template_dir_abs = dir_test
+                    break
+                archive_test = find_archive(dir_test)
+                if(archive_test is not None):
+                    archive = template_archive(archive_test)
+                    template_dir_abs = archive.path
+                    break
+
+            # Raise an exception if the template was not in the path
+            if(not template_dir_abs):
+                raise IsADirectoryError("Could not find template '%s' in template path {%s}" % (template_name, path))
+
+            # template_name may have path information. Clean that up.
+            template_path_dir, template_name = os.path.split(template_dir_abs)
+            if(archive is not None):
+                template_name = get_archive_name(template_name)
+                use_cache = False
+            if(element is not None):
+                use_cache = False
+
+            # Proceed with template construction
+            self.path.append(template_path_dir)
+            self.dir.append(template_dir_abs)
+            self.name.append(template_name)
+
+            # Walk the template directory structure, recursively processing sym-linked directories
+            gbpBuild.log.open("Loading template {'%s' from %s}..." % (self.name[-1], self.path[-1]))
+            scan_cache = template_scan_cache(self.dir[-1]) if use_cache else None
+            records = scan_cache.load() if use_cache else None
+            if(records is not None):
+                gbpBuild.log.comment("Using cached scan of template.")
+                n_template_files, scanned = self._restore_scan(records)
+            else:
+                scanned = []
+                if(archive is None):
+                    full_path_root = self.dir[-1]
+                else:
+                    full_path_root = archive.root
+                result = None
+                if(element is not None):
+                    result = self._process_path(
+                        full_path_root, element, scanned=scanned, archive=archive, walk_jobs=walk_jobs)
+                    if(result is None):
+                        gbpBuild.log.comment("Element {%s} not found lazily; loading the whole template." % (element))
+                        element = None
+                if(result is None):
+                    n_template_files = self._process_directory_recursive(
+                        full_path_root, full_path_root, '.', 0, scanned=scanned, archive=archive, walk_jobs=walk_jobs)
+                else:
+                    n_template_files, needed = result
+            if(element is None):
+                self._elements_needed = None
+            elif(self._elements_needed is not None):
+                self._elements_needed.extend(needed)
+
+            # Search all files (or just those needed, for lazily loaded templates) for the parameters needed
+            self.params_list = set()
+            if(n_template_files > 0):
+                gbpBuild.log.open("Scanning template files for parameters...")
+                if(self._elements_needed is None):
+                    elements = [element_i for dir_i in self.directories for element_i in [dir_i] + dir_i.files]
+                else:
+                    elements = self._elements_needed
+                directives = set()
+                files_template = []
+                for element_i in elements:
+                    if(element_i.is_directory or element_i.is_template):
+                        directives.update(template_line(element_i.full_path_in(), delimiter="_var_").directives)
+                    if(element_i.is_file and element_i.is_template):
+                        files_template.append(element_i)
+
+                # Template files are compiled once, here, and reused for every install
+                files_compile = [file_i for file_i in files_template if file_i.lines is None]
+                if(len(files_compile) > 1 and scan_jobs != 1):
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=scan_jobs) as executor:
+                        list(executor.map(template_file.compile, files_compile))
+                for file_i in files_template:
+                    for line in file_i.compile():
+                        directives.update(line.directives)
+
+                # Each distinct reference is only checked once
+                for directive in directives:
+                    if(not self.resolve_directive(None, directive, check=True)):
+                        self.params_list.add(directive)
+                gbpBuild.log.close("Done")
+
+            # Cache the scan (including the compiled template files) for next time
+            if(use_cache and records is None):
+                scan_cache.save(scanned)
+
+            # Print the contents of the template
+            gbpBuild.log.comment(self)
+
+            gbpBuild.log.close("Done (%s)" % (self.counters))
 
     def update_element(self, element, update):
         """
@@ -739,10 +3669,7 @@ class template:
         :param template_path_in:
         :return:
         """
-        for dir_i in self.directories:
-            if(dir_i.template_path_in() == template_path_in):
-                return dir_i
-        return None
+        return self._directory_index.get(template_path_in)
 
     def get_file(self, template_path_in):
         """
@@ -750,11 +3677,26 @@ class template:
         :param template_path_in:
         :return:
         """
-        for dir_i in self.directories:
-            for file_i in dir_i.files:
-                if(file_i.template_path_in() == template_path_in):
-                    return file_i
-        return None
+        return self._file_index.get(template_path_in)
+
+    def find_element(self, template_path):
+        """Find an element of the template by its template path, given either
+        as input (e.g. '_dot_project.json.template') or as output (e.g.
+        '.project.json', with the current parameters; see template_path_out()).
+
+        :param template_path: Template path
+        :return: template_file or template_directory (None if the template has no such element)
+        """
+        template_path = os.path.normpath(template_path)
+        element = self.get_file(template_path)
+        if(element is None):
+            element = self.get_directory(template_path)
+        if(element is None):
+            for dir_i in self.directories:
+                for element_i in [dir_i] + dir_i.files:
+                    if(self.template_path_out(element_i) == template_path):
+                        return element_i
+        return element
 
     def add_directory(self, dir_add):
         """
@@ -765,6 +3707,7 @@ class template:
         dir_check = self.get_directory(dir_add.template_path_in())
         if(dir_check is None):
             self.directories.append(dir_add)
+            self._directory_index[dir_add.template_path_in()] = dir_add
 
     def add_file(self, file_add):
         """
@@ -787,6 +3730,9 @@ class template:
             dir_out = file_add.dir_host
         else:
             dir_out = dir_check
+            # Make sure that files layered onto an existing
+            # directory are hosted by the registered instance
+            file_add.dir_host = dir_out
 
         # Check if this file already exists
         file_check = self.get_file(file_add.template_path_in())
@@ -794,10 +3740,11 @@ class template:
         # If not, append it to its directory's list
         if(file_check is None):
             dir_out.files.append(file_add)
+            self._file_index[file_add.template_path_in()] = file_add
 
         # ... else, check for conflicts
         else:
-            if(not filecmp.cmp(file_add.full_path_in(), file_check.full_path_in())):
+            if(not file_add.same_contents(file_check)):
                 gbpBuild.log.error(
                     "There is a file incompatibility between template files '%s' and '%s'." %
                     (file_add.template_path_in(), file_check.template_path_in()))
@@ -813,18 +3760,85 @@ class template:
             n_files += len(dir_i.files)
         return n_files
 
+    def directory_listing(self, directory):
+        """Return the listing of the output directory of a template directory:
+        the output names of the template elements it hosts, along with anything
+        already present on disk.  Listings are built once per install, from the
+        template model and a single scan of the output directory.
+
+        :param directory: template_directory
+        :return: Tuple of sorted lists of file names and directory names
+        """
+        self._check_caches()
+        listing = self._listings.get(directory)
+        if(listing is None):
+            # Index the template's directories by the output path of their parent (once per install)
+            if(self._subdirectories_out is None):
+                subdirectories_out = {}
+                for dir_i in self.directories:
+                    path_out = self.full_path_out(dir_i)
+                    subdirectories_out.setdefault(os.path.dirname(path_out), []).append(os.path.basename(path_out))
+                self._subdirectories_out = subdirectories_out
+
+            # The install's own records (manifest and journal) are left out of the install root's listing
+            path_out = self.full_path_out(directory)
+            files = set(os.path.basename(self.full_path_out(file_i)) for file_i in directory.files)
+            dirs = set(self._subdirectories_out.get(path_out, []))
+            is_install_root = os.path.normpath(path_out) == os.path.normpath(self.dir_install)
+            for name, (is_dir, is_file, is_symlink) in (self.output_tree().listing(path_out) or {}).items():
+                if(os.path.join(path_out, name) in self._paths_removed):
+                    continue
+                elif(is_install_root and name in (template_manifest.filename, template_journal.dirname)):
+                    continue
+                elif(is_file):
+                    files.add(name)
+                elif(is_dir):
+                    dirs.add(name)
+            listing = (sorted(files), sorted(dirs))
+            self._listings[directory] = listing
+        return listing
+
+    def output_tree(self):
+        """Return the snapshot of the output directories of the current
+        install (see template_output_tree), which is taken afresh for each
+        install.
+
+        :return: template_output_tree
+        """
+        self._check_caches()
+        if(self._output_tree is None):
+            self._output_tree = template_output_tree()
+        return self._output_tree
+
+    def _check_caches(self, check_values=False):
+        """Clear the output path and directive caches if the parameters have
+        changed since they were filled.  Changes made in place to mutable
+        parameter values are only looked for if asked to, as each install
+        (or other use of the template's output paths) starts.
+
+        :param check_values: Bool indicating that parameter values should be checked for changes made in place
+        :return: None
+        """
+        n_changes = self.params.changes(check_values=check_values)
+        if(self._paths_out_n_changes != n_changes):
+            self._template_paths_out.clear()
+            self._full_paths_out.clear()
+            self._clear_install_caches()
+            self._paths_out_n_changes = self.params.changes(check_values=True)
+
     def full_path_out(self, element):
         """
 
         :param element:
         :return:
         """
-        if (element.dir_host is None):
-            dir_host = self.dir_install
-        else:
-            dir_host = self.full_path_out(element.dir_host)
-        name_out = self.perform_parameter_substitution_filename(element, name_out=True)
-        return os.path.normpath(os.path.abspath(os.path.join(dir_host, name_out)))
+        self._check_caches()
+        full_path_out = self._full_paths_out.get(element)
+        if(full_path_out is None):
+            full_path_out = os.path.normpath(
+                os.path.abspath(os.path.join(self.dir_install, self.template_path_out(element))))
+            self._full_paths_out[element] = full_path_out
+        return full_path_out
 
     def template_path_out(self, element):
         """
@@ -832,37 +3846,106 @@ class template:
         :param element:
         :return:
         """
-        if (element.dir_host is None):
-            dir_host = "."
-        else:
-            dir_host = self.template_path_out(element.dir_host)
-        name_out = self.perform_parameter_substitution_filename(element, name_out=True)
-        return os.path.normpath(os.path.join(dir_host, name_out))
-
-    def write_with_substitution(self, file_in):
+        self._check_caches()
+        template_path_out = self._template_paths_out.get(element)
+        if(template_path_out is None):
+            if (element.dir_host is None):
+                dir_host = "."
+            else:
+                dir_host = self.template_path_out(element.dir_host)
+            name_out = self.perform_parameter_substitution_filename(element, name_out=True)
+            template_path_out = os.path.normpath(os.path.join(dir_host, name_out))
+            self._template_paths_out[element] = template_path_out
+        return template_path_out
+
+    def parameter_digest(self, file_in):
+        """Compute a digest of the values of all the parameters and directives
+        referenced by the contents of a file.
+
+        :param file_in: template_file
+        :return: Hexadecimal digest string
+        """
+        directives = []
+        if(file_in.is_template):
+            for line in file_in.compile():
+                directives.extend(line.directives)
+
+        # Resolve the references, along with any held by their values (see render_line())
+        resolved = {}
+        while(directives):
+            directive = directives.pop()
+            if(directive in resolved):
+                continue
+            resolved[directive] = self.resolve_directive(file_in, directive)
+            if(resolved[directive] is not None):
+                for value in resolved[directive]['input']:
+                    if("%%%" in str(value)):
+                        directives.extend(template_line(str(value)).directives)
+        digest = hashlib.sha256()
+        for directive in sorted(resolved):
+            digest.update(repr((directive, resolved[directive])).encode('utf-8'))
+        _count('directive_resolutions', len(resolved))
+        return digest.hexdigest()
+
+    def _is_current(self, file_install):
+        """Check if the installed copy of a file is recorded in the manifest
+        as being rendered from the current template source and parameters,
+        and has not been edited since.
+
+        :param file_install: template_file
+        :return: Bool
+        """
+        if(self.manifest is None):
+            return False
+        return self.manifest.is_current(
+            self.template_path_out(file_install),
+            self.full_path_out(file_install),
+            file_install.digest(),
+            self.parameter_digest(file_install))
+
+    def render(self, file_in):
+        """Render the contents of a template file.
+
+        :param file_in: template_file
+        :return: string
         """
+        _count('files_rendered')
+        chunks = []
+        for line_in in file_in.compile():
+            if(line_in.is_literal()):
+                chunks.append(line_in.literals[0])
+            else:
+                chunks.extend(self.render_line(file_in, line_in))
+        return ''.join(chunks)
 
-        :param file_in:
-        :return:
+    def render_element(self, dir_out, template_path):
+        """Render a single file of the template, as an install to a given
+        directory would.  Nothing is written.
+
+        :param dir_out: Output template directory
+        :param template_path: Template path (input or output; see find_element()) of the file
+        :return: Rendered contents, as bytes (None if the template has no such file)
         """
-        if(not file_in.is_file):
-            gbpBuild.log.error(
-                "Something other than a file {%s} has been passed to the 'write_with_substitution' template method." %
-                (self.name_in))
+        self._check_caches(check_values=True)
+        file_in = self.find_element(template_path)
+        if(file_in is None or not file_in.is_file):
+            return None
+        self.dir_install = dir_out
         try:
-            if(file_in.is_link):
-                os.symlink(os.path.relpath(self.full_path_in(file_in), os.path.dirname(self.full_path_out(file_in))),
-                           self.full_path_out(file_in))
-            elif(file_in.is_template):
-                with open(file_in.full_path_in(), "r") as fp_in:
-                    with open(self.full_path_out(file_in), "w") as fp_out:
-                        for line_in in fp_in:
-                            for line_out in self.perform_parameter_substitution(file_in, line_in):
-                                fp_out.write(line_out)
-            else:
-                shutil.copy2(file_in.full_path_in(), self.full_path_out(file_in))
-        except BaseException:
-            gbpBuild.log.error("Failed write template file {%s}." % (element.template_path_in()))
+            if(file_in.is_template):
+                return self.render(file_in).encode(locale.getpreferredencoding(False))
+            return file_in.read()
+        finally:
+            self.dir_install = "."
+
+    def _render_copy_mode(self):
+        """Return how renders are copied from the cache (see
+        template_render_cache): as non-template files are, except that they
+        are never hard linked.
+
+        :return: Copy mode
+        """
+        return 'reflink' if self.copy_mode == 'hardlink' else self.copy_mode
 
     def __str__(self):
         """Generate a string representation of the template.
@@ -884,7 +3967,7 @@ class template:
         return result
 
     # Install or uninstall a template
-    def _process_template(self, params=None, uninstall=False, silent=False, update=None, force=False):
+    def _process_template(self, params=None, uninstall=False, silent=False, update=None, force=False, jobs=1):
         """
 
         :param params:
@@ -892,220 +3975,497 @@ class template:
         :param silent:
         :param update:
         :param force:
-        :return:
+        :param jobs: Number of workers to use for writing files
+        :return: template_plan
         """
+        # Directive results and directory listings are only reused within an install
+        self._clear_install_caches()
+
         name_txt = format_template_names(self.name)
         if (not uninstall):
             if(len(self.name) > 1):
                 gbpBuild.log.open("Installing templates {%s} to {%s}..." % (name_txt, self.dir_install))
             else:
                 gbpBuild.log.open("Installing template {%s} to {%s}..." % (name_txt, self.dir_install))
-            flag_reverse_sort = False
         else:
-            flag_reverse_sort = True
             if(len(self.name) > 1):
                 gbpBuild.log.open("Uninstalling templates {%s} from {%s}..." % (name_txt, self.dir_install))
             else:
                 gbpBuild.log.open("Uninstalling template {%s} from {%s}..." % (name_txt, self.dir_install))
 
+        # Reverse anything left by an interrupted install before deciding what to do
+        if(not silent and self._recover()):
+            gbpBuild.log.comment("Reverted an interrupted install.")
+
+        # Decide everything that needs to be done, then do it (unless this is a dry run)
+        plan = self._build_plan(uninstall=uninstall, update=update, force=force)
+        self._execute_plan(plan, silent=silent, jobs=jobs)
+
+        gbpBuild.log.close("Done (%s)." % (self.counters))
+        return plan
+
+    def _recover(self):
+        """Reverse the operations of an interrupted install to the current
+        install directory, if its journal remains.
+
+        :return: Bool indicating if there was an interrupted install
+        """
+        journal = template_journal(self.dir_install)
+        if(not journal.exists()):
+            return False
+        journal.rollback()
+        return True
+
+    def _build_plan(self, uninstall=False, update=None, force=False):
+        """Build the plan of an install (or uninstall) of the template to
+        the current install directory.
+
+        :param uninstall:
+        :param update:
+        :param force:
+        :return: template_plan
+        """
+        plan = template_plan(self.dir_install)
+
         # Process directories in sorted order to ensure that
         # the sub-directory structure is respected
-        for dir_i in sorted(self.directories, key=lambda k: len(self.full_path_out(k)), reverse=flag_reverse_sort):
+        directories = sorted(self.directories, key=lambda k: len(self.full_path_out(k)), reverse=uninstall)
+        for dir_i in directories:
             # Note the different ordering of directory processing
             # vs. file processing between install/uninstall cases
             self.current_element = dir_i
-            if (not uninstall and self.update_element(dir_i, update)):
-                self.install_directory(dir_i, silent=silent, force=force)
-            elif(self.update_element(dir_i, update)):
-                gbpBuild.log.open("Uninstalling directory %s..." % (self.full_path_out(dir_i)))
+            flag_update_dir = self.update_element(dir_i, update)
+            if (not uninstall and flag_update_dir):
+                self._plan_install_directory(plan, dir_i)
+            elif(flag_update_dir):
+                plan.add('open', "Uninstalling directory %s..." % (self.full_path_out(dir_i)))
 
             for file_i in dir_i.files:
                 self.current_element = file_i
                 if(uninstall and self.update_element(file_i, update)):
-                    self.uninstall_file(file_i, silent=silent)
+                    self._plan_uninstall_file(plan, file_i)
                 elif(self.update_element(file_i, update)):
-                    self.install_file(file_i, silent=silent, force=force)
+                    self._plan_install_file(plan, file_i, force=force)
 
             self.current_element = dir_i
-            if(uninstall and self.update_element(dir_i, update)):
-                self.uninstall_directory(dir_i, silent=silent)
-            elif(self.update_element(dir_i, update)):
-                gbpBuild.log.close()
+            if(uninstall and flag_update_dir):
+                self._plan_uninstall_directory(plan, dir_i)
+            elif(flag_update_dir):
+                plan.add('close')
 
-        gbpBuild.log.close("Done.")
+        return plan
 
-    def install_directory(self, directory, silent=False, force=None):
+    def _execute_plan(self, plan, silent=False, jobs=1, use_journal=True):
+        """Perform a plan (unless this is a dry run) and report it.
+
+        :param plan: template_plan
+        :param silent: Bool indicating if this is a dry run
+        :param jobs: Number of workers to use for writing files
+        :param use_journal: Bool indicating that the plan should be journaled (see template_plan.execute())
+        :return: None
+        """
+        if(not silent):
+            try:
+                plan.execute(jobs=jobs, manifest=self.manifest, output_tree=self._output_tree, use_journal=use_journal)
+            except template_plan.execution_error as error:
+                if(use_journal):
+                    gbpBuild.log.error("%s; all changes have been reverted." % (error))
+                else:
+                    gbpBuild.log.error("%s." % (error))
+        plan.report(silent=silent)
+
+    def plan(self, dir_out, params_raw=None, uninstall=False, update=None, force=False, copy_mode='copy'):
+        """Build the plan of an install (or uninstall) of the template,
+        without altering the filesystem.  The plan can be executed (see
+        template_plan.execute()) or written to a file to be executed later.
+        If an interrupted install remains in the output directory, the plan
+        is built for the directory as it will be once that install has been
+        reversed, which template_plan.execute() does first.
+
+        :param dir_out: Output template directory
+        :param params_raw: Raw (unprocessed) list of input parameters
+        :param uninstall: Bool indicating that the plan is for an uninstall
+        :param update: String specifying a specific element to update
+        :param force: Bool indicating that existing files should be overwritten
+        :param copy_mode: How non-template files are copied (one of 'copy', 'reflink' or 'hardlink')
+        :return: template_plan
+        """
+        self.dir_install = dir_out
+        self._check_caches(check_values=True)
+        self.copy_mode = copy_mode
+        self.validate_parameters(params_raw)
+        self.manifest = template_manifest(dir_out)
+        self._clear_install_caches()
+        try:
+            journal = template_journal(dir_out)
+            if(journal.exists()):
+                self.output_tree().revert(journal.read())
+            plan = self._build_plan(uninstall=uninstall, update=update, force=force)
+        finally:
+            self.manifest = None
+            self.dir_install = "."
+            self.copy_mode = 'copy'
+        return plan
+
+    def diff(self, dir_out, params_raw=None, update=None):
+        """Compare the files an install of the template would write to those
+        already in the output directory, without writing anything.  Template
+        files are rendered to memory, and each is compared to the installed
+        copy (sizes first, then contents; see file_matches()).  Files recorded
+        in the install manifest which the template no longer produces are
+        reported as orphaned.
+
+        :param dir_out: Output template directory
+        :param params_raw: Raw (unprocessed) list of input parameters
+        :param update: String specifying a specific element to compare
+        :return: Dictionary of lists of output paths, keyed by 'created', 'changed', 'unchanged' and 'orphaned'
+        """
+        self.dir_install = dir_out
+        self._check_caches(check_values=True)
+        try:
+            self.validate_parameters(params_raw)
+            self._clear_install_caches()
+            name_txt = format_template_names(self.name)
+            if(len(self.name) > 1):
+                gbpBuild.log.open("Comparing templates {%s} to {%s}..." % (name_txt, dir_out))
+            else:
+                gbpBuild.log.open("Comparing template {%s} to {%s}..." % (name_txt, dir_out))
+
+            result = {'created': [], 'changed': [], 'unchanged': [], 'orphaned': []}
+            paths_relative = set()
+            for dir_i in sorted(self.directories, key=lambda k: len(self.full_path_out(k))):
+                elements = ([dir_i] if dir_i.is_link else []) + dir_i.files
+                for element in [element for element in elements if self.update_element(element, update)]:
+                    self.current_element = element
+                    paths_relative.add(self.template_path_out(element))
+                    full_path_out = self.full_path_out(element)
+                    status = self._diff_element(element, full_path_out)
+                    result[status].append(full_path_out)
+                    gbpBuild.log.comment("--> %s %s." % (full_path_out, self._diff_messages[status]))
+
+            # Files installed before which the template no longer produces
+            manifest = template_manifest(dir_out)
+            for path_relative in sorted(set(manifest.files) | set(manifest.links)):
+                if(path_relative in paths_relative):
+                    continue
+                if(update is not None and not (path_relative == update or
+                                               path_relative.startswith(update + os.sep))):
+                    continue
+                full_path_out = os.path.join(dir_out, path_relative)
+                if(self.output_tree().lexists(full_path_out)):
+                    result['orphaned'].append(full_path_out)
+                    gbpBuild.log.comment("--> %s %s." % (full_path_out, self._diff_messages['orphaned']))
+
+            gbpBuild.log.close("Done (%d to create, %d to change, %d unchanged, %d orphaned)." % (
+                len(result['created']), len(result['changed']), len(result['unchanged']), len(result['orphaned'])))
+        finally:
+            self.dir_install = "."
+        return result
+
+    def _diff_element(self, element, full_path_out):
+        """Compare the installed copy of a file (or link) to what an install
+        of it would write.
+
+        :param element: template_file (or linked template_directory)
+        :param full_path_out: Full output path of the element
+        :return: One of 'created', 'changed' or 'unchanged'
         """
+        output_tree = self.output_tree()
+        if(not output_tree.lexists(full_path_out)):
+            return 'created'
+        if(element.is_link):
+            if(not output_tree.islink(full_path_out)):
+                return 'changed'
+            symlink_path = os.path.relpath(element.link_source(), os.path.dirname(full_path_out))
+            return 'unchanged' if os.readlink(full_path_out) == symlink_path else 'changed'
+        if(output_tree.islink(full_path_out) or not output_tree.isfile(full_path_out)):
+            return 'changed'
+        if(element.is_template):
+            content = self.render(element).encode(locale.getpreferredencoding(False))
+            flag_same = file_matches(full_path_out, content=content)
+        elif(element.archive is not None):
+            flag_same = file_matches(full_path_out, content=element.read())
+        else:
+            flag_same = file_matches(full_path_out, path_in=element.full_path_in())
+        return 'unchanged' if flag_same else 'changed'
+
+    def _plan_install_directory(self, plan, directory):
+        """Add the installation of a directory to a plan.
 
+        :param plan: template_plan
         :param directory:
-        :param silent:
-        :param force:
-        :return:
+        :return: None
         """
         full_path_out = self.full_path_out(directory)
         try:
             if(not directory.is_root()):
-                if(os.path.isdir(full_path_out)):
-                    gbpBuild.log.open("Directory %s exists." % (full_path_out))
-                else:
+                # Describe the change this makes to the record of installed files
+                record = None
+                if(self.manifest is not None):
+                    record = {'path_relative': self.template_path_out(directory)}
+                if(self.output_tree().isdir(full_path_out) or plan.planned(full_path_out) is not None):
+                    plan.add('open', "Directory %s exists." % (full_path_out))
+                elif(directory.is_link):
                     # Figure-out the relative path directly to the linked file
-                    if(directory.is_link):
-                        symlink_path = os.path.relpath(directory.full_path_in(), os.path.dirname(full_path_out))
-                    if(not silent):
-                        if(directory.is_link):
-                            if(os.path.lexists(full_path_out)):
-                                os.unlink(full_path_out)
-                                os.symlink(symlink_path, full_path_out)
-                                gbpBuild.log.open("Directory %s link updated." % (full_path_out))
-                            else:
-                                os.symlink(symlink_path, full_path_out)
-                                gbpBuild.log.open("Directory %s linked." % (full_path_out))
-                        else:
-                            os.mkdir(full_path_out)
-                            gbpBuild.log.open("Directory %s created." % (full_path_out))
+                    symlink_path = os.path.relpath(directory.link_source(), os.path.dirname(full_path_out))
+                    flag_replace = self.output_tree().lexists(full_path_out)
+                    operation = template_operation(
+                        'symlink', full_path_out, target=symlink_path, replace=flag_replace, record=record,
+                        is_directory=True)
+                    if(flag_replace):
+                        msg = "Directory %s link updated" % (full_path_out)
                     else:
-                        if(directory.is_link):
-                            if(os.path.lexists(full_path_out)):
-                                gbpBuild.log.open("Directory %s link updated silently." % (full_path_out))
-                            else:
-                                gbpBuild.log.open("Directory %s linked silently." % (full_path_out))
-                        else:
-                            gbpBuild.log.open("Directory %s created silently." % (full_path_out))
+                        msg = "Directory %s linked" % (full_path_out)
+                    plan.add('open', msg + ".", msg + " silently.", operation=operation)
+                else:
+                    plan.add('open',
+                             "Directory %s created." % (full_path_out),
+                             "Directory %s created silently." % (full_path_out),
+                             operation=template_operation('mkdir', full_path_out, record=record))
             else:
-                if(os.path.isdir(full_path_out)):
-                    gbpBuild.log.open("Directory %s -- root valid." % (full_path_out))
+                if(self.output_tree().isdir(full_path_out)):
+                    plan.add('open', "Directory %s -- root valid." % (full_path_out))
                 else:
                     raise NotADirectoryError
         except BaseException:
             gbpBuild.log.error("Failed to install directory {%s}." % (full_path_out))
 
-    def uninstall_directory(self, directory, silent=False):
-        """
+    def _plan_uninstall_directory(self, plan, directory):
+        """Add the removal of a directory to a plan.
 
+        :param plan: template_plan
         :param directory:
-        :param silent:
-        :return:
+        :return: None
         """
         full_path_out = self.full_path_out(directory)
         try:
             if(not directory.is_root()):
-                if(not os.path.isdir(full_path_out)):
-                    gbpBuild.log.close("Not found.")
+                record = None
+                if(self.manifest is not None):
+                    record = {'path_relative': self.template_path_out(directory)}
+                if(not self.output_tree().isdir(full_path_out)):
+                    plan.add('close', "Not found.")
+                elif(directory.is_link):
+                    plan.add('close', "Unlinked.", "Unlinked silently.",
+                             operation=template_operation('unlink', full_path_out, record=record, is_directory=True))
                 else:
-                    if(not silent):
-                        if(directory.is_link):
-                            os.unlink(full_path_out)
-                            gbpBuild.log.close("Unlinked.")
-                        else:
-                            os.rmdir(full_path_out)
-                            gbpBuild.log.close("Removed.")
-                    else:
-                        if(directory.is_link):
-                            gbpBuild.log.close("Unlinked silently.")
-                        else:
-                            gbpBuild.log.close("Removed silently.")
+                    plan.add('close', "Removed.", "Removed silently.",
+                             operation=template_operation('rmdir', full_path_out, record=record))
             else:
-                gbpBuild.log.close("Root ignored.")
+                plan.add('close', "Root ignored.")
         except BaseException:
             gbpBuild.log.error("Failed to uninstall directory {%s}." % (directory.name_out))
 
-    def install_file(self, file_install, silent=False, force=False):
-        """
+    def _plan_install_file(self, plan, file_install, force=False):
+        """Add the installation of a file to a plan.  Template files are
+        rendered here, so that the plan holds their content.
 
+        :param plan: template_plan
         :param file_install:
-        :param silent:
         :param force:
-        :return:
+        :return: None
         """
+
         full_path_in = file_install.full_path_in()
         full_path_out = self.full_path_out(file_install)
         try:
-            flag_file_exists = os.path.isfile(self.full_path_out(file_install))
-            if(flag_file_exists and not force):
-                gbpBuild.log.comment("--> %s exists." % (full_path_out))
+            # Elements resolving to a path already planned find it existing; forced installs replace the
+            # earlier element's operation, so that each path is only written once
+            operation_planned = plan.planned(full_path_out)
+            flag_file_exists = self.output_tree().isfile(full_path_out)
+            if((flag_file_exists or operation_planned is not None) and not force):
+                plan.add('comment', "--> %s exists." % (full_path_out))
+                return
+            if(operation_planned is not None):
+                plan.discard(operation_planned)
+            if(flag_file_exists and not file_install.is_link and self._is_current(file_install)):
+                plan.add('comment', "--> %s unchanged." % (full_path_out))
+            elif(file_install.is_link):
+                symlink_path = os.path.relpath(file_install.link_source(), os.path.dirname(full_path_out))
+                flag_replace = self.output_tree().lexists(full_path_out)
+                record = None
+                if(self.manifest is not None):
+                    record = {'path_relative': self.template_path_out(file_install)}
+                operation = template_operation('symlink', full_path_out, target=symlink_path, replace=flag_replace,
+                                               record=record)
+                if(flag_replace):
+                    msg = "--> %s link updated" % (full_path_out)
+                else:
+                    msg = "--> %s linked" % (full_path_out)
+                plan.add('comment', msg + ".", msg + " silently.", operation=operation)
             else:
-                if(file_install.is_link):
-                    symlink_path = os.path.relpath(full_path_in, self.full_path_out(file_install.dir_in))
-                if(not silent):
-                    if(file_install.is_link):
-                        if(os.path.lexists(full_path_out)):
-                            os.unlink(full_path_out)
-                            os.symlink(symlink_path, full_path_out)
-                            gbpBuild.log.comment("--> %s link updated." % (full_path_out))
-                        else:
-                            os.symlink(symlink_path, full_path_out)
-                            gbpBuild.log.comment("--> %s linked." % (full_path_out))
+                # Describe the change this makes to the record of installed files
+                record = None
+                if(self.manifest is not None):
+                    record = {
+                        'path_relative': self.template_path_out(file_install),
+                        'source': file_install.digest(),
+                        'params': self.parameter_digest(file_install)}
+                cached = None
+                if(file_install.is_template and self.render_cache is not None):
+                    if(record is None):
+                        digests = (file_install.digest(), self.parameter_digest(file_install))
                     else:
-                        if(flag_file_exists):
-                            os.remove(full_path_out)
-                            gbpBuild.log.comment("--> %s removed." % (full_path_out))
-                        self.write_with_substitution(file_install)
-                        if(flag_file_exists):
-                            gbpBuild.log.comment("--> %s updated." % (full_path_out))
-                        else:
-                            gbpBuild.log.comment("--> %s created." % (full_path_out))
+                        digests = (record['source'], record['params'])
+                    cached = self.render_cache.get(*digests)
+                if(cached is not None and cached[1] is not None):
+                    operation = template_operation(
+                        'write', full_path_out, content=cached[1], replace=flag_file_exists, record=record)
+                elif(cached is not None):
+                    # Large renders are copied from the cache; never hard linked, since the install may be edited
+                    operation = template_operation('copy', full_path_out, source=cached[0],
+                                                   copy_mode=self._render_copy_mode(), replace=flag_file_exists,
+                                                   record=record)
+                elif(file_install.is_template):
+                    content = self.render(file_install).encode(locale.getpreferredencoding(False))
+                    if(self.render_cache is not None):
+                        self.render_cache.put(digests[0], digests[1], content)
+                    operation = template_operation(
+                        'write', full_path_out, content=content, replace=flag_file_exists, record=record)
                 else:
-                    if(file_install.is_link):
-                        if(os.path.lexists(full_path_out)):
-                            gbpBuild.log.comment("--> %s link updated silently." % (full_path_out))
-                        else:
-                            gbpBuild.log.comment("--> %s linked silently." % (full_path_out))
+                    if(record is not None):
+                        record['output'] = record['source']
+                    if(file_install.archive is None):
+                        operation = template_operation('copy', full_path_out, source=full_path_in,
+                                                       copy_mode=self.copy_mode, replace=flag_file_exists,
+                                                       record=record)
                     else:
-                        if(flag_file_exists):
-                            gbpBuild.log.comment("--> %s updated silently." % (full_path_out))
-                        else:
-                            gbpBuild.log.comment("--> %s created silently." % (full_path_out))
+                        # Archive members can not be copied by path, so their contents are held in the plan
+                        operation = template_operation('write', full_path_out, content=file_install.read(),
+                                                       replace=flag_file_exists, record=record)
+                if(flag_file_exists or operation_planned is not None):
+                    plan.add('comment', "--> %s removed." % (full_path_out), in_silent=False)
+                    plan.add('comment',
+                             "--> %s updated." % (full_path_out),
+                             "--> %s updated silently." % (full_path_out),
+                             operation=operation)
+                else:
+                    plan.add('comment',
+                             "--> %s created." % (full_path_out),
+                             "--> %s created silently." % (full_path_out),
+                             operation=operation)
         except BaseException:
             gbpBuild.log.error("Failed to install file {%s}." % (full_path_out))
 
-    def uninstall_file(self, file_install, silent=False):
-        """Uninstall a specific template file.
+    def _plan_uninstall_file(self, plan, file_install):
+        """Add the removal of a file to a plan.
 
+        :param plan: template_plan
         :param file_install:
-        :param silent:
-        :return:
+        :return: None
         """
         full_path_out = self.full_path_out(file_install)
         try:
-            if(not os.path.isfile(full_path_out)):
-                gbpBuild.log.comment("--> %s not found." % (full_path_out))
+            if(not self.output_tree().isfile(full_path_out)):
+                plan.add('comment', "--> %s not found." % (full_path_out))
             else:
-                if(not silent):
-                    if(file_install.is_link):
-                        os.unlink(full_path_out)
-                        gbpBuild.log.comment("--> %s unlinked." % (full_path_out))
-                    else:
-                        os.remove(full_path_out)
-                        gbpBuild.log.comment("--> %s removed." % (full_path_out))
+                record = None
+                if(self.manifest is not None):
+                    record = {'path_relative': self.template_path_out(file_install)}
+                if(file_install.is_link):
+                    plan.add('comment',
+                             "--> %s unlinked." % (full_path_out),
+                             "--> %s unlinked silently." % (full_path_out),
+                             operation=template_operation('unlink', full_path_out, record=record))
                 else:
-                    if(file_install.is_link):
-                        gbpBuild.log.comment("--> %s unlinked silently." % (full_path_out))
-                    else:
-                        gbpBuild.log.comment("--> %s removed silently." % (full_path_out))
+                    plan.add('comment',
+                             "--> %s removed." % (full_path_out),
+                             "--> %s removed silently." % (full_path_out),
+                             operation=template_operation('remove', full_path_out, record=record))
         except BaseException:
             gbpBuild.log.error("Failed to uninstall file {%s}." % (full_path_out))
 
-    def install(self, dir_out, params_raw=None, silent=False, update=None, force=False):
+    def install_directory(self, directory, silent=False, force=None):
+        """
+
+        :param directory:
+        :param silent:
+        :param force:
+        :return:
+        """
+        plan = template_plan(self.dir_install)
+        self._plan_install_directory(plan, directory)
+        self._execute_plan(plan, silent=silent, use_journal=False)
+
+    def uninstall_directory(self, directory, silent=False):
+        """
+
+        :param directory:
+        :param silent:
+        :return:
+        """
+        plan = template_plan(self.dir_install)
+        self._plan_uninstall_directory(plan, directory)
+        self._execute_plan(plan, silent=silent, use_journal=False)
+
+    def install_file(self, file_install, silent=False, force=False):
+        """
+
+        :param file_install:
+        :param silent:
+        :param force:
+        :return:
+        """
+        plan = template_plan(self.dir_install)
+        self._plan_install_file(plan, file_install, force=force)
+        self._execute_plan(plan, silent=silent, use_journal=False)
+
+    def uninstall_file(self, file_install, silent=False):
+        """Uninstall a specific template file.
+
+        :param file_install:
+        :param silent:
+        :return:
+        """
+        plan = template_plan(self.dir_install)
+        self._plan_uninstall_file(plan, file_install)
+        self._execute_plan(plan, silent=silent, use_journal=False)
+
+    def install(self, dir_out, params_raw=None, silent=False, update=None, force=False, jobs=1, copy_mode='copy',
+                use_render_cache=False):
         """Install template.
 
         :param dir_out: Output template directory
         :param params_raw: Raw (unprocessed) list of input parameters
         :param silent: Bool indicating if this is a dry run (report only; no file operations performed)
         :param update: String specifying a specific element to update
-        :param force: Bool indicating that existing files should be overwritten
-        :return:
+        :param force: Bool indicating that existing files should be overwritten (unless the
+            install manifest shows that they are already current)
+        :param jobs: Number of workers to use for writing files
+        :param copy_mode: How non-template files are copied (one of 'copy', 'reflink' or 'hardlink')
+        :param use_render_cache: Bool indicating if the cache of rendered files (see template_render_cache)
+            should be used (it is kept in the user's cache directory, so is off unless asked for, and is not
+            used by dry runs)
+        :return: The template_plan performed
         """
-        # Set the current install directory
-        self.dir_install = dir_out
-
-        # Create a list of project parameters
-        self.validate_parameters(params_raw)
-
-        # Perform install
-        self._process_template(silent=silent, update=update, force=force)
-
-        # Unset the current install directory
-        self.dir_install = "."
+        self.counters = template_counters()
+        with self.counters:
+            # Set the current install directory
+            self.dir_install = dir_out
+            self._check_caches(check_values=True)
+            self.copy_mode = copy_mode
+            if(use_render_cache and not silent):
+                self.render_cache = template_render_cache()
+            try:
+                # Create a list of project parameters
+                self.validate_parameters(params_raw)
+
+                # Perform install, updating the record of installed files
+                self.manifest = template_manifest(dir_out)
+                plan = self._process_template(silent=silent, update=update, force=force, jobs=jobs)
+                if(not silent):
+                    self.manifest.add_templates(self.name)
+                    self.manifest.write()
+            finally:
+                self.manifest = None
+                if(self.render_cache is not None):
+                    self.render_cache.save_stats()
+                    self.render_cache = None
+
+                # Unset the current install directory
+                self.dir_install = "."
+                self.copy_mode = 'copy'
+            return plan
 
     def uninstall(self, dir_out, params_raw=None, silent=False, update=None):
         """Uninstall template.
@@ -1114,16 +4474,408 @@ class template:
         :param params_raw: Raw (unprocessed) list of input parameters
         :param silent: Bool indicating if this is a dry run (report only; no file operations performed)
         :param update: String indicating a specific element to update
-        :return:
+        :return: The template_plan performed
+        """
+        self.counters = template_counters()
+        with self.counters:
+            # Set the current install directory
+            self.dir_install = dir_out
+            self._check_caches(check_values=True)
+            try:
+                # Create a list of project parameters
+                self.validate_parameters()
+
+                # Perform uninstall, updating the record of installed files
+                self.manifest = template_manifest(dir_out)
+                plan = self._process_template(uninstall=True, silent=silent, update=update)
+                if(not silent):
+                    if(update is None and self.manifest.templates is not None):
+                        self.manifest.templates = [name for name in self.manifest.templates if name not in self.name]
+                    self.manifest.write()
+            finally:
+                self.manifest = None
+
+                # Unset the current install directory
+                self.dir_install = "."
+            return plan
+
+    def source_directories(self):
+        """Return the source directories of the template, mapped to the
+        template directories that files added to them belong to.  The
+        directories of layered templates are included.
+
+        :return: Dictionary of template_directories, keyed by full path
+        """
+        sources = {}
+        for dir_i in self.directories:
+            if(not dir_i.is_link):
+                sources[dir_i.full_path_in()] = dir_i
+        for dir_i in self.directories:
+            for file_i in dir_i.files:
+                if(not file_i.is_symlink):
+                    sources.setdefault(os.path.dirname(file_i.full_path_in()), dir_i)
+        return sources
+
+    def watched_directories(self):
+        """Return the directories holding the template's source files,
+        including the targets of symlinked files.  For templates held in
+        archives, the directories holding the archives are watched instead.
+
+        :return: Set of full paths
+        """
+        directories = set()
+        for path in self.source_directories():
+            if(not self._archive_path(path)):
+                directories.add(path)
+        for dir_i in self.directories:
+            for file_i in dir_i.files:
+                if(file_i.archive is None):
+                    directories.add(os.path.dirname(file_i.full_path_in()))
+                else:
+                    directories.add(os.path.dirname(file_i.archive.path))
+        return directories
+
+    def _archive_path(self, path):
+        """Check if a path is that of an archive the template was loaded from
+        (or is within one).
+
+        :param path: Full path
+        :return: Bool
+        """
+        return any(path == dir_i or path.startswith(dir_i + os.sep) for dir_i in self.dir if os.path.isfile(dir_i))
+
+    def _lists_directory(self, file_in):
+        """Check if the rendering of a file depends on the contents of its
+        output directory (see template_directive_handler.lists_directory).
+
+        :param file_in: template_file
+        :return: Bool
+        """
+        if(not file_in.is_template):
+            return False
+        for line in file_in.compile():
+            for text in line.directives:
+                directive = parse_directive(text)
+                handler = directive_handlers.get(directive.command) if directive.is_command else None
+                if(handler is not None and handler.lists_directory):
+                    return True
+        return False
+
+    def refresh(self, paths):
+        """Update the template for changes to its source files: changed files
+        are re-read, new files are added and deleted files are removed.
+        Changes to directories can not be applied this way; the template must
+        be reloaded (see reload()) instead, as it must for changes to
+        archives.
+
+        :param paths: List of changed paths (in the directories given by watched_directories())
+        :return: Tuple of the lists of files changed (including those added, and those whose
+            directory listings have changed) and removed; None if the template must be reloaded
+        """
+        sources = self.source_directories()
+        files_by_path = {}
+        for dir_i in self.directories:
+            for file_i in dir_i.files:
+                files_by_path.setdefault(file_i.full_path_in(), []).append(file_i)
+
+        changed = []
+        removed = []
+        directories_changed = []
+        for path in paths:
+            path = os.path.normpath(os.path.abspath(path))
+            files = files_by_path.get(path)
+            if(files is not None):
+                if(os.path.isfile(path)):
+                    for file_i in files:
+                        file_i.lines = None
+                        file_i._stat = None
+                        file_i._digest = None
+                        if(file_i not in changed):
+                            changed.append(file_i)
+                elif(os.path.lexists(path)):
+                    return None
+                else:
+                    for file_i in files:
+                        file_i.dir_host.files.remove(file_i)
+                        del self._file_index[file_i.template_path_in()]
+                        directories_changed.append(file_i.dir_host)
+                        removed.append(file_i)
+            elif(path in sources or os.path.isdir(path) or self._archive_path(path)):
+                return None
+            elif(os.path.isfile(path) and os.path.dirname(path) in sources):
+                if(any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in _watch_ignore)):
+                    continue
+                dir_host = sources[os.path.dirname(path)]
+                template_path = os.path.normpath(os.path.join(dir_host.template_path_in(), os.path.basename(path)))
+                file_new = template_file(dir_host.dirname_template, path, template_path, dir_host)
+                self.add_file(file_new)
+                if(self.get_file(template_path) is file_new):
+                    changed.append(file_new)
+                    directories_changed.append(file_new.dir_host)
+
+        # Files listing directories whose contents have changed must be rendered again
+        for dir_i in set(directories_changed):
+            for file_i in dir_i.files:
+                if(file_i not in changed and self._lists_directory(file_i)):
+                    changed.append(file_i)
+
+        # Note any new parameters referenced by the changed files
+        for file_i in changed:
+            if(file_i.is_template):
+                for line in file_i.compile():
+                    for directive in line.directives:
+                        if(not self.resolve_directive(None, directive, check=True)):
+                            self.params_list.add(directive)
+        return changed, removed
+
+    def reload(self):
+        """Scan the template(s) again, from scratch.
+
+        :return: None
+        """
+        templates = list(zip(self.name, self.path))
+        self.path = []
+        self.dir = []
+        self.name = []
+        self.directories = []
+        self._directory_index = {}
+        self._file_index = {}
+        self._template_paths_out.clear()
+        self._full_paths_out.clear()
+        self._clear_install_caches()
+        for template_name, path in templates:
+            self.add(template_name, path=[path])
+
+    def install_changes(self, dir_out, paths, jobs=1, copy_mode='copy'):
+        """Update an install of the template for changes to its source files,
+        rendering again only the outputs affected.  If the structure of the
+        template has changed, it is reloaded and installed again in full
+        (with force, so that only files which are not current are written).
+
+        :param dir_out: Output template directory
+        :param paths: List of changed source paths (see refresh())
+        :param jobs: Number of workers to use for writing files
+        :param copy_mode: How non-template files are copied (one of 'copy', 'reflink' or 'hardlink')
+        :return: The template_plan performed
         """
-        # Set the current install directory
+        changes = self.refresh(paths)
+        if(changes is None):
+            gbpBuild.log.comment("The structure of the template has changed; reloading it.")
+            self.reload()
+            return self.install(dir_out, force=True, jobs=jobs, copy_mode=copy_mode)
+        files_changed, files_removed = changes
+
         self.dir_install = dir_out
+        self._check_caches(check_values=True)
+        self.copy_mode = copy_mode
+        try:
+            self.manifest = template_manifest(dir_out)
+            plan = template_plan(self.dir_install)
+            for file_i in files_removed:
+                self._plan_uninstall_file(plan, file_i)
+            self._paths_removed = set(operation.path for operation in plan.operations)
+            for file_i in files_changed:
+                self._plan_install_file(plan, file_i, force=True)
+            self._execute_plan(plan, jobs=jobs)
+            self.manifest.write()
+        finally:
+            self._paths_removed = set()
+            self.manifest = None
+            self.dir_install = "."
+            self.copy_mode = 'copy'
+        return plan
+
+    def watch(self, dir_out, jobs=1, copy_mode='copy', poll_interval=0.5, max_changes=None, timeout=None):
+        """Watch the template's source files, updating an install of it (see
+        install_changes()) each time they change, until interrupted.
 
-        # Create a list of project parameters
-        self.validate_parameters()
+        :param dir_out: Output template directory
+        :param jobs: Number of workers to use for writing files
+        :param copy_mode: How non-template files are copied (one of 'copy', 'reflink' or 'hardlink')
+        :param poll_interval: Time (in seconds) between polls, if inotify is not available
+        :param max_changes: Number of changes after which to stop (default: no limit)
+        :param timeout: Time (in seconds) to wait for a change before stopping (default: no limit)
+        :return: None
+        """
+        directories = self.watched_directories()
+        watcher = template_watcher(directories, poll_interval=poll_interval)
+        gbpBuild.log.open("Watching template files for changes (using %s; press Ctrl-C to stop)..." %
+                          ('inotify' if watcher.uses_inotify else 'polling'))
+        n_changes = 0
+        try:
+            while(max_changes is None or n_changes < max_changes):
+                paths = watcher.wait(timeout=timeout)
+                if(not paths):
+                    break
+                time_start = time.perf_counter()
+                plan = self.install_changes(dir_out, paths, jobs=jobs, copy_mode=copy_mode)
+                gbpBuild.log.comment("%d path(s) changed; %d operation(s) performed in %.1f ms." %
+                                     (len(paths), plan.n_operations(), 1e3 * (time.perf_counter() - time_start)))
+                n_changes += 1
+
+                # Watch any directories added to the template
+                directories_new = self.watched_directories()
+                if(directories_new != directories):
+                    directories = directories_new
+                    watcher.watch(directories)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        gbpBuild.log.close("Done.")
 
-        # Perform uninstall
-        self._process_template(uninstall=True, silent=silent, update=update)
+    def install_many(self, targets, silent=False, update=None, force=False, jobs=None, copy_mode='copy',
+                     use_render_cache=False):
+        """Install the template to many output directories, each with its own
+        parameters.  The template is loaded (and its files compiled) once, and
+        the installs are shared between a pool of worker processes.  The log
+        of each install is captured, and a summary of them all is written to
+        the log instead.
 
-        # Unset the current install directory
-        self.dir_install = "."
+        :param targets: List of (output directory, parameter dictionary) pairs
+        :param silent: Bool indicating if this is a dry run (report only; no file operations performed)
+        :param update: String specifying a specific element to update
+        :param force: Bool indicating that existing files should be overwritten
+        :param jobs: Number of worker processes (default: the number of CPUs)
+        :param copy_mode: How non-template files are copied (one of 'copy', 'reflink' or 'hardlink')
+        :param use_render_cache: Bool indicating if the cache of rendered files (see template_render_cache)
+            should be used (off unless asked for)
+        :return: List of dictionaries (one per target, in order) with keys 'dir_out', 'n_operations',
+            'time', 'log', 'counters' (see template_counters) and 'error' (None for successful installs)
+        """
+        if(jobs is None):
+            jobs = os.cpu_count() or 1
+        jobs = max(1, min(jobs, len(targets)))
+
+        # Compile everything the workers will need before they are started
+        for dir_i in self.directories:
+            for file_i in dir_i.files:
+                file_i.compile()
+
+        name_txt = format_template_names(self.name)
+        gbpBuild.log.open("Installing template(s) {%s} to %d target(s)..." % (name_txt, len(targets)))
+        kwargs = {'silent': silent, 'update': update, 'force': force, 'copy_mode': copy_mode,
+                  'use_render_cache': use_render_cache}
+        if(jobs == 1):
+            results = [_install_target(self, dir_out, params, kwargs) for dir_out, params in targets]
+        else:
+            # Forked workers inherit the loaded template; otherwise it is pickled once per worker
+            if('fork' in multiprocessing.get_all_start_methods()):
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context()
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs, mp_context=context, initializer=_install_many_init, initargs=(self,)) as executor:
+                futures = [executor.submit(_install_many_target, dir_out, params, kwargs)
+                           for dir_out, params in targets]
+                results = [future.result() for future in futures]
+
+        # Write the summary, totalling the counts of all the installs
+        self.counters = template_counters()
+        n_failed = 0
+        for result in results:
+            self.counters.add(result['counters'])
+            if(result['error'] is None):
+                gbpBuild.log.comment("--> %s: %d operation(s) in %.2fs." %
+                                     (result['dir_out'], result['n_operations'], result['time']))
+            else:
+                n_failed += 1
+                gbpBuild.log.comment("--> %s: FAILED (%s)" % (result['dir_out'], result['error']))
+        gbpBuild.log.close("Done (%d of %d target(s) failed; %s)." % (n_failed, len(targets), self.counters))
+        return results
+
+
+# The template installed by the workers of template.install_many()
+_install_many_template = None
+
+
+def _install_many_init(template_in):
+    global _install_many_template
+    _install_many_template = template_in
+
+
+def _install_many_target(dir_out, params, kwargs):
+    return _install_target(_install_many_template, dir_out, params, kwargs)
+
+
+def _install_target(template_in, dir_out, params, kwargs):
+    """Install a template to one of the targets of template.install_many(),
+    capturing its log.
+
+    :param template_in: template
+    :param dir_out: Output directory
+    :param params: Dictionary of parameters to add to the template's parameters
+    :param kwargs: Dictionary of options to pass to template.install()
+    :return: Dictionary (see template.install_many())
+    """
+    result = {'dir_out': dir_out, 'n_operations': 0, 'time': 0., 'log': None, 'counters': None, 'error': None}
+    log_saved = gbpBuild.log
+    params_saved = template_in.params
+    template_in.counters = template_counters()
+    buffer = io.StringIO()
+    time_start = time.time()
+    try:
+        gbpBuild.log = log_saved.__class__(fp_out=buffer)
+        params_target = dict(params_saved)
+        params_target.update(params)
+        template_in.params = params_target
+        template_in.validate_parameters()
+        plan = template_in.install(dir_out, **kwargs)
+        result['n_operations'] = plan.n_operations()
+    except Exception as error:
+        # Report the message written by gbpBuild.log.error(), if there is one
+        messages = [line.strip()[len('ERROR: '):] for line in buffer.getvalue().splitlines()
+                    if line.strip().startswith('ERROR: ')]
+        result['error'] = messages[-1] if messages else str(error)
+    finally:
+        template_in.params = params_saved
+        gbpBuild.log = log_saved
+    result['time'] = time.time() - time_start
+    result['log'] = buffer.getvalue()
+    result['counters'] = dict(template_in.counters)
+    return result
+
+
+def uninstall_recorded(dir_out, templates=None, silent=False, jobs=1):
+    """Uninstall everything recorded in the install manifest of a directory
+    (see template_manifest.plan_uninstall()), without loading the templates
+    that were installed there.
+
+    :param dir_out: Output template directory
+    :param templates: List of the names of the templates to uninstall (if given, the uninstall is only
+        performed if these are the templates recorded as installed)
+    :param silent: Bool indicating if this is a dry run (report only; no file operations performed)
+    :param jobs: Number of workers to use for removing files
+    :return: The template_plan performed (None if the manifest does not record the templates installed)
+    """
+    counters = template_counters()
+    with counters:
+        manifest = template_manifest(dir_out)
+        if(manifest.templates is None or not (manifest.files or manifest.directories or manifest.links)):
+            return None
+        if(templates is not None and sorted(set(templates)) != manifest.templates):
+            return None
+
+        name_txt = format_template_names(manifest.templates)
+        if(len(manifest.templates) > 1):
+            gbpBuild.log.open("Uninstalling templates {%s} from {%s} (as recorded)..." % (name_txt, dir_out))
+        else:
+            gbpBuild.log.open("Uninstalling template {%s} from {%s} (as recorded)..." % (name_txt, dir_out))
+
+        # Reverse anything left by an interrupted install before deciding what to do
+        journal = template_journal(dir_out)
+        if(not silent and journal.exists()):
+            journal.rollback()
+            gbpBuild.log.comment("Reverted an interrupted install.")
+
+        plan = manifest.plan_uninstall()
+        if(not silent):
+            try:
+                plan.execute(jobs=jobs, manifest=manifest)
+            except template_plan.execution_error as error:
+                gbpBuild.log.error("%s; all changes have been reverted." % (error))
+            manifest.write()
+        plan.report(silent=silent)
+
+        gbpBuild.log.close("Done (%s)." % (counters))
+        return plan
@@ -0,0 +1,45 @@
+import os
+import sys
+import json
+import importlib
+
+# Infer the name of this package from the path of __file__
+package_parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+package_name = 'gbpBuild'
+
+# Make sure that what's in this path takes precedence
+# over an installed version of the project
+sys.path.insert(0, package_parent_dir)
+
+# Import needed modules
+bench = importlib.import_module(package_name + '.benchmarks')
+
+
+def test_synthetic_template(tmp_path):
+    synthetic = bench.synthetic_template(str(tmp_path))
+    n_files = 0
+    for root, dirs, files in os.walk(synthetic.dir_template, followlinks=True):
+        n_files += len(files)
+    assert n_files == synthetic.n_files()
+    assert os.path.islink(os.path.join(synthetic.dir_template, 'linked_0'))
+    assert os.path.isdir(os.path.join(synthetic.dir_template, 'dir_var_name_var_'))
+
+
+def test_benchmark(tmp_path):
+    # Set GBPBUILD_BENCHMARK_SHAPE to run a larger benchmark (and GBPBUILD_BENCHMARK_OUTPUT to keep its results)
+    shape = os.environ.get('GBPBUILD_BENCHMARK_SHAPE', 'tiny')
+    results = bench.benchmark(shape=shape, path=str(tmp_path / 'work'))
+    results.run()
+    assert [result['step'] for result in results.results] == list(bench.steps)
+
+    # Every step must actually have done its work
+    dir_out = str(tmp_path / 'work' / 'output')
+    assert os.listdir(dir_out) == []
+    record = json.loads(json.dumps(results.to_record()))
+    for result in record['results']:
+        assert result['wall_time'] > 0
+        assert result['n_files'] > 0
+    output = os.environ.get('GBPBUILD_BENCHMARK_OUTPUT')
+    if(output is not None):
+        with open(output, 'w') as fp_out:
+            results.write(fp_out)
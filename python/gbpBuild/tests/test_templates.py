@@ -0,0 +1,933 @@
+import os
+import io
+import time
+import sys
+import importlib
+import stat
+import zipfile
+import tarfile
+import pytest
+
+# Infer the name of this package from the path of __file__
+package_parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+package_name = 'gbpBuild'
+
+# Make sure that what's in this path takes precedence
+# over an installed version of the project
+sys.path.insert(0, package_parent_dir)
+
+# Import needed modules
+tmp = importlib.import_module(package_name + '.templates')
+
+
+def write_file(path, txt):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp_out:
+        fp_out.write(txt)
+
+
+def read_file(path):
+    with open(path, 'r') as fp_in:
+        return fp_in.read()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep every test's caches out of the user's cache directory."""
+    monkeypatch.setenv('GBPTEMPLATE_CACHE_PATH', str(tmp_path / 'cache'))
+    return str(tmp_path / 'cache')
+
+
+@pytest.fixture
+def template_dir(tmp_path, monkeypatch):
+    """Build a small template, returning the directory holding it."""
+    monkeypatch.setenv('GBPTEMPLATE_CONFIG_PATH', str(tmp_path / 'no_config.json'))
+    monkeypatch.delenv('GBPPY_TEMPLATE_PATH', raising=False)
+    root = tmp_path / 'templates' / 'test'
+    write_file(str(root / 'README.md.template'), "# %%%name%%%\n\nBy %%%author%%%.\n")
+    write_file(str(root / 'plain.txt'), "No %%%substitution%%% here.\n")
+    write_file(str(root / '_var_name_var_' / 'list.txt.template'), "item=%%%items%%%;\n")
+    write_file(str(root / 'src' / 'a.c'), "int a;\n")
+    write_file(str(root / 'src' / 'b.h'), "int b;\n")
+    write_file(str(root / 'src' / 'local.cmake.template'),
+               "dirs=%%%_DIRLIST_DIRS%%%\nfiles=%%%_DIRLIST_FILES *.c,*.h%%%\n")
+    return str(tmp_path / 'templates')
+
+
+@pytest.fixture
+def params():
+    return {'name': 'proj', 'author': 'Someone', 'items': ['x', 'y', 'z']}
+
+
+def load_template(template_dir, params):
+    template = tmp.template('test', path=[template_dir])
+    template.params.update(params)
+    return template
+
+
+def list_tree(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, dirs, files in os.walk(path) for name in dirs + files)
+
+
+def test_template_line():
+    line = tmp.template_line("a %%%b%%% c %%%_DIRLIST_FILES *.c%%%\n")
+    assert line.literals == ["a ", " c ", "\n"]
+    assert line.directives == ["b", "_DIRLIST_FILES *.c"]
+    assert str(line) == "a %%%b%%% c %%%_DIRLIST_FILES *.c%%%\n"
+    assert tmp.template_line("_var_name_var__info.py", delimiter="_var_").directives == ["name"]
+    assert tmp.template_line("no references").is_literal()
+
+
+def test_install(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    assert template.params_list == set(['name', 'author', 'items'])
+
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+
+    assert read_file(os.path.join(dir_out, 'README.md')) == "# proj\n\nBy Someone.\n"
+    assert read_file(os.path.join(dir_out, 'plain.txt')) == "No %%%substitution%%% here.\n"
+    assert read_file(os.path.join(dir_out, 'proj', 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+    assert read_file(os.path.join(dir_out, 'src', 'local.cmake')) == "files=a.c\nfiles=b.h\n"
+    assert os.path.isfile(os.path.join(dir_out, tmp.template_manifest.filename))
+
+    # Installing again leaves existing files alone, unless forced
+    write_file(os.path.join(dir_out, 'README.md'), "Edited.\n")
+    assert template.install(dir_out).n_operations() == 0
+    assert read_file(os.path.join(dir_out, 'README.md')) == "Edited.\n"
+    assert template.install(dir_out, force=True).n_operations() == 1
+    assert read_file(os.path.join(dir_out, 'README.md')) == "# proj\n\nBy Someone.\n"
+    assert template.install(dir_out, force=True).n_operations() == 0
+
+
+def test_render_nested(template_dir, params, tmp_path):
+    # References held by parameter values are substituted in turn, as they were before lines were compiled
+    template = load_template(template_dir, params)
+    template.params['title'] = "%%%name%%% by %%%author%%%"
+    template.params['paths'] = ['%%%items%%%.c', 'b.c', '%%%items%%%.h']
+    assert template.render_line(None, tmp.template_line("# %%%title%%%\n")) == ["# proj by Someone\n"]
+    assert template.render_line(None, tmp.template_line("%%%paths%%%\n")) == ["x.c\n", "b.c\n", "z.h\n"]
+    template.params['paths'] = ['%%%name%%%', '%%%items%%%']
+    with pytest.raises(Exception):
+        template.render_line(None, tmp.template_line("%%%paths%%%\n"))
+
+    # ... including in names (by their own delimiter), and installed files follow changes to the values they reference
+    write_file(os.path.join(template_dir, 'test', '_var_title_var_.txt.template'), "%%%title%%%\n")
+    template = load_template(template_dir, params)
+    template.params['title'] = "_var_name_var_-%%%author%%%"
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    assert read_file(os.path.join(dir_out, 'proj-%%%author%%%.txt')) == "_var_name_var_-Someone\n"
+    template.params['author'] = 'Someone else'
+    template.install(dir_out, force=True)
+    assert read_file(os.path.join(dir_out, 'proj-%%%author%%%.txt')) == "_var_name_var_-Someone else\n"
+
+
+def test_layered_templates(template_dir, params):
+    write_file(os.path.join(template_dir, 'extra', 'plain.txt'), "No %%%substitution%%% here.\n")
+    write_file(os.path.join(template_dir, 'extra', 'src', 'c.c'), "int c;\n")
+    template = load_template(template_dir, params)
+    n_files = template.n_files()
+    template.add('extra', path=[template_dir])
+
+    # Identical files are merged and new files land in the existing directory
+    assert template.n_files() == n_files + 1
+    assert template.get_file('src/c.c').dir_host is template.get_directory('src')
+    assert template.get_file('src/c.c') in template.get_directory('src').files
+    assert template.get_file('plain.txt').full_path_in() == os.path.join(template_dir, 'test', 'plain.txt')
+    assert template.get_directory('missing') is None
+
+    # Conflicting files are an error
+    write_file(os.path.join(template_dir, 'conflict', 'plain.txt'), "Something else.\n")
+    with pytest.raises(Exception):
+        template.add('conflict', path=[template_dir])
+    write_file(os.path.join(template_dir, 'conflict_size', 'plain.txt'), "No %%%substitution%%% there.\n")
+    with pytest.raises(Exception):
+        template.add('conflict_size', path=[template_dir])
+
+
+def test_paths_out_cache(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    file_list = template.get_file('_var_name_var_/list.txt.template')
+    assert template.template_path_out(file_list) == 'proj/list.txt'
+
+    # Cached paths are invalidated by changes to the parameters ...
+    template.params['name'] = 'other'
+    assert template.template_path_out(file_list) == 'other/list.txt'
+    template.params = dict(params)
+    assert template.template_path_out(file_list) == 'proj/list.txt'
+    template.params |= {'name': 'merged'}
+    assert template.template_path_out(file_list) == 'merged/list.txt'
+
+    # ... including changes made in place to mutable values, which are found as installs start
+    template.params['name'] = ['listed']
+    assert template.template_path_out(file_list) == 'listed/list.txt'
+    template.params['name'][0] = 'altered'
+    plan = template.plan(str(tmp_path), update='altered/list.txt')
+    assert [op.path for op in plan.operations] == [str(tmp_path / 'altered' / 'list.txt')]
+    assert template.template_path_out(file_list) == 'altered/list.txt'
+    template.params = dict(params)
+
+    # ... and to the install directory
+    template.dir_install = str(tmp_path)
+    assert template.full_path_out(file_list) == str(tmp_path / 'proj' / 'list.txt')
+    template.dir_install = str(tmp_path / 'out')
+    assert template.full_path_out(file_list) == str(tmp_path / 'out' / 'proj' / 'list.txt')
+
+
+def test_install_parallel(template_dir, params, tmp_path):
+    write_file(os.path.join(template_dir, 'test', 'src', 'sub', 'shared.txt.link'), "Linked.\n")
+    template = load_template(template_dir, params)
+    dir_sequential = str(tmp_path / 'sequential')
+    dir_parallel = str(tmp_path / 'parallel')
+    os.mkdir(dir_sequential)
+    os.mkdir(dir_parallel)
+    template.install(dir_sequential)
+    template.install(dir_parallel, jobs=4)
+
+    for root, dirs, files in os.walk(dir_sequential):
+        for file_i in [f for f in files if f != tmp.template_manifest.filename]:
+            path_parallel = os.path.join(dir_parallel, os.path.relpath(os.path.join(root, file_i), dir_sequential))
+            assert read_file(os.path.join(root, file_i)) == read_file(path_parallel)
+    path_link = os.path.join(dir_parallel, 'src', 'sub', 'shared.txt')
+    assert os.path.islink(path_link)
+    assert read_file(path_link) == "Linked.\n"
+
+    # Forced parallel re-installs rewrite only the edited files (along with the links, which are always renewed)
+    tree = list_tree(dir_parallel)
+    write_file(os.path.join(dir_parallel, 'src', 'a.c'), "Edited.\n")
+    write_file(os.path.join(dir_parallel, 'proj', 'list.txt'), "Edited.\n")
+    plan = template.install(dir_parallel, force=True, jobs=4)
+    assert sorted(op.action for op in plan.operations) == ['copy', 'symlink', 'write']
+    assert read_file(os.path.join(dir_parallel, 'src', 'a.c')) == "int a;\n"
+    assert read_file(os.path.join(dir_parallel, 'proj', 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+    plan = template.install(dir_parallel, force=True, jobs=4)
+    assert [op.action for op in plan.operations] == ['symlink']
+    assert list_tree(dir_parallel) == tree
+
+
+def test_install_manifest(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    manifest = tmp.template_manifest(dir_out)
+    assert sorted(manifest.files.keys()) == ['README.md', 'plain.txt', 'proj/list.txt', 'src/a.c', 'src/b.h',
+                                             'src/local.cmake']
+
+    # Forced re-installs leave current files alone ...
+    path_readme = os.path.join(dir_out, 'README.md')
+    path_plain = os.path.join(dir_out, 'plain.txt')
+    os.utime(path_readme, ns=(0, 0))
+    with open(path_plain, 'a') as fp_out:
+        fp_out.write("Edited.\n")
+    template.install(dir_out, force=True)
+    assert os.stat(path_readme).st_mtime_ns == 0
+
+    # ... but rewrite those which have been edited or whose parameters have changed
+    assert read_file(path_plain) == "No %%%substitution%%% here.\n"
+    template.params['author'] = 'Someone else'
+    template.install(dir_out, force=True)
+    assert read_file(path_readme) == "# proj\n\nBy Someone else.\n"
+
+    # Uninstalling removes the manifest along with the files
+    template.uninstall(dir_out)
+    assert not os.path.exists(manifest.path)
+
+
+def test_dirlist_install_records(template_dir, params, tmp_path):
+    # The manifest and journal in the install root are never listed, however many times the template is installed
+    write_file(os.path.join(template_dir, 'test', 'list.txt.template'), "files=%%%_DIRLIST_FILES%%%\n")
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    assert read_file(os.path.join(dir_out, 'list.txt')) == "files=README.md\nfiles=list.txt\nfiles=plain.txt\n"
+    assert os.path.isfile(os.path.join(dir_out, tmp.template_manifest.filename))
+    template.install(dir_out, force=True)
+    assert read_file(os.path.join(dir_out, 'list.txt')) == "files=README.md\nfiles=list.txt\nfiles=plain.txt\n"
+    template = load_template(template_dir, params)
+    template.install(dir_out, force=True)
+    assert read_file(os.path.join(dir_out, 'list.txt')) == "files=README.md\nfiles=list.txt\nfiles=plain.txt\n"
+
+
+@pytest.mark.parametrize('mode', tmp.copy_modes)
+def test_copy_file(tmp_path, mode):
+    path_in = str(tmp_path / 'in.bin')
+    path_out = str(tmp_path / 'out.bin')
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with open(path_in, 'wb') as fp_out:
+        fp_out.write(data)
+    tmp.copy_file(path_in, path_out, mode=mode)
+    with open(path_out, 'rb') as fp_in:
+        assert fp_in.read() == data
+
+    # Copies over an existing, larger, file leave nothing of it behind
+    if(mode != 'hardlink'):
+        path_other = str(tmp_path / 'other.bin')
+        with open(path_other, 'wb') as fp_out:
+            fp_out.write(os.urandom(len(data) + 4096))
+        tmp.copy_file(path_in, path_other, mode=mode)
+        with open(path_other, 'rb') as fp_in:
+            assert fp_in.read() == data
+    assert os.stat(path_in).st_mtime_ns == os.stat(path_out).st_mtime_ns
+    if(mode == 'hardlink'):
+        assert os.path.samefile(path_in, path_out)
+
+
+def test_compile_literal_blocks(template_dir, params):
+    template = load_template(template_dir, params)
+    file_readme = template.get_file('README.md.template')
+    assert [str(line) for line in file_readme.compile()] == ["# %%%name%%%\n", "\n", "By %%%author%%%.\n"]
+    write_file(file_readme.full_path_in(), "a\nb\n%%%name%%%\nc\n")
+    file_readme.lines = None
+    assert [line.is_literal() for line in file_readme.compile()] == [True, False, True]
+    assert str(file_readme.compile()[0]) == "a\nb\n"
+
+
+def test_scan_cache(template_dir, params, tmp_path):
+    template_cold = load_template(template_dir, params)
+    assert os.listdir(str(tmp_path / 'cache' / 'scan'))
+
+    # Warm loads reproduce the cold load, including the compiled template files
+    template_warm = load_template(template_dir, params)
+    assert str(template_warm) == str(template_cold)
+    assert template_warm.params_list == template_cold.params_list
+    assert template_warm.get_file('README.md.template').lines is not None
+    dir_cold = str(tmp_path / 'cold')
+    dir_warm = str(tmp_path / 'warm')
+    os.mkdir(dir_cold)
+    os.mkdir(dir_warm)
+    template_cold.install(dir_cold)
+    template_warm.install(dir_warm)
+    for path in ['README.md', 'plain.txt', 'proj/list.txt', 'src/local.cmake']:
+        assert read_file(os.path.join(dir_cold, path)) == read_file(os.path.join(dir_warm, path))
+
+    # Changes to the template invalidate the cache
+    write_file(os.path.join(template_dir, 'test', 'README.md.template'), "# %%%name%%% (%%%version%%%)\n")
+    template_changed = load_template(template_dir, params)
+    assert 'version' in template_changed.params_list
+    write_file(os.path.join(template_dir, 'test', 'src', 'new.c'), "int n;\n")
+    assert load_template(template_dir, params).get_file('src/new.c') is not None
+
+
+def test_compile_template_text():
+    text = "a\nb %%%x%%% c %%%y%%%\n\nd %%%z%%%"
+    lines = tmp.compile_template_text(text)
+    assert [str(line) for line in lines] == ["a\n", "b %%%x%%% c %%%y%%%\n", "\n", "d %%%z%%%"]
+    assert [line.directives for line in lines] == [[], ['x', 'y'], [], ['z']]
+
+    # References may not span lines
+    assert tmp.compile_template_text("%%%a\nb%%%\n")[0].is_literal()
+
+
+def test_compile_crlf(template_dir, params):
+    template = load_template(template_dir, params)
+    file_readme = template.get_file('README.md.template')
+    with open(file_readme.full_path_in(), 'wb') as fp_out:
+        fp_out.write(b"# %%%name%%%\r\nText\r\n")
+    file_readme.lines = None
+    assert [str(line) for line in file_readme.compile()] == ["# %%%name%%%\n", "Text\n"]
+
+
+class _directive_upper(tmp.template_directive_handler):
+    n_args_max = 1
+
+    def __init__(self):
+        self.n_calls = 0
+
+    def resolve(self, template_in, element, directive):
+        self.n_calls += 1
+        return [str(template_in.params[directive.args[0]]).upper()]
+
+
+def test_register_directive(template_dir, params, tmp_path):
+    handler = _directive_upper()
+    tmp.register_directive('UPPER', handler)
+    try:
+        write_file(os.path.join(template_dir, 'test', 'UPPER.txt.template'), "%%%_UPPER name%%%\n%%%_UPPER name%%%\n")
+        template = load_template(template_dir, params)
+        assert '_UPPER name' not in template.params_list
+        dir_out = str(tmp_path / 'out')
+        os.mkdir(dir_out)
+        template.install(dir_out)
+        assert read_file(os.path.join(dir_out, 'UPPER.txt')) == "PROJ\nPROJ\n"
+        assert handler.n_calls == 1
+    finally:
+        del tmp.directive_handlers['UPPER']
+    assert tmp.parse_directive('_DIRLIST_FILES *.c') is tmp.parse_directive('_DIRLIST_FILES *.c')
+    assert tmp.parse_directive('_DIRLIST_FILES *.c').args == ['*.c']
+
+
+def test_dirlist(template_dir, params, tmp_path):
+    write_file(os.path.join(template_dir, 'test', 'src', 'sub', 'd.c'), "int d;\n")
+    write_file(os.path.join(template_dir, 'test', 'src', 'list.txt.template'),
+               "%%%_DIRLIST%%%\n-%%%_DIRLIST *.c,!a.c%%%\n")
+    template = load_template(template_dir, params)
+
+    # Files and directories already present in the output are listed too
+    dir_out = str(tmp_path / 'out')
+    write_file(os.path.join(dir_out, 'src', 'user.c'), "int user;\n")
+    os.makedirs(os.path.join(dir_out, 'src', 'user_dir'))
+    template.install(dir_out)
+    assert read_file(os.path.join(dir_out, 'src', 'local.cmake')) == \
+        "dirs=sub\ndirs=user_dir\nfiles=a.c\nfiles=b.h\nfiles=user.c\n"
+    assert read_file(os.path.join(dir_out, 'src', 'list.txt')) == \
+        "a.c\nb.h\nlist.txt\nlocal.cmake\nsub\nuser.c\nuser_dir\n-user.c\n"
+
+    # Forced re-installs list what has been added since
+    write_file(os.path.join(dir_out, 'src', 'later.h'), "int later;\n")
+    template.install(dir_out, force=True)
+    assert read_file(os.path.join(dir_out, 'src', 'local.cmake')) == \
+        "dirs=sub\ndirs=user_dir\nfiles=a.c\nfiles=b.h\nfiles=later.h\nfiles=user.c\n"
+
+
+def test_install_plan(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+
+    # Building a plan does not touch the install directory
+    plan = template.plan(dir_out)
+    assert os.listdir(dir_out) == []
+    assert [op.action for op in plan.operations].count('mkdir') == 2
+    assert "write %s (sha256 " % (os.path.join(dir_out, 'README.md')) in str(plan)
+
+    # A plan read back from a file installs the same tree as an install
+    path_plan = str(tmp_path / 'plan.json')
+    plan.write(path_plan)
+    manifest = tmp.template_manifest(dir_out)
+    tmp.template_plan.read(path_plan).execute(jobs=2, manifest=manifest)
+    assert read_file(os.path.join(dir_out, 'proj', 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+    assert sorted(manifest.files) == ['README.md', 'plain.txt', 'proj/list.txt', 'src/a.c', 'src/b.h',
+                                      'src/local.cmake']
+    assert not os.path.exists(os.path.join(dir_out, tmp.template_journal.dirname))
+
+
+def test_install_plan_mixed_batches(tmp_path, monkeypatch):
+    # Directory operations wait for everything before them, even in batches mixing them with file operations
+    dir_out = str(tmp_path / 'out')
+    for path in ('r1.txt', 'r2.txt', 'old/r3.txt'):
+        write_file(os.path.join(dir_out, path), path)
+    os.mkdir(os.path.join(dir_out, 'old', 'sub'))
+    plan = tmp.template_plan(dir_out)
+    for action, path in (('remove', 'r1.txt'), ('mkdir', 'd'), ('remove', 'r2.txt'), ('mkdir', 'd/e'),
+                         ('remove', 'old/r3.txt'), ('write', 'd/a.txt'), ('rmdir', 'old/sub'),
+                         ('write', 'd/e/b.txt'), ('rmdir', 'old'), ('write', 'c.txt')):
+        content = path.encode() if action == 'write' else None
+        operation = tmp.template_operation(action, os.path.join(dir_out, path), content=content)
+        plan.add('comment', path, operation=operation)
+    events = []
+    perform = tmp.template_operation.perform
+
+    def perform_logged(operation):
+        events.append(('start', operation.path))
+        if(not operation.is_directory):
+            time.sleep(0.01)
+        perform(operation)
+        events.append(('end', operation.path))
+
+    monkeypatch.setattr(tmp.template_operation, 'perform', perform_logged)
+    plan.execute(jobs=4)
+    operations = sorted(plan.operations, key=lambda op: op.phase)
+    for i_op, operation in enumerate(operations):
+        if(operation.is_directory):
+            i_start = events.index(('start', operation.path))
+            i_end = events.index(('end', operation.path))
+            assert all(events.index(('end', op.path)) < i_start for op in operations[:i_op])
+            assert all(events.index(('start', op.path)) > i_end for op in operations[i_op + 1:])
+    assert sorted(os.listdir(dir_out)) == ['c.txt', 'd']
+    assert read_file(os.path.join(dir_out, 'd', 'e', 'b.txt')) == "d/e/b.txt"
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_install_plan_shared_output(template_dir, params, tmp_path, jobs):
+    # Elements resolving to the same output path are installed once: the first is kept ...
+    write_file(os.path.join(template_dir, 'extra', 'src', 'local.cmake'), "layered\n")
+    template = load_template(template_dir, params)
+    template.add('extra', path=[template_dir])
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    plan = template.install(dir_out, jobs=jobs)
+    path_out = os.path.join(dir_out, 'src', 'local.cmake')
+    assert [op.path for op in plan.operations].count(path_out) == 1
+    assert read_file(path_out) == "files=a.c\nfiles=b.h\n"
+    assert ('comment', "--> %s exists." % (path_out), "--> %s exists." % (path_out)) in plan.messages
+
+    # ... unless the install is forced, when the last replaces it
+    os.remove(path_out)
+    plan = template.install(dir_out, jobs=jobs, force=True)
+    assert [op.path for op in plan.operations].count(path_out) == 1
+    assert read_file(path_out) == "layered\n"
+
+
+def test_install_plan_rollback(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    write_file(os.path.join(dir_out, 'plain.txt'), "Local edit.\n")
+    os.makedirs(os.path.join(dir_out, 'src', 'b.h'))
+    tree = list_tree(dir_out)
+
+    # The last file can not be written, so everything done before it is reversed
+    plan = template.plan(dir_out, force=True)
+    with pytest.raises(tmp.template_plan.execution_error):
+        plan.execute()
+    assert list_tree(dir_out) == tree
+    assert read_file(os.path.join(dir_out, 'plain.txt')) == "Local edit.\n"
+
+    # An interrupted install is reversed before the next one starts
+    os.rmdir(os.path.join(dir_out, 'src', 'b.h'))
+    journal = tmp.template_journal(dir_out)
+    journal.start()
+    journal.record([tmp.template_operation('mkdir', os.path.join(dir_out, 'proj'))])
+    os.mkdir(os.path.join(dir_out, 'proj'))
+
+    # ... by the plan's execution; planning leaves it in place, but plans as if it had been reversed
+    plan = template.plan(dir_out, force=True)
+    assert journal.exists() and os.path.isdir(os.path.join(dir_out, 'proj'))
+    assert ('mkdir', os.path.join(dir_out, 'proj')) in [(op.action, op.path) for op in plan.operations]
+    plan.execute()
+    assert read_file(os.path.join(dir_out, 'plain.txt')) == "No %%%substitution%%% here.\n"
+    assert read_file(os.path.join(dir_out, 'proj', 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+    assert not journal.exists()
+
+
+def test_install_elements_unjournaled(template_dir, params, tmp_path, monkeypatch):
+    # Single elements are written directly, without a journal
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    started = []
+    monkeypatch.setattr(tmp.template_journal, 'start', lambda journal: started.append(journal))
+    template.dir_install = dir_out
+    template.install_directory(template.get_directory('src'))
+    template.install_file(template.get_file('src/local.cmake.template'))
+    template.install_file(template.get_file('README.md.template'))
+    assert read_file(os.path.join(dir_out, 'README.md')) == "# proj\n\nBy Someone.\n"
+    assert os.path.isfile(os.path.join(dir_out, 'src', 'local.cmake'))
+    template.uninstall_file(template.get_file('src/local.cmake.template'))
+    template.uninstall_directory(template.get_directory('src'))
+    assert sorted(os.listdir(dir_out)) == ['README.md']
+    assert started == []
+
+
+def test_layered_templates_shared(template_dir, params):
+    # Files linked from a shared directory are recognised without being read
+    os.makedirs(os.path.join(template_dir, 'linked'))
+    os.symlink(os.path.join(template_dir, 'test', 'plain.txt'), os.path.join(template_dir, 'linked', 'plain.txt'))
+    template = load_template(template_dir, params)
+    template.add('linked', path=[template_dir])
+    file_plain = template.get_file('plain.txt')
+    assert file_plain._digest is None
+
+    # ... while copies are compared by digest, which is kept in the scan cache
+    write_file(os.path.join(template_dir, 'copied', 'plain.txt'), "No %%%substitution%%% here.\n")
+    template.add('copied', path=[template_dir])
+    assert file_plain._digest == tmp.file_digest(file_plain.full_path_in())
+    template_warm = tmp.template('copied', path=[template_dir])
+    assert template_warm.get_file('plain.txt')._digest == file_plain._digest
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_install_many(template_dir, params, tmp_path, jobs):
+    template = load_template(template_dir, params)
+    targets = []
+    for name in ['alpha', 'beta', 'gamma']:
+        os.mkdir(str(tmp_path / name))
+        targets.append((str(tmp_path / name), {'name': name}))
+    targets.append((str(tmp_path / 'missing'), {}))
+    results = template.install_many(targets, jobs=jobs)
+
+    # Each target gets its own parameters, and failures are reported without stopping the others
+    assert [result['dir_out'] for result in results] == [dir_out for dir_out, params_i in targets]
+    for name, result in zip(['alpha', 'beta', 'gamma'], results):
+        assert result['error'] is None
+        assert result['n_operations'] == 8
+        assert read_file(os.path.join(result['dir_out'], name, 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+        assert read_file(os.path.join(result['dir_out'], 'README.md')) == "# %s\n\nBy Someone.\n" % (name)
+    assert "Failed to install directory" in results[-1]['error']
+    assert template.params['name'] == 'proj'
+
+    # Installing to the same targets again finds nothing to do
+    results = template.install_many(targets[:-1], jobs=jobs, force=True)
+    assert [(result['error'], result['n_operations']) for result in results] == [(None, 0)] * 3
+
+
+def test_install_changes(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    path_readme = template.get_file('README.md.template').full_path_in()
+    dir_src = os.path.dirname(template.get_file('src/a.c').full_path_in())
+
+    # Only the edited file is rendered again
+    write_file(path_readme, "# %%%name%%% (edited)\n")
+    plan = template.install_changes(dir_out, [path_readme])
+    assert [op.path for op in plan.operations] == [os.path.join(dir_out, 'README.md')]
+    assert read_file(os.path.join(dir_out, 'README.md')) == "# proj (edited)\n"
+
+    # Files added and removed update the directory listings which depend on them
+    write_file(os.path.join(dir_src, 'c.c'), "int c;\n")
+    write_file(os.path.join(dir_src, 'c.c.swp'), "")
+    os.remove(os.path.join(dir_src, 'a.c'))
+    plan = template.install_changes(dir_out, [os.path.join(dir_src, name) for name in ('a.c', 'c.c', 'c.c.swp')])
+    assert len(plan.operations) == 3
+    assert read_file(os.path.join(dir_out, 'src', 'local.cmake')) == "files=b.h\nfiles=c.c\n"
+    assert not os.path.exists(os.path.join(dir_out, 'src', 'a.c'))
+    assert template.get_file('src/c.c.swp') is None
+
+    # New directories require the template to be reloaded
+    write_file(os.path.join(dir_src, 'sub', 'd.c'), "int d;\n")
+    template.install_changes(dir_out, [os.path.join(dir_src, 'sub')])
+    assert read_file(os.path.join(dir_out, 'src', 'sub', 'd.c')) == "int d;\n"
+    assert read_file(os.path.join(dir_out, 'README.md')) == "# proj (edited)\n"
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_template_watcher(tmp_path, use_inotify):
+    watcher = tmp.template_watcher([str(tmp_path)], poll_interval=0.01, use_inotify=use_inotify)
+    try:
+        assert watcher.wait(timeout=0.05) == []
+        write_file(str(tmp_path / 'a.txt'), "a\n")
+        assert watcher.wait(timeout=5) == [str(tmp_path / 'a.txt')]
+    finally:
+        watcher.close()
+
+
+def test_render_line(template_dir, params):
+    template = load_template(template_dir, params)
+    template.params['paths'] = ['a', 'b', 'c']
+    template.params['empty'] = []
+    line = tmp.template_line("100%% %%%items%%%=%%%paths%%% by %%%author%%%%%%undefined%%%\n")
+    with pytest.raises(Exception):
+        template.render_line(None, line)
+    line = tmp.template_line("100% %%%items%%%=%%%paths%%%\n")
+    assert template.render_line(None, line) == ["100% x=a\n", "100% y=b\n", "100% z=c\n"]
+    assert template.render_line(None, tmp.template_line("- %%%items%%%\n")) == ["- x\n", "- y\n", "- z\n"]
+    assert template.render_line(None, tmp.template_line("%%%empty%%%\n")) == []
+    assert template.render_line(None, tmp.template_line("%%%undefined%%%\n")) == ["undefined\n"]
+
+
+@pytest.mark.parametrize('kind', ['zip', 'tar'])
+def test_install_archive(template_dir, params, tmp_path, kind):
+    # Add hidden, symlinked and linked elements to the template, then archive it (keeping the symlink)
+    root = os.path.join(template_dir, 'test')
+    write_file(os.path.join(root, '_dot_hidden'), "hidden\n")
+    write_file(os.path.join(root, 'shared.link', 'data.txt'), "shared\n")
+    os.symlink('src', os.path.join(root, 'alias'))
+    path_archive = str(tmp_path / 'archives' / ('test.' + kind))
+    os.makedirs(os.path.dirname(path_archive))
+    if(kind == 'zip'):
+        with zipfile.ZipFile(path_archive, 'w') as archive:
+            for path in list_tree(root):
+                path_full = os.path.join(root, path)
+                if(os.path.islink(path_full)):
+                    info = zipfile.ZipInfo(os.path.join('test', path))
+                    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                    archive.writestr(info, os.readlink(path_full))
+                else:
+                    archive.write(path_full, os.path.join('test', path))
+    else:
+        with tarfile.open(path_archive, 'w') as archive:
+            archive.add(root, 'test')
+
+    dir_out_dir = str(tmp_path / 'out_dir')
+    dir_out_archive = str(tmp_path / 'out_archive')
+    os.mkdir(dir_out_dir)
+    os.mkdir(dir_out_archive)
+    load_template(template_dir, params).install(dir_out_dir)
+    template = tmp.template('test', path=[os.path.dirname(path_archive)])
+    template.params.update(params)
+    assert template.dir == [path_archive]
+    template.install(dir_out_archive)
+
+    # The installs match, with the linked directory extracted once from the archive
+    assert list_tree(dir_out_archive) == list_tree(dir_out_dir)
+    for path in list_tree(dir_out_dir):
+        if(os.path.isfile(os.path.join(dir_out_dir, path)) and path != tmp.template_manifest.filename):
+            assert read_file(os.path.join(dir_out_archive, path)) == read_file(os.path.join(dir_out_dir, path))
+    assert read_file(os.path.join(dir_out_archive, '.hidden')) == "hidden\n"
+    assert read_file(os.path.join(dir_out_archive, 'alias', 'local.cmake')) == "files=a.c\nfiles=b.h\n"
+    assert os.path.islink(os.path.join(dir_out_archive, 'shared'))
+    assert os.path.realpath(os.path.join(dir_out_archive, 'shared')).startswith(tmp.cache_path('archives'))
+
+    # Re-installs from the archive leave the current files alone
+    tree = list_tree(dir_out_archive)
+    plan = template.install(dir_out_archive, force=True)
+    assert [op.action for op in plan.operations if op.action != 'symlink'] == []
+    assert list_tree(dir_out_archive) == tree
+
+    template.uninstall(dir_out_archive)
+    assert os.listdir(dir_out_archive) == []
+
+
+def test_uninstall_recorded(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    manifest = tmp.template_manifest(dir_out)
+    assert manifest.templates == ['test']
+    assert sorted(manifest.directories) == ['proj', 'src']
+    assert tmp.uninstall_recorded(dir_out, templates=['other']) is None
+
+    # Directories holding only recorded elements are removed whole; others are kept with their unrecorded files
+    write_file(os.path.join(dir_out, 'src', 'notes.txt'), "Mine.\n")
+    plan = tmp.uninstall_recorded(dir_out, templates=['test'], jobs=2)
+    assert [op.action for op in plan.operations].count('rmtree') == 1
+    assert list_tree(dir_out) == [tmp.template_manifest.filename, 'src', 'src/notes.txt']
+    manifest = tmp.template_manifest(dir_out)
+    assert manifest.files == {} and list(manifest.directories) == ['src']
+
+    # Once the unrecorded files have gone, the rest is removed
+    os.remove(os.path.join(dir_out, 'src', 'notes.txt'))
+    tmp.uninstall_recorded(dir_out)
+    assert os.listdir(dir_out) == []
+
+    # ... after which there is nothing recorded to uninstall
+    assert tmp.uninstall_recorded(dir_out) is None
+
+
+def test_diff(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    assert len(template.diff(dir_out)['created']) == 6
+    assert os.listdir(dir_out) == []
+    template.install(dir_out)
+
+    # Edit, remove and orphan installed files; nothing is written by the comparison
+    write_file(os.path.join(dir_out, 'plain.txt'), "No %%%substitution%%% here!\n")
+    os.remove(os.path.join(dir_out, 'src', 'a.c'))
+    os.remove(os.path.join(template_dir, 'test', 'src', 'b.h'))
+    template = load_template(template_dir, params)
+    tree = list_tree(dir_out)
+    result = template.diff(dir_out)
+    assert list_tree(dir_out) == tree
+    assert result['created'] == [os.path.join(dir_out, 'src', 'a.c')]
+    assert result['changed'] == [os.path.join(dir_out, 'plain.txt')]
+    assert result['orphaned'] == [os.path.join(dir_out, 'src', 'b.h')]
+    assert len(result['unchanged']) == 3
+
+    # Comparisons can be limited to one element
+    result = template.diff(dir_out, update='src')
+    assert [len(result[status]) for status in ('created', 'changed', 'unchanged', 'orphaned')] == [1, 0, 1, 1]
+
+
+def test_diff_after_install(template_dir, params, tmp_path):
+    # Nothing is reported changed or orphaned in an untouched install, including files listing the install root
+    write_file(os.path.join(template_dir, 'test', 'list.txt.template'), "files=%%%_DIRLIST_FILES%%%\n")
+    template = load_template(template_dir, params)
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    for i_check in range(2):
+        result = template.diff(dir_out)
+        assert [len(result[status]) for status in ('created', 'changed', 'unchanged', 'orphaned')] == [0, 0, 7, 0]
+        template.install(dir_out, force=True)
+
+
+def test_symlink_cycle(template_dir, params, tmp_path):
+    # Symlinked directories are walked, unless they lead back to a directory being walked
+    os.symlink(os.path.join('..', 'src'), os.path.join(template_dir, 'test', '_var_name_var_', 'src'))
+    template = load_template(template_dir, params)
+    path_in = template.get_file('_var_name_var_/src/a.c').full_path_in()
+    assert path_in == os.path.join(template_dir, 'test', 'src', 'a.c')
+
+    # Their files are installed as copies, once
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+    template.install(dir_out)
+    assert read_file(os.path.join(dir_out, 'proj', 'src', 'local.cmake')) == "files=a.c\nfiles=b.h\n"
+    assert not os.path.islink(os.path.join(dir_out, 'proj', 'src'))
+    assert template.install(dir_out, force=True).n_operations() == 0
+    os.symlink('..', os.path.join(template_dir, 'test', 'src', 'loop'))
+    with pytest.raises(OSError, match='leads back to'):
+        load_template(template_dir, params)
+
+
+def test_walk_jobs(template_dir, params, tmp_path):
+    # Elements are added in the same order however many threads list the directories
+    os.symlink(os.path.join('..', 'src'), os.path.join(template_dir, 'test', '_var_name_var_', 'src'))
+    for i_dir in range(8):
+        write_file(os.path.join(template_dir, 'test', 'dir%d' % (i_dir), 'sub', 'file.txt'), "%d\n" % (i_dir))
+    orders = []
+    trees = []
+    for walk_jobs in (1, 4):
+        template = tmp.template()
+        template.add('test', path=[template_dir], use_cache=False, walk_jobs=walk_jobs)
+        template.params.update(params)
+        orders.append([(dir_i.template_path_in(), [file_i.full_path_in() for file_i in dir_i.files])
+                       for dir_i in template.directories])
+
+        # ... and install the same tree
+        dir_out = str(tmp_path / ('out%d' % (walk_jobs)))
+        os.mkdir(dir_out)
+        template.install(dir_out)
+        trees.append(list_tree(dir_out))
+    assert orders[0] == orders[1]
+    assert len(orders[0]) == 20
+    assert trees[0] == trees[1]
+
+
+def test_render_cache(template_dir, params, tmp_path):
+    template = load_template(template_dir, params)
+    for name in ('out0', 'out1', 'out2'):
+        os.mkdir(str(tmp_path / name))
+
+    # The cache is only used when asked for
+    template.install(str(tmp_path / 'out0'))
+    assert not os.path.exists(tmp.cache_path('renders'))
+    template.install(str(tmp_path / 'out1'), use_render_cache=True)
+    cache = tmp.template_render_cache()
+    assert cache.stats()['misses'] == 3 and cache.stats()['renders'] == 3
+
+    # Installs with the same parameters copy the renders from the cache
+    template.install(str(tmp_path / 'out2'), use_render_cache=True)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['renders']) == (3, 3, 3)
+    for path in ('README.md', os.path.join('proj', 'list.txt'), os.path.join('src', 'local.cmake')):
+        assert read_file(str(tmp_path / 'out2' / path)) == read_file(str(tmp_path / 'out1' / path))
+
+    # ... but render those whose parameters have changed, and keep the cache to its maximum size
+    template.params['author'] = 'Someone else'
+    template.install(str(tmp_path / 'out2'), force=True, use_render_cache=True)
+    assert read_file(str(tmp_path / 'out2' / 'README.md')) == "# proj\n\nBy Someone else.\n"
+    assert cache.stats()['renders'] == 4
+    cache.size_max = 0
+    assert cache.trim() == 4 and cache.stats()['renders'] == 0
+
+
+def test_lazy_load(template_dir, params, tmp_path, monkeypatch):
+    write_file(os.path.join(template_dir, 'test', 'src', 'sub', 'd.c'), "int d;\n")
+    dir_out = str(tmp_path / 'out')
+    os.mkdir(dir_out)
+
+    def load_lazy(element, params_lazy=params):
+        template = tmp.template()
+        template.params.update(params_lazy)
+        template.add('test', path=[template_dir], element=element)
+        return template
+
+    # Only the elements leading to the element (given by output path) are loaded and scanned for parameters
+    template = load_lazy('proj/list.txt', params_lazy={'name': 'proj'})
+    assert [dir_i.template_path_in() for dir_i in template.directories] == ['.', '_var_name_var_']
+    assert template.n_files() == 1
+    assert template.params_list == set(['items'])
+    template.params.update(params)
+    assert template.render_element(dir_out, 'proj/list.txt') == b"item=x;\nitem=y;\nitem=z;\n"
+
+    # The rest of a directory is only loaded for files listing it, without walking its sub-directories
+    template = load_lazy('src/local.cmake.template')
+    assert template.get_file('src/a.c') is not None
+    assert template.get_directory('src/sub') is not None and template.get_file('src/sub/d.c') is None
+    assert template.params_list == set()
+    os.mkdir(os.path.join(dir_out, 'src'))
+    template.install(dir_out, update='src/local.cmake')
+    assert os.listdir(os.path.join(dir_out, 'src')) == ['local.cmake']
+    assert read_file(os.path.join(dir_out, 'src', 'local.cmake')) == "dirs=sub\nfiles=a.c\nfiles=b.h\n"
+    assert template.install(dir_out, update='src/local.cmake', force=True).n_operations() == 0
+
+    # Directories are loaded with everything under them
+    template = load_lazy('src')
+    assert template.get_file('src/sub/d.c') is not None
+
+    # Elements which can not be found lazily load the whole template
+    assert load_lazy('missing').n_files() == 7
+    params_unnamed = dict((key, value) for key, value in params.items() if key != 'name')
+    template = load_lazy('proj/list.txt', params_lazy=params_unnamed)
+    assert template.n_files() == 7
+    assert 'name' in template.params_list
+
+    # ... so that output paths can use parameters given afterwards
+    monkeypatch.setattr('builtins.input', lambda prompt: 'proj')
+    template.validate_parameters(interactive=True)
+    os.mkdir(os.path.join(dir_out, 'proj'))
+    template.install(dir_out, update='proj/list.txt')
+    assert read_file(os.path.join(dir_out, 'proj', 'list.txt')) == "item=x;\nitem=y;\nitem=z;\n"
+    assert not os.path.exists(os.path.join(dir_out, 'README.md'))
+
+
+def test_output_tree(template_dir, params, tmp_path, monkeypatch):
+    dir_out = str(tmp_path / 'out')
+    write_file(os.path.join(dir_out, 'src', 'a.c'), "int a;\n")
+    os.symlink('src', os.path.join(dir_out, 'link'))
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(path) or scandir(path))
+
+    # Each directory is listed once, and missing directories are never listed
+    output_tree = tmp.template_output_tree()
+    assert output_tree.isdir(dir_out)
+    assert output_tree.isfile(os.path.join(dir_out, 'src', 'a.c'))
+    assert output_tree.isdir(os.path.join(dir_out, 'link')) and output_tree.islink(os.path.join(dir_out, 'link'))
+    assert not output_tree.lexists(os.path.join(dir_out, 'missing', 'b.c'))
+    assert not output_tree.isfile(os.path.join(dir_out, 'src', 'a.c', 'b.c'))
+    assert scanned == [dir_out, os.path.join(dir_out, 'src')]
+
+    # The snapshot follows the operations performed
+    output_tree.apply(tmp.template_operation('mkdir', os.path.join(dir_out, 'new')))
+    output_tree.apply(tmp.template_operation('write', os.path.join(dir_out, 'new', 'b.c'), content=b"int b;\n"))
+    output_tree.apply(tmp.template_operation('rmtree', os.path.join(dir_out, 'src')))
+    assert output_tree.isfile(os.path.join(dir_out, 'new', 'b.c'))
+    assert not output_tree.lexists(os.path.join(dir_out, 'src', 'a.c'))
+    assert len(scanned) == 2
+
+    # Installs answer everything from the snapshot
+    template = load_template(template_dir, params)
+    scanned[:] = []
+    template.install(dir_out)
+    scanned_out = [path for path in scanned if str(path).startswith(dir_out)]
+    assert len(scanned_out) == len(set(scanned_out))
+    isfile = os.path.isfile
+    checked = []
+    monkeypatch.setattr(os.path, 'isfile', lambda path: checked.append(path) or isfile(path))
+    template.install(dir_out, force=True)
+    assert checked == [os.path.join(dir_out, tmp.template_manifest.filename)]
+
+
+def test_counters(template_dir, params, tmp_path):
+    write_file(os.path.join(template_dir, 'test', 'src', 'shared.txt.link'), "Linked.\n")
+    template = load_template(template_dir, params)
+    assert template.counters['listings'] == 3
+    assert template.counters['bytes_written'] == 0
+
+    # Counts are reset for each install, and reported when it is done
+    dir_out = str(tmp_path / 'out')
+    os.makedirs(dir_out)
+    buffer = io.StringIO()
+    log_saved = tmp.gbpBuild.log
+    tmp.gbpBuild.log = log_saved.__class__(fp_out=buffer)
+    try:
+        template.install(dir_out, use_render_cache=False)
+    finally:
+        tmp.gbpBuild.log = log_saved
+    counters = template.counters
+    assert set(counters) == set(tmp.template_counters.names)
+    assert counters['files_rendered'] == 3 and counters['files_copied'] == 3 and counters['symlinks_created'] == 1
+    assert counters['bytes_written'] == sum(os.path.getsize(os.path.join(root, name))
+                                            for root, _, names in os.walk(dir_out) for name in names
+                                            if name != tmp.template_manifest.filename and
+                                            not os.path.islink(os.path.join(root, name)))
+    assert counters['substitutions'] > 0 and counters['directive_resolutions'] > 0
+    assert "(%s)." % (counters) in buffer.getvalue()
+    template.install(dir_out, use_render_cache=False)
+    assert template.counters['files_rendered'] == 0 and template.counters['bytes_written'] == 0
+
+    # The operations performed by workers are counted as well
+    dir_parallel = str(tmp_path / 'parallel')
+    os.makedirs(dir_parallel)
+    template.install(dir_parallel, jobs=4)
+    for name in ('bytes_written', 'files_rendered', 'files_copied', 'symlinks_created'):
+        assert template.counters[name] == counters[name]
+
+    # Nothing is counted outside of adds, installs and uninstalls
+    counters_saved = dict(template.counters)
+    template.render_element(dir_out, 'README.md')
+    assert template.counters == counters_saved
+    template.uninstall(dir_out)
+    assert template.counters['listings'] > 0 and template.counters['files_rendered'] == 0